@@ -20,12 +20,15 @@ import os
 import urllib
 import time
 import json
+import Queue
+import threading
 import os.path as path
 from multiprocessing import Process
 from pprint import pprint
 
 from DIRAC import S_OK, S_ERROR
 from DIRAC.Core.Base.AgentModule import AgentModule
+from DIRAC.Core.Utilities.ThreadPool import ThreadPool
 
 # Copy from dirac script
 from DIRAC import gConfig, gLogger
@@ -33,6 +36,8 @@ from DIRAC.Core.Utilities.PrettyPrint import printTable
 from DIRAC.DataManagementSystem.Client.DataManager import DataManager
 from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
 
+from Project8DIRAC.DataManagementSystem.Client.AgentUtilities import processQueue
+from Project8DIRAC.DataManagementSystem.Client.DirectorySync import RemoteListingCache, getFilesToDownload
 
 __RCSID__ = ' '
 
@@ -64,6 +69,20 @@ class Project8CalibProcessedFileSyncAgent(AgentModule):
         self.calibDirs = ['rf_bkgd', 'esr']
         self.ProcDataDir = 'proc'
 
+        ### The calib dirs are synced in-process and at the same time: the catalog listing is cached between cycles
+        ### (sub dirs listed again when they change, everything every ListingCacheTTL seconds), and the new or
+        ### changed files are downloaded by maxNumberOfDownloads threads. InProcessSync = False falls back to
+        ### dirac-dms-directory-sync, one calib dir after the other.
+        self.inProcessSync = bool(self.am_getOption("InProcessSync", True))
+        self.listingCache = RemoteListingCache(int(self.am_getOption("ListingCacheTTL", 3600)))
+        self.maxNumberOfDownloads = int(self.am_getOption("maxNumberOfDownloads", 4))
+        self.threadPool = ThreadPool(self.maxNumberOfDownloads, self.maxNumberOfDownloads)
+        ### The download threads, and the clients they and the listing threads use, are kept from one cycle to the next
+        self.workerClients = threading.local()
+        self.listingClients = dict((calib_dir, FileCatalogClient()) for calib_dir in self.calibDirs)
+        self.toBeDownloaded = Queue.Queue(2 * self.maxNumberOfDownloads)
+        self.numberOfWorkers = 0
+
         return S_OK()
 
     def _syncDir(self, LPN, localDir):
@@ -83,11 +102,121 @@ class Project8CalibProcessedFileSyncAgent(AgentModule):
         return status
 
 
+    def _downloadFile(self, lfn, localPath, size, mtime):
+        """ Download a file with the DataManager of the current thread, and give it the mtime it has in the catalog
+            """
+        localDir = path.dirname(localPath)
+        if not path.isdir(localDir):
+            try:
+                os.makedirs(localDir)
+            except OSError as e:
+                if not path.isdir(localDir):
+                    gLogger.error('Could not create local dir (%s): %s' %(localDir, e))
+                    return S_ERROR(str(e))
+        initialTime = time.time()
+        res = self.__getWorkerClient('DataManager', DataManager).getFile(lfn, destinationDir = localDir)
+        if res['OK'] and lfn in res['Value'].get('Failed', {}):
+            res = S_ERROR(str(res['Value']['Failed'][lfn]))
+        if not res['OK']:
+            gLogger.error('Failed to download (%s) to (%s): %s' %(lfn, localDir, res['Message']))
+            ### Do not trust this client any more, the next file gets a fresh one
+            setattr(self.workerClients, 'DataManager', None)
+            return res
+        ### The next cycles compare the local mtime with the catalog one
+        if mtime:
+            try:
+                os.utime(localPath, (mtime, mtime))
+            except OSError as e:
+                gLogger.warn('Could not set the mtime of (%s): %s' %(localPath, e))
+        gLogger.info('Download of (%s) (%s bytes) successful in %s s.' %(lfn, size, round(time.time() - initialTime, 2)))
+        return res
+
+
+    def _execute(self):
+        """ Method run by the thread pool. It downloads the files pulled from the queue,
+            from one cycle to the next, until it gets the end marker (None).
+            """
+        return processQueue(self.toBeDownloaded, lambda task: self._downloadFile(*task), lambda task: 'download of file (%s)' %task[0])
+
+
+    def __getWorkerClient(self, name, clientClass):
+        """ The client of the current thread, created on first use
+            """
+        client = getattr(self.workerClients, name, None)
+        if client is None:
+            client = clientClass()
+            setattr(self.workerClients, name, client)
+        return client
+
+
+    def __startWorkers(self):
+        """ Start the download threads that are not running yet (all of them at the first cycle),
+            returns the number of running ones
+            """
+        while self.numberOfWorkers < self.maxNumberOfDownloads:
+            jobUp = self.threadPool.generateJobAndQueueIt(self._execute)
+            if not jobUp['OK']:
+                gLogger.error(jobUp['Message'])
+                break
+            self.numberOfWorkers += 1
+        return self.numberOfWorkers
+
+
+    def __syncCalibDir(self, fc, se_data_dir, local_data_dir):
+        """ List se_data_dir (through the listing cache) with the catalog client fc and queue the downloads
+            of the files that are missing or changed in local_data_dir
+            """
+        initialTime = time.time()
+        try:
+            res = self.listingCache.listTree(fc, se_data_dir)
+            if not res['OK']:
+                gLogger.error('Failed to list (%s): %s' %(se_data_dir, res['Message']))
+                return
+            toDownload = getFilesToDownload(res['Value']['Files'], se_data_dir, local_data_dir)
+            gLogger.info('Sync of %s: %s files in the catalog (%s dirs listed), %s to download. Diff took %s s.'
+                         %(se_data_dir, len(res['Value']['Files']), res['Value']['Listed'], len(toDownload),
+                           round(time.time() - initialTime, 2)))
+            for task in toDownload:
+                ### Blocks while the queue is full
+                self.toBeDownloaded.put(task)
+        except Exception as e:
+            gLogger.exception('Unexpected error while syncing %s' %se_data_dir, lException = e)
+
+
+    def __executeInProcess(self):
+        """ Sync all the calib dirs at the same time, with a shared pool of download threads
+            """
+        if not self.__startWorkers():
+            return S_ERROR('Could not start any download thread')
+
+        initialTime = time.time()
+        try:
+            syncThreads = []
+            for calib_dir in self.calibDirs:
+                se_data_dir = path.join(self.SEDataDirPath, path.join(calib_dir,self.ProcDataDir))
+                local_data_dir = path.join(self.LocalDataDirPath, path.join(calib_dir,self.ProcDataDir))
+                gLogger.info("Syncing {}: se dir {}, local dir {}".format(calib_dir, se_data_dir, local_data_dir))
+                thread = threading.Thread(target = self.__syncCalibDir, name = 'Sync-%s' %calib_dir,
+                                          args = (self.listingClients[calib_dir], se_data_dir, local_data_dir))
+                thread.daemon = True
+                thread.start()
+                syncThreads.append(thread)
+            for thread in syncThreads:
+                thread.join()
+        finally:
+            ### Block until the queued downloads are done, the download threads wait for the next cycle
+            self.toBeDownloaded.join()
+        gLogger.info('Sync of all calib dirs done in %s s.' %round(time.time() - initialTime, 2))
+        return S_OK()
+
+
     def execute(self):
         """ execution in one agent's cycle
 
         :param self: self reference
         """
+        if self.inProcessSync:
+            return self.__executeInProcess()
  
         for calib_dir in self.calibDirs:
 
@@ -16,6 +16,7 @@ import commands
 import os
 import urllib
 import time
+import json
 from pprint import pprint
 from DIRAC.Core.Utilities.Grid import executeGridCommand
 from DIRAC import S_OK, S_ERROR
@@ -28,10 +29,12 @@ from DIRAC import gConfig, gLogger
 from DIRAC.ResourceStatusSystem.Client.ResourceStatus import ResourceStatus
 from DIRAC.Core.Utilities.PrettyPrint import printTable
 from DIRAC.DataManagementSystem.Client.DataManager import DataManager
-from DIRAC.RequestManagementSystem.Client.Request import Request
-from DIRAC.RequestManagementSystem.Client.Operation import Operation
-from DIRAC.RequestManagementSystem.Client.File import File
 from DIRAC.RequestManagementSystem.Client.ReqClient import ReqClient
+from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
+
+from Project8DIRAC.DataManagementSystem.Client.AgentUtilities import makeDeletionQueue
+from Project8DIRAC.DataManagementSystem.Client.CatalogUtilities import getReplicasInChunks
+from Project8DIRAC.DataManagementSystem.Client.ReplicationRequests import buildRequest
 
 __RCSID__ = ' (Fri Oct  2 13:25:08 PDT 2015)  Malachi Schram <malachi.schram@pnnl.gov '
 
@@ -53,6 +56,11 @@ class Project8ReplicateAgentIgnatius(AgentModule):
         self.SEDataDirPath = (self.am_getOption("SEDataDirPath",'/project8/dirac/data/'))
         self.LocalDataDirPath = (self.am_getOption("LocalDataDirPath",'/data_ignatius/'))
         self.DIRACCfgSEPath = 'Resources/StorageElements'
+        self.fc = FileCatalogClient()
+        ### Number of lfns per bulk catalog query
+        self.catalogChunkSize = int(self.am_getOption("CatalogChunkSize", 1000))
+        ### The local files are removed in the background, see makeDeletionQueue for the options
+        self.deletionQueue = makeDeletionQueue(self)
 
         return S_OK()
 
@@ -63,28 +71,13 @@ class Project8ReplicateAgentIgnatius(AgentModule):
             """
     
         ## Setup request
-        request = Request()
-        request.RequestName = "DDM_"+ str(target_se) +  datetime.datetime.now().strftime("_%Y%m%d_%H%M%S")
-        myOp = Operation()
-        myOp.Type = whichRMSOp
-        myOp.TargetSE = target_se
-        ## Add LFNS to operations
-        for lfn in lfns_chunk_dict.keys():
-            opFile = File()
-            opFile.LFN = lfn
-            opFile.Size = lfns_chunk_dict[lfn]['Size']
-            if "Checksum" in lfns_chunk_dict[lfn]:
-                opFile.Checksum = lfns_chunk_dict[lfn]['Checksum']
-                opFile.ChecksumType = 'ADLER32'
-                ## Add file to operation
-                myOp.addFile( opFile )
-    
-        request.addOperation( myOp )
+        request = buildRequest( target_se, lfns_chunk_dict, whichRMSOp )
         reqClient = ReqClient()
         putRequest = reqClient.putRequest( request )
         if not putRequest["OK"]:
             gLogger.error( "Unable to put request '%s': %s" % ( request.RequestName, putRequest["Message"] ) )
             return S_ERROR("Problem submitting to RMS.")
+        return S_OK( putRequest["Value"] )
 
 
     def execute(self):
@@ -109,58 +102,43 @@ class Project8ReplicateAgentIgnatius(AgentModule):
         se_data_dir = self.SEDataDirPath
         local_data_dir = self.LocalDataDirPath
         
+        ### Collect the candidate files first ( dict with key - lfn and value = local-pfn )
+        filesDict = {}
         for rootdir, subdirs, filenames in os.walk(local_data_dir):
             for filename in filenames:
                 if filename.endswith('.mat') or filename.endswith('.MAT') or filename.endswith('.egg') or filename.endswith('_meta.json') or filename.endswith('.msk') or filename.endswith('.Setup'):
                     gLogger.info('Matched local file: ' + filename)
                     pfn = os.path.join(rootdir, filename)
                     lfn = os.path.join(se_data_dir, os.path.join(rootdir, filename).split(local_data_dir)[-1])
-
-                    ### Check if file already exists ###
-                    cmd = 'dirac-dms-lfn-accessURL ' + lfn + ' ' + dest_se
-                    gLogger.debug(cmd)
-                    status, output = commands.getstatusoutput(cmd)
-                    if "No such file" not in output:
-                        gLogger.info('File already exists ... removing.')
-                        cmd = '/bin/rm ' + pfn + ' <<< y'
-                        gLogger.debug(cmd)
-                        status, output = commands.getstatusoutput(cmd)
-                        if status==0:
-                            gLogger.info('File successfully removed.')
-                        else:
-                            gLogger.error('Problem removing file!  rm returned {}'.format(status))
-                            gLogger.info('rm cmd was: "{}"'.format(cmd))
-                        continue
-                    else:   
-                    ### Upload file ###
-                        cmd = 'dirac-dms-add-file -ddd -o /Resources/Sites/Test=true '
-                        gLogger.info("local file is {}".format(lfn))
-                        cmd += lfn + ' '
-                        gLogger.info("will move file to {}".format(pfn))
-                        cmd += pfn + ' ' 
-                        cmd += dest_se 
-                        gLogger.info("full upload command is:\n{}".format(cmd))
-                        initialTime = time.time()
-                        status, output = commands.getstatusoutput(cmd)
-                        elapsedTime = time.time() - initialTime
-                        if status==0:
-                            gLogger.info('Upload successful in {} s. Removing local file...'.format(elapsedTime))
-                            cmd = '/bin/rm ' + pfn + ' <<< y'
-                            gLogger.debug(cmd)
-                            status, output = commands.getstatusoutput(cmd)
-                            if status==0:
-                                gLogger.info('File successfully removed.')
-                            else:
-                                gLogger.error('Problem removing file!  rm returned {}'.format(status))
-                                gLogger.info('rm cmd was: "{}"'.format(cmd))
-                        else:
-                            gLogger.error('Failed to upload file ' + lfn)
-
+                    filesDict[lfn] = pfn
+
+        if not filesDict:
+            return S_OK()
+
+        ### Check if files already exist, in bulk ###
+        res = getReplicasInChunks(self.fc, filesDict.keys(), self.catalogChunkSize)
+        if not res['OK']:
+            gLogger.error(res['Message'])
+            return res
+        replicasDict = res['Value']['Successful']
+
+        for lfn in sorted(filesDict):
+            pfn = filesDict[lfn]
+            filename = os.path.basename(pfn)
+
+            if lfn in replicasDict:
+                if dest_se not in replicasDict[lfn]:
+                    gLogger.warn('File (%s) is in the catalog but not on %s ... skipping.' %(lfn, dest_se))
+                    continue
+                gLogger.info('File already exists ... removing.')
+                self.deletionQueue.add(pfn)
+                continue
+            else:   
                 ### Do metadata for the dir
                 if filename.endswith('_meta.json'):
-                    meta_json_string = open(filename).read()
+                    meta_json_string = open(pfn).read()
                     meta_python_unicode_dict = json.loads(meta_json_string) # converts to unicode
-                    
+                
                     meta_python_dict = {} # this one is utf encoded
                     for item in meta_python_unicode_dict.items():
                         key = item[0].encode('utf-8')
@@ -175,4 +153,23 @@ class Project8ReplicateAgentIgnatius(AgentModule):
                         meta_python_dict[key] = value
                     gLogger.info('Meta Data from file (%s) is: %s' %(filename, meta_python_dict))
 
+                ### Upload file ###
+                cmd = 'dirac-dms-add-file -ddd -o /Resources/Sites/Test=true '
+                gLogger.info("local file is {}".format(lfn))
+                cmd += lfn + ' '
+                gLogger.info("will move file to {}".format(pfn))
+                cmd += pfn + ' ' 
+                cmd += dest_se 
+                gLogger.info("full upload command is:\n{}".format(cmd))
+                initialTime = time.time()
+                status, output = commands.getstatusoutput(cmd)
+                elapsedTime = time.time() - initialTime
+                if status==0:
+                    gLogger.info('Upload successful in {} s. Removing local file...'.format(elapsedTime))
+                    self.deletionQueue.add(pfn)
+                else:
+                    gLogger.error('Failed to upload file ' + lfn)
+
+        ### Wait for the removals that are due
+        self.deletionQueue.drain()
         return S_OK()
@@ -20,17 +20,33 @@ import time
 import json
 import math
 import Queue
+import threading
 import gfal2
 
 from DIRAC import S_OK, S_ERROR
 from DIRAC.Core.Base.AgentModule import AgentModule
 from DIRAC.Core.Utilities.ThreadPool                            import ThreadPool
-from DIRAC.Interfaces.API.Dirac import Dirac
+from DIRAC.Core.Utilities.List import breakListIntoChunks
 
 # Copy from dirac script
 from DIRAC import gConfig, gLogger
+from DIRAC.Core.Utilities.File import makeGuid
 from DIRAC.DataManagementSystem.Client.DataManager import DataManager
 from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
+from DIRAC.Resources.Storage.StorageElement import StorageElement
+
+from Project8DIRAC.DataManagementSystem.Client.AgentUtilities import dumpMetrics, makeDeletionQueue, processQueue
+from Project8DIRAC.DataManagementSystem.Client.BandwidthLimiter import BandwidthLimiter, parseSchedule
+from Project8DIRAC.DataManagementSystem.Client.CatalogUtilities import CatalogLookupCache
+from Project8DIRAC.DataManagementSystem.Client.ChecksumCache import ChecksumCache, adler32
+from Project8DIRAC.DataManagementSystem.Client.ConcurrencyController import ConcurrencyController
+from Project8DIRAC.DataManagementSystem.Client.DirMetadataCache import DirMetadataCache
+from Project8DIRAC.DataManagementSystem.Client.InotifyWatcher import InotifyWatcher
+from Project8DIRAC.DataManagementSystem.Client.ReplicationRequests import ReplicationRequests, parseSecondarySEs
+from Project8DIRAC.DataManagementSystem.Client.RetryJournal import RetryJournal
+from Project8DIRAC.DataManagementSystem.Client.ScanIndex import ScanIndex
+from Project8DIRAC.DataManagementSystem.Client.SmallFileArchive import buildArchive, removeArchive
+from Project8DIRAC.DataManagementSystem.Client.TransferMetrics import TransferMetrics, RATE_BUCKETS
 
 
 __RCSID__ = ' '
@@ -57,20 +73,191 @@ class Project8ThreadedDataReplicateAgent(AgentModule):
         self.SEDataDirPath = (self.am_getOption("SEDataDirPath",'/project8/dirac/data/'))
         self.LocalDataDirPaths = (self.am_getOption("LocalDataDirPaths",['/data_ignatius/', '/data_zeppelin']))
         self.MaxFilesToTransferPerCycle = int(self.am_getOption("MaxFilesToTransferPerCycle",200))
+        ### Max total size of the files copied in one cycle, 0 for no limit
+        self.MaxBytesToTransferPerCycle = int(self.am_getOption("MaxBytesToTransferPerCycle",0))
         
+        ### ADLER32 checksums of the files to be copied are computed ahead of the uploads by a process pool,
+        ### and cached by (path, size, mtime) so that the upload and the verification do not read the file again.
+        ### The pool is started here, before any thread: its processes are forked.
+        self.checksumCache = None
+        if bool(self.am_getOption("PrecomputeChecksums", False)):
+            checksumCacheFile = self.am_getOption("ChecksumCacheFile", os.path.join(self.am_getWorkDirectory(), 'ChecksumCache.db'))
+            self.checksumCache = ChecksumCache(checksumCacheFile,
+                                               self.am_getOption("ChecksumProcesses", 4),
+                                               int(self.am_getOption("ChecksumMinSize", 10 * 1024 * 1024)))
+            self.checksumCache.start()
+        ### Max time a copy thread waits for a checksum being computed. A checksum whose computation did not start
+        ### yet is not waited for, the upload computes it.
+        self.checksumTimeout = int(self.am_getOption("ChecksumTimeout", 3600))
+
         self.maxNumberOfThreads = self.am_getOption( 'maxNumberOfThreads', self.__maxNumberOfThreads )
         self.threadPool    = ThreadPool( self.maxNumberOfThreads, self.maxNumberOfThreads )
+        ### Max number of files waiting in the copy queue (the scanner blocks when it is full)
+        self.copyQueueSize = int(self.am_getOption( 'CopyQueueSize', 2 * self.maxNumberOfThreads ))
+
+        ### Optionally, the number of uploads running at once is adapted (AIMD) between minNumberOfThreads
+        ### and maxNumberOfThreads from the per file rates and the error rate of the uploads
+        self.concurrencyController = None
+        if bool(self.am_getOption( 'AdaptiveConcurrency', False )):
+            self.concurrencyController = ConcurrencyController( self.am_getOption( 'minNumberOfThreads', 2 ),
+                                                                self.maxNumberOfThreads,
+                                                                window = self.am_getOption( 'AdaptiveWindow', 10 ),
+                                                                maxErrorRate = self.am_getOption( 'AdaptiveMaxErrorRate', 0.2 ) )
+
+        ### Each worker thread keeps its own DataManager across files and cycles.
+        ### It is recycled after ClientMaxUses uploads, after ClientMaxAge seconds, or after a failed upload.
+        self.workerClients = threading.local()
+        self.clientMaxUses = int(self.am_getOption( 'ClientMaxUses', 500 ))
+        self.clientMaxAge = int(self.am_getOption( 'ClientMaxAge', 3600 ))
+
+        ### Files already in the catalog are verified on the SE by their own threads, alongside the uploads
+        self.maxNumberOfVerifyThreads = int(self.am_getOption( 'maxNumberOfVerifyThreads', 5 ))
+        self.verifyThreadPool = ThreadPool( self.maxNumberOfVerifyThreads, self.maxNumberOfVerifyThreads )
+        self.toBeVerified = []  # verify queues of the current cycle, each with its own threads
+
+        ### Dir meta data already registered, and meta data waiting to be registered in bulk at the end of the cycle
+        self.dirMetaDataCache = DirMetadataCache(self.am_getOption("DirMetadataCacheFile", os.path.join(self.am_getWorkDirectory(), 'DirMetadataCache.db')))
+        self.pendingDirMetaData = {}
+        self.pendingDirMetaDataLock = threading.Lock()
+        ### Parsed meta data files, keyed by local path
+        self.metaDataFileCache = {}
 
         # Extra metadata added by the user.
         self.extraMetadata =  {"DataLevel": "RAW", "DataType": "Data"}
         
         gLogger.info('MaxFilesToTransferPerCycle: ' + str(self.MaxFilesToTransferPerCycle))
+        gLogger.info('MaxBytesToTransferPerCycle: ' + str(self.MaxBytesToTransferPerCycle))
         gLogger.info('maxNumberOfThreads: ' + str(self.maxNumberOfThreads))
 
         self.DIRACCfgSEPath = 'Resources/StorageElements'
         self.fc = FileCatalogClient()
+        ### Number of lfns per bulk catalog query
+        self.catalogChunkSize = int(self.am_getOption("CatalogChunkSize", 1000))
+        ### The replica lookups are cached: the files in the catalog for CatalogPositiveTTL seconds, the files not in it
+        ### for CatalogNegativeTTL seconds (0 to disable either). The files uploaded by the agent are looked up again.
+        self.catalogLookupCache = CatalogLookupCache(int(self.am_getOption("CatalogPositiveTTL", 0)),
+                                                     int(self.am_getOption("CatalogNegativeTTL", 0)))
         
         self.acceptableFileSuffix = ['.mat', '.MAT', '.egg', '_meta.json', '.msk', '.Setup', '.json', '_snapshot.json', '.yaml']
+
+        ### Files modified less than MinFileAge seconds ago are left for a later cycle (they may still be written)
+        self.minFileAge = int(self.am_getOption("MinFileAge", 0))
+
+        ### The local dirs are scanned at the same time, and their files share MaxFilesToTransferPerCycle according to
+        ### LocalDataDirWeights (one weight per dir, same order as LocalDataDirPaths, all 1 by default).
+        ### A dir not scanned within ScanTimeout seconds (0 for no limit) only contributes the files found so far.
+        weights = self.am_getOption("LocalDataDirWeights", [])
+        self.localDataDirWeights = {}
+        for index, local_data_dir in enumerate(self.LocalDataDirPaths):
+            self.localDataDirWeights[local_data_dir] = max(float(weights[index]) if index < len(weights) else 1., 0.)
+        self.scanTimeout = float(self.am_getOption("ScanTimeout", 0))
+        self.scanThreads = {}
+
+        ### Disk pressure: the local dirs on a file system more than HighWatermark full (fraction, 0 to disable) are
+        ### drained first, fullest first, with their files picked by PressureOrder ('size': largest first, 'age':
+        ### oldest first), and the agent polls every PressurePollingTime seconds until the pressure is gone.
+        self.highWatermark = float(self.am_getOption("HighWatermark", 0))
+        self.pressureOrder = self.am_getOption("PressureOrder", 'size')
+        self.pressurePollingTime = int(self.am_getOption("PressurePollingTime", 60))
+        self.normalPollingTime = self.am_getPollingTime()
+
+        ### Optional watch mode: files are copied as soon as they are closed (inotify),
+        ### with a full scan every WatchRescanInterval seconds for consistency
+        self.watcher = None
+        self.rescanDue = False
+        if bool(self.am_getOption("WatchMode", False)):
+            self.watchCycleDuration = int(self.am_getOption("WatchCycleDuration", 600))
+            self.watchRescanInterval = int(self.am_getOption("WatchRescanInterval", 3600))
+            self.lastFullScan = 0
+            watcher = InotifyWatcher(self.LocalDataDirPaths)
+            res = watcher.start()
+            if res['OK']:
+                self.watcher = watcher
+                ### The full scans run while files are being written, only the ones untouched for a while are taken
+                if self.minFileAge <= 0:
+                    self.minFileAge = 60
+                    gLogger.info('Watch mode: MinFileAge is not set, using %s s' %self.minFileAge)
+            else:
+                gLogger.error('Could not start watch mode, falling back to scanning: %s' %res['Message'])
+
+        ### Persistent index of the local dirs, so that only changed dirs are listed in each cycle
+        self.scanIndex = None
+        self.useScanIndex = bool(self.am_getOption("UseScanIndex", False))
+        if self.useScanIndex:
+            scanIndexFile = self.am_getOption("ScanIndexFile", os.path.join(self.am_getWorkDirectory(), 'ScanIndex.db'))
+            self.scanIndex = ScanIndex(scanIndexFile)
+            gLogger.info('Using scan index: ' + scanIndexFile)
+
+        ### Compare the size and checksum in the catalog with the local file before deleting a file already registered
+        self.verifyChecksum = bool(self.am_getOption("VerifyChecksum", False))
+
+        ### Optionally, the small side files of a run dir are packed into one tar archive (with a manifest),
+        ### uploaded and registered as a single file. The dir meta data is still registered from the _meta.json files.
+        self.aggregateSmallFiles = bool(self.am_getOption("AggregateSmallFiles", False))
+        self.aggregateSuffixes = tuple(self.am_getOption("AggregateSuffixes", ['_meta.json', '_snapshot.json', '.json', '.yaml', '.Setup', '.msk']))
+        self.aggregateMaxFileSize = int(self.am_getOption("AggregateMaxFileSize", 1024 * 1024))
+        self.aggregateMinFiles = int(self.am_getOption("AggregateMinFiles", 2))
+        self.aggregationDir = self.am_getOption("AggregationDir", os.path.join(self.am_getWorkDirectory(), 'Aggregation'))
+
+        ### Files of at least LargeFileThreshold bytes (0 to disable) are copied directly with gfal2, with LargeFileStreams
+        ### parallel streams and up to LargeFileRetries retries of the transfer, then registered in the catalog
+        self.largeFileThreshold = int(self.am_getOption("LargeFileThreshold", 0))
+        self.largeFileStreams = int(self.am_getOption("LargeFileStreams", 8))
+        self.largeFileRetries = int(self.am_getOption("LargeFileRetries", 3))
+        self.largeFileRetryDelay = int(self.am_getOption("LargeFileRetryDelay", 30))
+        self.largeFileTimeout = int(self.am_getOption("LargeFileTimeout", 0))
+        self.largeFileProtocols = self.am_getOption("LargeFileProtocols", ['srm', 'gsiftp', 'root', 'https'])
+
+        ### Failed uploads are journaled: a file is retried after an exponential backoff (RetryBaseDelay seconds doubled
+        ### at each failure, at most RetryMaxDelay) and quarantined after QuarantineAfter failures (0 for never)
+        self.retryJournal = None
+        if bool(self.am_getOption("UseRetryJournal", False)):
+            self.retryJournal = RetryJournal(self.am_getOption("RetryJournalFile", os.path.join(self.am_getWorkDirectory(), 'RetryJournal.db')),
+                                             int(self.am_getOption("RetryBaseDelay", 600)),
+                                             int(self.am_getOption("RetryMaxDelay", 86400)),
+                                             int(self.am_getOption("QuarantineAfter", 10)))
+
+        ### Optional limit on the upload rate to CopyToSE, by time of day: BandwidthLimits is a list of
+        ### 'HH:MM-HH:MM=bytes/s' windows (no limit outside of them), applied per file with a token bucket.
+        ### While limited, at most BandwidthMaxStreams uploads run at once, which bounds the peak rate.
+        self.bandwidthLimiter = None
+        bandwidthLimits = self.am_getOption("BandwidthLimits", [])
+        if bandwidthLimits:
+            res = parseSchedule(bandwidthLimits)
+            if not res['OK']:
+                return res
+            self.bandwidthLimiter = BandwidthLimiter(float(self.am_getOption("BandwidthBurstTime", 1.)),
+                                                     int(self.am_getOption("BandwidthMaxStreams", 2)))
+            self.bandwidthLimiter.setSchedule(self.CopyToSE, res['Value'])
+            gLogger.info('Upload rate limits to %s: %s' %(self.CopyToSE, ', '.join(bandwidthLimits)))
+
+        ### Optional replication of the uploaded files from CopyToSE to secondary SEs by data type (file suffix):
+        ### SecondarySEs is a list of 'suffix=SE1+SE2' entries. The files uploaded in a cycle are submitted to the RMS
+        ### at its end, as ReplicateAndRegister requests of at most RMSChunkSize files.
+        self.replicationRequests = None
+        secondarySEs = self.am_getOption("SecondarySEs", [])
+        if secondarySEs:
+            res = parseSecondarySEs(secondarySEs)
+            if not res['OK']:
+                return res
+            self.replicationRequests = ReplicationRequests(self.am_getOption("ReplicationQueueFile", os.path.join(self.am_getWorkDirectory(), 'ReplicationQueue.db')),
+                                                           res['Value'], int(self.am_getOption("RMSChunkSize", 500)), self.CopyToSE)
+
+        ### Metrics, written to MetricsDir at the end of every cycle (empty MetricsDir to disable)
+        self.metrics = TransferMetrics('project8_data_replicate')
+        self.metricsDir = self.am_getOption("MetricsDir", self.am_getWorkDirectory())
+        self.metricsFormats = self.am_getOption("MetricsFormats", ['prometheus', 'json'])
+        self.metrics.describe('scan_duration_seconds', 'Time to scan a local data dir')
+        self.metrics.describe('catalog_rpc_seconds', 'Latency of the File Catalog calls')
+        self.metrics.describe('copy_queue_depth', 'Files waiting in the copy queue')
+        self.metrics.describe('upload_duration_seconds', 'Time to upload and register a file')
+        self.metrics.describe('upload_rate_bytes_per_second', 'Per file upload rate')
+        self.metrics.describe('verify_duration_seconds', 'Time to stat an already registered replica on the SE')
+        self.metrics.describe('delete_duration_seconds', 'Time to remove a local file')
+
+        ### The local files are removed in the background, see makeDeletionQueue for the options
+        ### The end of a cycle waits for the removals that are due.
+        self.deletionQueue = makeDeletionQueue(self, self.metrics)
         
         return S_OK()
 
@@ -78,7 +265,13 @@ class Project8ThreadedDataReplicateAgent(AgentModule):
     def __getMetaData(self, filename):
         ### Give json filename as input
         ### return meta data dict
+        ### The parsed dict is cached until the file size or mtime changes
     
+        st = os.stat(filename)
+        cached = self.metaDataFileCache.get(filename)
+        if cached and cached[0] == (st.st_size, st.st_mtime):
+            return dict(cached[1])
+
         meta_json_string = open(filename).read()
         meta_python_unicode_dict = json.loads(meta_json_string) # converts to unicode
         
@@ -95,7 +288,8 @@ class Project8ThreadedDataReplicateAgent(AgentModule):
                 value = item[1].encode('utf-8')
             meta_python_dict[key] = value
 
-        return meta_python_dict
+        self.metaDataFileCache[filename] = ((st.st_size, st.st_mtime), meta_python_dict)
+        return dict(meta_python_dict)
 
 
     def execute(self):
@@ -122,6 +316,40 @@ class Project8ThreadedDataReplicateAgent(AgentModule):
         gLogger.info("Using SE dir : " + se_data_dir)
         gLogger.info("Using local dir : %s" % ','.join(local_data_dirs))
 
+        cycleStartTime = time.time()
+        cycleStartBytes = self.metrics.getCounter('uploaded_bytes_total')
+        try:
+            if self.watcher:
+                return self.__executeWatchMode()
+            return self.__executeScan()
+        finally:
+            self.__exportCycleMetrics(time.time() - cycleStartTime, self.metrics.getCounter('uploaded_bytes_total') - cycleStartBytes)
+
+
+    def __exportCycleMetrics(self, cycleDuration, cycleBytes):
+        """ Record the cycle level metrics and write all the metrics to MetricsDir
+            """
+        self.metrics.observe('cycle_duration_seconds', cycleDuration)
+        self.metrics.setGauge('last_cycle_duration_seconds', cycleDuration)
+        self.metrics.setGauge('last_cycle_uploaded_bytes', cycleBytes)
+        self.metrics.setGauge('last_cycle_throughput_bytes_per_second', cycleBytes / max(cycleDuration, 1e-6))
+        if self.concurrencyController:
+            self.metrics.setGauge('upload_concurrency_limit', self.concurrencyController.getStatus()['Limit'])
+        if self.bandwidthLimiter:
+            for se, status in self.bandwidthLimiter.getStatus().items():
+                gLogger.info('Upload rate to %s: %.0f bytes/s (limit %s)' %(se, status['Rate'], status['Limit'] or 'none'))
+                self.metrics.setGauge('bandwidth_limit_bytes_per_second', status['Limit'], {'se': se})
+                self.metrics.setGauge('achieved_rate_bytes_per_second', status['Rate'], {'se': se})
+        if self.retryJournal:
+            retryStatus = self.retryJournal.getStatus()
+            self.metrics.setGauge('backing_off_files', retryStatus['BackingOff'])
+            self.metrics.setGauge('quarantined_files', retryStatus['Quarantined'])
+        dumpMetrics(self.metrics, self.metricsDir, self.metricsFormats)
+
+
+    def __executeScan(self):
+        """ One cycle driven by a scan of the local dirs
+            """
         # Get files to be copied ( returns a dict with key - lfn and value = local-pfn )
         res_filesToBeCopiedDict = self.getFilesToBeCopied()
         if not res_filesToBeCopiedDict['OK']:
@@ -130,40 +358,93 @@ class Project8ThreadedDataReplicateAgent(AgentModule):
         filesToBeCopiedDict = res_filesToBeCopiedDict['Value']
 
         gLogger.info("Number of files to be copied in this cycle are : %s" % len(filesToBeCopiedDict))
-        while filesToBeCopiedDict:
-            
-            res_toBeCopied = self.makeFileCopyQueue(filesToBeCopiedDict, self.maxNumberOfThreads)
-            if not res_toBeCopied[ 'OK' ]:
-                gLogger.error( res_toBeCopied[ 'Message' ] )
-                continue ### Go to next iteration of while loop
-            self.toBeCopied, lfn_toCopy = res_toBeCopied[ 'Value' ]
-
-            for _x in xrange( self.toBeCopied.qsize() ):
-                jobUp = self.threadPool.generateJobAndQueueIt( self._execute )
-                if not jobUp[ 'OK' ]:
-                    glogger.error( jobUp[ 'Message' ] )
-                        
-            gLogger.info( 'Blocking until all spawned threads (Num=%s) have finish copying.' %(self.toBeCopied.qsize()) )
-            # block until all tasks are done
-            self.toBeCopied.join()
-            ### Remove all the lfns that are copied in the loop
-            for lfn in lfn_toCopy:
-                filesToBeCopiedDict.pop(lfn, None)
-            gLogger.info( 'All threads are done (Num=%s). Number of files remaining to be copied = %s'
-                         %( self.toBeCopied.qsize(), len(filesToBeCopiedDict) ) )
+        res = S_OK()
+        if filesToBeCopiedDict:
+            res = self.__copyFiles(filesToBeCopiedDict)
+
+        ### The verification of the files already in the catalog runs alongside the uploads
+        self.__waitForVerification()
+        ### Register the dir meta data found in this cycle
+        self.flushDirMetaData()
+        self.submitReplicationRequests()
+        self.deletionQueue.drain()
+
+        return res
+
+
+    def __executeWatchMode(self):
+        """ One cycle in watch mode: the files closed under LocalDataDirPaths (as reported by inotify)
+            are copied as they come for WatchCycleDuration seconds. A full scan is done first
+            every WatchRescanInterval seconds, when inotify events were lost, or when files are known
+            to be left over (see __isRescanDue).
+            """
+        if self.watcher.overflowed or self.__isRescanDue() or time.time() - self.lastFullScan >= self.watchRescanInterval:
+            gLogger.info('Watch mode: doing a full scan of the local dirs')
+            self.watcher.resetOverflow()
+            self.rescanDue = False
+            self.lastFullScan = time.time()
+            res = self.__executeScan()
+            if not res['OK']:
+                return res
+
+        res = self.__startCopyThreads( self.maxNumberOfThreads )
+        if not res[ 'OK' ]:
+            return res
+        numberOfWorkers = res[ 'Value' ]
+
+        try:
+            endTime = time.time() + self.watchCycleDuration
+            while time.time() < endTime:
+                closedFiles = self.watcher.getFiles( 1, self.MaxFilesToTransferPerCycle )
+                if not closedFiles:
+                    continue
+                closedFilesDict = {}
+                for local_data_dir, pfn, closed in closedFiles:
+                    ### Make sure file ends in acceptable suffix.
+                    if not pfn.endswith(tuple(self.acceptableFileSuffix)) or not os.path.isfile(pfn):
+                        continue
+                    ### A file found in a new dir may still be written: if it is too recent, it is left to
+                    ### its close event, or to the full scan at the start of the next cycle if it was closed already
+                    if not closed and self.minFileAge and not self.__isOldEnough(pfn):
+                        self.rescanDue = True
+                        continue
+                    ### Files that failed recently wait for their next attempt, the removed ones are done
+                    if self.retryJournal and not self.retryJournal.isDue(pfn):
+                        continue
+                    if self.deletionQueue.isPending(pfn):
+                        continue
+                    lfn = os.path.join( self.SEDataDirPath, pfn.split(local_data_dir)[-1].strip("/") )
+                    closedFilesDict[lfn] = pfn
+                if not closedFilesDict:
+                    continue
+                gLogger.info('Watch mode: %s closed files to be copied' %len(closedFilesDict))
+
+                ### The files already in the catalog are verified alongside, the verification is waited for at the end of the cycle
+                res_filesToBeCopiedDict = self.filterCataloguedFiles(closedFilesDict)
+                if not res_filesToBeCopiedDict['OK']:
+                    ### inotify will not report these files again, the next cycle starts with a full scan
+                    self.rescanDue = True
+                    continue
+                self.makeFileCopyQueue(res_filesToBeCopiedDict['Value'], self.toBeCopied)
+        finally:
+            self.__stopCopyThreads( numberOfWorkers )
+            self.__waitForVerification()
+            self.flushDirMetaData()
+            self.submitReplicationRequests()
+            self.deletionQueue.drain()
 
         return S_OK()
                 
                 
     def removeLocalFile(self, local_pfn):
     
-        ### Now remove the file
-        try:
-            os.remove(local_pfn)
-            gLogger.info('File %s successfully removed.' %local_pfn)
-        except OSError as e:
-            gLogger.error('Problem removing file {} !  remove returned {}'.format(local_pfn, e.strerror))
-            pass
+        ### Now remove the file, in the background
+        self.metaDataFileCache.pop(local_pfn, None)
+        if self.checksumCache:
+            self.checksumCache.remove(local_pfn)
+        if self.retryJournal:
+            self.retryJournal.forget(local_pfn)
+        self.deletionQueue.add(local_pfn)
 
 
     def verifyAndDeleteAlreadyRegisterdFiles(self, fileFC_Dict, fileLocal_Dict ):
@@ -173,31 +454,32 @@ class Project8ThreadedDataReplicateAgent(AgentModule):
             This takes two dictionaries as input: One from FC.getReplicas as returned by Successful key and
             other is is dict with LFN as key and local-PFN as value
             It file is meta data files, then it also verifies if meta data is registered or not.
+            The files are verified by the verify threads, so this returns without waiting for them
+            and the verification runs alongside the uploads until the end of the cycle.
             """
     
-        ### Get gfal2 handle
-        gf2 = gfal2.creat_context()
+        toBeVerified = Queue.Queue()
+        self.toBeVerified.append( toBeVerified )
         ### Loop over all files in the input dict
         for lfn in fileFC_Dict:
-            
-            pfn = fileFC_Dict[lfn][self.CopyToSE]
-            try:
-                stat_values = gf2.stat(pfn)
-                _replica_size = stat_values.st_size
-                gLogger.info('File (%s) was found on the SE (%s). Now deleting it locally.' %(lfn, self.CopyToSE))
-                if lfn.endswith('_meta.json'):
-                    ### Make sure the parent dir has metaData set
-                    res = self.registerDirMetaData(lfn,  self.__getMetaData(fileLocal_Dict[lfn]) )
-                    ### If setting of meta data failed, then go to next file
-                    if not res['OK']: continue
-                ###
-                self.removeLocalFile(fileLocal_Dict[lfn]) ### Need local PFN as well.
-                
-            except Exception, err:
-                _error_msg = err.message
-                msg = 'gfal API to query stat failed on PFN (%s) with output as %s' % (pfn, err)
-                gLogger.error(msg)
-    
+            toBeVerified.put( {'lfn': lfn, 'pfn': fileLocal_Dict[lfn], 'replicas': fileFC_Dict[lfn]} )
+
+        numberOfWorkers = 0
+        for _x in xrange( min( self.maxNumberOfVerifyThreads, len(fileFC_Dict) ) ):
+            jobUp = self.verifyThreadPool.generateJobAndQueueIt( self._verify, args = ( toBeVerified, ) )
+            if not jobUp[ 'OK' ]:
+                gLogger.error( jobUp[ 'Message' ] )
+                continue
+            numberOfWorkers += 1
+
+        ### One end marker per worker, each worker exits when it gets one
+        for _x in xrange( max( numberOfWorkers, 1 ) ):
+            toBeVerified.put( None )
+        if not numberOfWorkers:
+            ### No verify thread could be started, do it here
+            self._verify( toBeVerified )
+
+        return S_OK( numberOfWorkers )
 
 
     def registerDirMetaData(self, lfn, meta_dict):
@@ -207,42 +489,145 @@ class Project8ThreadedDataReplicateAgent(AgentModule):
             """
         filename = os.path.basename(lfn)
         lpn = lfn.split(filename)[0].rstrip('/')
-        res = self.fc.setMetadata(lpn, meta_dict)
+        ### Nothing to do if this very meta data was already registered on the dir
+        if self.dirMetaDataCache.isRegistered(lpn, meta_dict):
+            gLogger.verbose('Meta data on lpn (%s) is already registered' %lpn)
+            return S_OK()
+        with self.metrics.timer('catalog_rpc_seconds', {'method': 'setMetadata'}):
+            res = self.fc.setMetadata(lpn, meta_dict)
         if not res['OK']:
             gLogger.error('Setting Meta Data from file (%s) on dir (%s) failed with message (%s)' %(filename, lpn, res['Message']))
         else:
             gLogger.info('Setting meta data on lpn (%s) succeeded' %lpn)
+            self.dirMetaDataCache.setRegistered(lpn, meta_dict)
         ### res is either S_OK or S_ERROR
         return res
 
 
-    def makeFileCopyQueue(self, filesToBeCopiedDict, size):
+    def queueDirMetaData(self, lfn, meta_dict, local_pfn):
+        """
+            queueDirMetaData
+            queues the meta data to be registered at dir level (as deduced from provided LFN) at the end of the cycle,
+            together with the meta data of the other dirs. The local meta data file is removed once it is registered.
+            """
+        filename = os.path.basename(lfn)
+        lpn = lfn.split(filename)[0].rstrip('/')
+        if self.dirMetaDataCache.isRegistered(lpn, meta_dict):
+            gLogger.verbose('Meta data on lpn (%s) is already registered' %lpn)
+            self.removeLocalFile(local_pfn)
+            return S_OK()
+        with self.pendingDirMetaDataLock:
+            pending = self.pendingDirMetaData.setdefault(lpn, {'lfn': lfn, 'pfns': []})
+            pending['metaData'] = meta_dict
+            pending['pfns'].append(local_pfn)
+        return S_OK()
+
+
+    def flushDirMetaData(self):
+        """
+            flushDirMetaData
+            registers all the queued dir meta data, in bulk catalog calls, and removes the local meta data files
+            of the dirs for which it succeeded.
+            """
+        with self.pendingDirMetaDataLock:
+            pendingDirMetaData = self.pendingDirMetaData
+            self.pendingDirMetaData = {}
+        if not pendingDirMetaData:
+            return S_OK()
+
+        if len(pendingDirMetaData) == 1:
+            ### No need for a bulk call
+            lpn, pending = pendingDirMetaData.items()[0]
+            registered = [lpn] if self.registerDirMetaData(pending['lfn'], pending['metaData'])['OK'] else []
+        else:
+            registered = []
+            for lpnChunk in breakListIntoChunks(pendingDirMetaData.keys(), self.catalogChunkSize):
+                with self.metrics.timer('catalog_rpc_seconds', {'method': 'setMetadataBulk'}):
+                    res = self.fc.setMetadataBulk( dict( (lpn, pendingDirMetaData[lpn]['metaData']) for lpn in lpnChunk ) )
+                if not res['OK']:
+                    gLogger.error('Setting Meta Data on %s dirs failed with message (%s)' %(len(lpnChunk), res['Message']))
+                    continue
+                for lpn, error in res['Value']['Failed'].items():
+                    gLogger.error('Setting Meta Data on dir (%s) failed with message (%s)' %(lpn, error))
+                for lpn in res['Value']['Successful']:
+                    self.dirMetaDataCache.setRegistered(lpn, pendingDirMetaData[lpn]['metaData'])
+                    registered.append(lpn)
+            gLogger.info('Setting meta data succeeded on %s out of %s dirs' %(len(registered), len(pendingDirMetaData)))
+
+        ### Now that the meta data is in the catalog, the local meta data files can go
+        for lpn in registered:
+            for local_pfn in pendingDirMetaData[lpn]['pfns']:
+                self.removeLocalFile(local_pfn)
+        return S_OK( registered )
+
+
+    def submitReplicationRequests(self):
+        """ Submit to the RMS the replication to the secondary SEs of the files uploaded so far.
+            The files of the requests that failed are submitted again at the next call.
+            """
+        if not self.replicationRequests:
+            return
+        with self.metrics.timer('rms_submit_seconds'):
+            res = self.replicationRequests.flush()
+        submitted = res['Value']
+        if submitted['Requests'] or submitted['Failed']:
+            gLogger.info('%s replication requests submitted for %s files, %s files failed' %(submitted['Requests'], submitted['Files'], submitted['Failed']))
+        self.metrics.incr('replication_requests_total', submitted['Requests'])
+        self.metrics.incr('replication_files_total', submitted['Files'], {'status': 'OK'})
+        self.metrics.incr('replication_files_total', submitted['Failed'], {'status': 'Failed'})
+        self.metrics.setGauge('replication_pending_files', self.replicationRequests.getNumberOfPending())
+
+
+    def makeFileCopyQueue(self, filesToBeCopiedDict, toBeCopied):
         """
             makeFileCopyQueue
-            This method makes the multi-threaded queue from the files to be copied with max size specified as input.
-            It returns the queue and the list of lfns in the queue
+            This method feeds the multi-threaded queue with the files to be copied.
+            It blocks while the queue is full, i.e. until the worker threads catch up.
+            The files are queued largest first: the long transfers start early and the small files
+            fill the workers that become free, which keeps the end of the cycle short.
+            It returns the list of lfns put in the queue
             """
-        toBeCopied = Queue.Queue()
         lfn_list = []
-        ### Add it to the queue to be copied
+        archives = []
+        if self.aggregateSmallFiles:
+            filesToBeCopiedDict, archives = self.__aggregateSmallFiles(filesToBeCopiedDict)
+        fileSizes = {}
         for lfn, pfn in filesToBeCopiedDict.items():
-            
-            ### If size of queue is >= size provided then exit the for loop
-            if toBeCopied.qsize() >= size: break
+            try:
+                fileSizes[lfn] = os.path.getsize(pfn)
+            except OSError:
+                fileSizes[lfn] = 0
+        sortedLfns = sorted(filesToBeCopiedDict, key = lambda lfn: fileSizes[lfn], reverse = True)
+        ### The checksums are computed in the same order as the files are copied, so they are ready first
+        if self.checksumCache:
+            self.checksumCache.submit([filesToBeCopiedDict[lfn] for lfn in sortedLfns])
+        ### Add it to the queue to be copied
+        for lfn in sortedLfns:
+            pfn = filesToBeCopiedDict[lfn]
             
             gLogger.info('This local file (%s) will be transferred ' %pfn)
             ### If the file contains meta data then add that info in the queue
             if lfn.endswith('_meta.json'):
-                meta_python_dict = self.__getMetaData(pfn)
+                try:
+                    meta_python_dict = self.__getMetaData(pfn)
+                except (IOError, ValueError) as e:
+                    gLogger.error('Could not read meta data from file (%s) : %s' %(pfn, e))
+                    continue
                 meta_python_dict.update(self.extraMetadata)
-                toBeCopied.put( {'lfn': lfn, 'pfn': pfn, 'metaData': meta_python_dict} )
+                toBeCopied.put( {'lfn': lfn, 'pfn': pfn, 'size': fileSizes[lfn], 'metaData': meta_python_dict} )
                 lfn_list.append(lfn)
                 gLogger.debug('Meta Data is %s:' %meta_python_dict)
             else:
-                toBeCopied.put( {'lfn': lfn, 'pfn': pfn} )
+                toBeCopied.put( {'lfn': lfn, 'pfn': pfn, 'size': fileSizes[lfn]} )
                 lfn_list.append(lfn)
+        ### The archives of small files go last
+        for archive in archives:
+            gLogger.info('This archive (%s) of %s files will be transferred ' %(archive[ 'pfn' ], len(archive[ 'members' ])))
+            toBeCopied.put( archive )
+            lfn_list.append( archive[ 'lfn' ] )
+        self.metrics.setGauge('copy_queue_depth', toBeCopied.qsize())
 
-        return S_OK( (toBeCopied, lfn_list) )
+        return S_OK( lfn_list )
 
 
     def getFilesToBeCopied(self):
@@ -252,46 +637,60 @@ class Project8ThreadedDataReplicateAgent(AgentModule):
             This method gets all the files that need to be copied via dirac in one agent cycle.
             """
 
-        local_data_dirs = self.LocalDataDirPaths
-        filesToBeCopiedDict = {} ### A dict with LFN as the key and local-PFN as the value for files to be copied
-        ### Loop over all directories
-        for local_data_dir in local_data_dirs:
-            ### Make sure the agent does not copy more than specified files in one cycle. This is good for stopping agent cleanly if need be
-            if len(filesToBeCopiedDict) >= self.MaxFilesToTransferPerCycle: break
-            ### Do OS walk over local_data_dir (ROACH (.egg) or RSA (.MAT))
-            for currentdir, subdirs, filenames in os.walk(local_data_dir):
-                ### Make sure the agent does not copy more than specified files in one cycle. This is good for stopping agent cleanly if need be
-                if len(filesToBeCopiedDict) >= self.MaxFilesToTransferPerCycle: break
-                gLogger.debug('In dir: %s . It has these many files (%s)' % (currentdir, len(filenames)))
-                ### Sort file names
-                filenames.sort()
-                for filename in filenames:
-                    gLogger.debug('Found filename: %s' % filename)
-                    ### Make sure file ends in acceptable suffix.
-                    if not filename.endswith(tuple(self.acceptableFileSuffix)):
-                        ### Go to next file
-                        continue
-                    
-                    pfn = os.path.join(currentdir, filename)
-                    sub_lfn = pfn.split(local_data_dir)[-1].strip("/")
-                    lfn = os.path.join( self.SEDataDirPath, pfn.split(local_data_dir)[-1].strip("/") )
-                    gLogger.debug('pfn/sub_lfn/lfn: %s -- %s -- %s' % (pfn,sub_lfn,lfn))
-                    filesToBeCopiedDict[lfn] = pfn
-                    ### Make sure the agent does not copy more than specified files in one cycle. This is good for stopping agent cleanly if need be
-                    if len(filesToBeCopiedDict) >= self.MaxFilesToTransferPerCycle: break
+        ### The dirs whose disk is nearly full go first, and the agent polls more often meanwhile
+        pressuredRoots = self.__getPressuredRoots(self.LocalDataDirPaths)
+        self.__setPollingTime(bool(pressuredRoots))
 
+        ### Scan all the local dirs at the same time, then share the files of this cycle between them
+        candidatesByRoot = self.__scanRoots(self.LocalDataDirPaths, pressuredRoots)
+        if pressuredRoots:
+            ### All the files of the dirs under pressure, in the order they are drained
+            candidates = self.__prioritizeRoots(candidatesByRoot, pressuredRoots, self.MaxFilesToTransferPerCycle)
+        else:
+            candidates = self.__interleaveRoots(candidatesByRoot, self.MaxFilesToTransferPerCycle)
+        filesToBeCopiedDict = dict(candidates) ### A dict with LFN as the key and local-PFN as the value for files to be copied
+        ### More files may be waiting than one cycle takes, in watch mode they are only found by the next full scan
+        self.rescanDue = len(candidates) >= self.MaxFilesToTransferPerCycle
 
+        self.metrics.setGauge('last_cycle_candidate_files', len(filesToBeCopiedDict))
         ### Now We have a queue of files that need to be transferred (if not already transferred)
         gLogger.info('Potentially these many files will be copied in this cycle - %s' % len(filesToBeCopiedDict))
         if len(filesToBeCopiedDict) == 0:
             return S_OK( {} )
         
         ### Lets first check if the files are already in the DFC
-        res_FC = self.fc.getReplicas(filesToBeCopiedDict.keys())
+        if pressuredRoots:
+            ### The files already in the catalog are left out before taking the first MaxFilesToTransferPerCycle
+            res = self.__filterCataloguedInOrder(candidates, self.MaxFilesToTransferPerCycle)
+        else:
+            res = self.filterCataloguedFiles(filesToBeCopiedDict)
+        if not res['OK']:
+            return res
+        filesToBeCopiedDict = res['Value']
+
+        ### Make sure the agent does not copy more than specified bytes in one cycle, the rest waits for the next cycle
+        if self.MaxBytesToTransferPerCycle > 0:
+            budgetedDict = self.__applyByteBudget(filesToBeCopiedDict, self.MaxBytesToTransferPerCycle,
+                                                  [lfn for lfn, _pfn in candidates])
+            if len(budgetedDict) < len(filesToBeCopiedDict):
+                self.rescanDue = True
+            filesToBeCopiedDict = budgetedDict
+        
+        return S_OK( filesToBeCopiedDict )
+
+
+    def filterCataloguedFiles(self, filesToBeCopiedDict):
+        """
+            filterCataloguedFiles
+
+            This method checks which of the files (dict with LFN as key and local-PFN as value) are already in the catalog.
+            Those are verified on the SE and deleted locally (by the verify threads), the others are returned to be copied.
+            """
+        self.catalogLookupCache.purge()
+        res_FC = self.catalogLookupCache.getReplicas(self.fc, filesToBeCopiedDict.keys(), self.catalogChunkSize, self.metrics)
         if not res_FC['OK']:
-            msg = 'Could not query FC with getReplicas(). Message is : %s' %res_FC['Message']
-            gLogger.error(msg)
-            return S_ERROR(msg)
+            gLogger.error(res_FC['Message'])
+            return res_FC
         res_FC_Value = res_FC['Value']
         if 'Successful' in res_FC_Value and res_FC_Value['Successful']:
             ### This means that the files are already in the catalog (FC)
@@ -314,53 +713,692 @@ class Project8ThreadedDataReplicateAgent(AgentModule):
 
     # Private methods ............................................................
 
-    def _execute( self ):
+    def __filterCataloguedInOrder(self, candidates, maxFiles):
         """
-        Method run by the thread pool. It enters a loop until there are no files
-        on the queue. On each iteration, it copies and then removes the file.
-        If there are no more files in the queue, the loop is finished.
+            Check the candidates (list of (LFN, local-PFN)) against the catalog in their order, one chunk at a time,
+            until maxFiles of them are not in the catalog. Returns S_OK with a dict with LFN as key and local-PFN
+            as value of those files.
+            """
+        filesToBeCopiedDict = {}
+        for chunk in breakListIntoChunks(candidates, max(maxFiles, self.catalogChunkSize)):
+            res = self.filterCataloguedFiles(dict(chunk))
+            if not res['OK']:
+                return res
+            for lfn, pfn in chunk:
+                if len(filesToBeCopiedDict) >= maxFiles:
+                    break
+                if lfn in res['Value']:
+                    filesToBeCopiedDict[lfn] = pfn
+            if len(filesToBeCopiedDict) >= maxFiles:
+                break
+        return S_OK( filesToBeCopiedDict )
+
+
+    def __applyByteBudget(self, filesToBeCopiedDict, maxBytes, order = None):
         """
-    
-        while True:
-        
+            Keep the files (in the given order of LFNs, or in LFN order) until their total size reaches maxBytes.
+            The first file is always kept, even if it is larger than maxBytes on its own.
+            """
+        budgetedDict = {}
+        totalBytes = 0
+        if order is None:
+            order = sorted(filesToBeCopiedDict)
+        for lfn in order:
+            if lfn not in filesToBeCopiedDict:
+                continue
+            if budgetedDict and totalBytes >= maxBytes:
+                break
+            pfn = filesToBeCopiedDict[lfn]
+            try:
+                totalBytes += os.path.getsize(pfn)
+            except OSError as e:
+                gLogger.warn('Could not get size of file (%s): %s' %(pfn, e.strerror))
+                continue
+            budgetedDict[lfn] = pfn
+        gLogger.info('Byte budget: %s files (%s bytes) out of %s will be copied in this cycle'
+                     %(len(budgetedDict), totalBytes, len(filesToBeCopiedDict)))
+        return budgetedDict
+
+
+    def __copyFiles(self, filesToBeCopiedDict):
+        """
+            Copy the files (dict with LFN as key and local-PFN as value) with the copy threads
+            and block until all of them are processed.
+            """
+        res = self.__startCopyThreads( len(filesToBeCopiedDict) )
+        if not res[ 'OK' ]:
+            return res
+        numberOfWorkers = res[ 'Value' ]
+
+        try:
+            ### Feed the queue, this blocks while the queue is full
+            res_toBeCopied = self.makeFileCopyQueue(filesToBeCopiedDict, self.toBeCopied)
+            if not res_toBeCopied[ 'OK' ]:
+                gLogger.error( res_toBeCopied[ 'Message' ] )
+        finally:
+            self.__stopCopyThreads( numberOfWorkers )
+
+        return S_OK()
+
+
+    def __startCopyThreads(self, numberOfFiles):
+        """
+            Create the copy queue and start the copy threads (at most maxNumberOfThreads, and not more than numberOfFiles).
+            Returns S_OK with the number of started threads.
+            """
+        ### Bounded queue shared by all the workers. Each worker pulls the next file as soon as
+        ### it is done with the previous one, so no upload slot waits for the slowest file of a batch.
+        self.toBeCopied = Queue.Queue( self.copyQueueSize )
+        if self.concurrencyController:
+            self.concurrencyController.resetWindow()
+            gLogger.info( 'Adaptive upload concurrency: %s' %self.concurrencyController.getStatus() )
+        numberOfWorkers = 0
+        for _x in xrange( min( self.maxNumberOfThreads, numberOfFiles ) ):
+            jobUp = self.threadPool.generateJobAndQueueIt( self._execute )
+            if not jobUp[ 'OK' ]:
+                gLogger.error( jobUp[ 'Message' ] )
+                continue
+            numberOfWorkers += 1
+        if not numberOfWorkers:
+            return S_ERROR( 'Could not start any copy thread' )
+        return S_OK( numberOfWorkers )
+
+
+    def __stopCopyThreads(self, numberOfWorkers):
+        """
+            Tell the copy threads there are no more files and block until they are done with the queued ones.
+            """
+        ### One end marker per worker, each worker exits when it gets one
+        for _x in xrange( numberOfWorkers ):
+            self.toBeCopied.put( None )
+
+        gLogger.info( 'Blocking until all spawned threads (Num=%s) have finish copying.' %numberOfWorkers )
+        # block until all tasks are done
+        self.toBeCopied.join()
+        gLogger.info( 'All threads are done (Num=%s).' %numberOfWorkers )
+        if self.checksumCache:
+            self.checksumCache.clearPending()
+
+
+    def __scanRoots(self, local_data_dirs, pressuredRoots = None):
+        """
+            Scan the local dirs, each in its own thread, for at most ScanTimeout seconds.
+            The dirs under disk pressure are scanned entirely, the others up to MaxFilesToTransferPerCycle files.
+            Returns a dict with the local dir as key and the list of (LFN, local-PFN) found in it as value.
+            """
+        candidatesByRoot = {}
+        stopEvent = threading.Event()
+        for local_data_dir in local_data_dirs:
+            if self.localDataDirWeights.get(local_data_dir, 1.) <= 0:
+                continue
+            ### A scan of the previous cycle may still be stuck on this dir, do not pile up another one
+            previousThread = self.scanThreads.get(local_data_dir)
+            if previousThread and previousThread.is_alive():
+                gLogger.warn('The previous scan of %s is still running, skipping it in this cycle' %local_data_dir)
+                continue
+            candidatesByRoot[local_data_dir] = []
+            thread = threading.Thread(target = self.__scanRoot, name = 'Scan-%s' %local_data_dir,
+                                      args = (local_data_dir, candidatesByRoot[local_data_dir], stopEvent,
+                                              None if local_data_dir in (pressuredRoots or []) else self.MaxFilesToTransferPerCycle))
+            thread.daemon = True
+            thread.start()
+            self.scanThreads[local_data_dir] = thread
+
+        deadline = time.time() + self.scanTimeout if self.scanTimeout > 0 else None
+        for local_data_dir in candidatesByRoot:
+            thread = self.scanThreads[local_data_dir]
+            thread.join(max(deadline - time.time(), 0) if deadline else None)
+            if thread.is_alive():
+                gLogger.warn('Scan of %s did not finish within %s s, using the %s files found so far'
+                             %(local_data_dir, self.scanTimeout, len(candidatesByRoot[local_data_dir])))
+                self.metrics.incr('scan_timeouts_total', labels = {'root': local_data_dir})
+        ### The scans still running stop at their next file, what they found until now is used
+        stopEvent.set()
+        return dict((local_data_dir, list(candidates)) for local_data_dir, candidates in candidatesByRoot.items())
+
+
+    def __scanRoot(self, local_data_dir, candidates, stopEvent, maxFiles = None):
+        """
+            Scan thread of one local dir: append to candidates the (LFN, local-PFN) of the files to be copied,
+            at most maxFiles of them (None for all), until stopEvent is set.
+            """
+        ### Get the files found under local_data_dir (ROACH (.egg) or RSA (.MAT))
+        scanStartTime = time.time()
+        try:
+            if self.scanIndex:
+                pfns = self.__getIndexedFiles(local_data_dir)
+            else:
+                pfns = self.__walkFiles(local_data_dir)
+            for pfn in pfns:
+                if stopEvent.is_set():
+                    break
+                ### Skip the files that may still be being written
+                if self.minFileAge and not self.__isOldEnough(pfn):
+                    continue
+                ### Skip the files that failed recently (backing off) or too often (quarantined)
+                if self.retryJournal and not self.retryJournal.isDue(pfn):
+                    continue
+                ### Skip the files already on the SE, waiting to be removed
+                if self.deletionQueue.isPending(pfn):
+                    continue
+                sub_lfn = pfn.split(local_data_dir)[-1].strip("/")
+                lfn = os.path.join( self.SEDataDirPath, pfn.split(local_data_dir)[-1].strip("/") )
+                gLogger.debug('pfn/sub_lfn/lfn: %s -- %s -- %s' % (pfn,sub_lfn,lfn))
+                candidates.append( (lfn, pfn) )
+                ### No dir can provide more than the files of one cycle
+                if maxFiles and len(candidates) >= maxFiles: break
+        except Exception as e:
+            gLogger.exception('Unexpected error while scanning %s' %local_data_dir, lException = e)
+        self.metrics.observe('scan_duration_seconds', time.time() - scanStartTime, {'root': local_data_dir})
+
+
+    def __interleaveRoots(self, candidatesByRoot, maxFiles):
+        """
+            Merge the candidates of the local dirs into one list of at most maxFiles (LFN, local-PFN),
+            taking from each dir in proportion to its weight (smooth weighted round robin).
+            The files a dir can not provide are taken from the others.
+            """
+        queues = dict((local_data_dir, list(reversed(candidates))) for local_data_dir, candidates in candidatesByRoot.items() if candidates)
+        weights = dict((local_data_dir, self.localDataDirWeights.get(local_data_dir, 1.)) for local_data_dir in queues)
+        current = dict((local_data_dir, 0.) for local_data_dir in queues)
+        counts = dict((local_data_dir, 0) for local_data_dir in candidatesByRoot)
+        merged = []
+        seen = set()
+        while queues and len(merged) < maxFiles:
+            totalWeight = sum(weights[local_data_dir] for local_data_dir in queues)
+            for local_data_dir in queues:
+                current[local_data_dir] += weights[local_data_dir]
+            chosen = max(sorted(queues), key = lambda local_data_dir: current[local_data_dir])
+            current[chosen] -= totalWeight
+            lfn, pfn = queues[chosen].pop()
+            if not queues[chosen]:
+                del queues[chosen]
+            ### Nested local dirs may find the same file
+            if lfn in seen:
+                continue
+            seen.add(lfn)
+            merged.append( (lfn, pfn) )
+            counts[chosen] += 1
+        for local_data_dir, count in counts.items():
+            self.metrics.setGauge('last_cycle_candidate_files_per_root', count, {'root': local_data_dir})
+        return merged
+
+
+    def __isRescanDue(self):
+        """
+            True if the last full scan left files for later (MaxFilesToTransferPerCycle or MaxBytesToTransferPerCycle
+            reached, catalog lookup failed, recent files found in a new dir), or failed files are due for a retry:
+            inotify does not report them again.
+            """
+        if self.rescanDue:
+            return True
+        return bool(self.retryJournal) and self.retryJournal.hasDue()
+
+
+    def __getPressuredRoots(self, local_data_dirs):
+        """
+            The local dirs whose file system is at least HighWatermark full (statvfs), fullest first
+            """
+        usedFractions = {}
+        for local_data_dir in local_data_dirs:
+            try:
+                st = os.statvfs(local_data_dir)
+            except OSError as e:
+                gLogger.warn('Could not get the disk usage of %s: %s' %(local_data_dir, e.strerror))
+                continue
+            if not st.f_blocks:
+                continue
+            usedFractions[local_data_dir] = 1. - float(st.f_bavail) / st.f_blocks
+            self.metrics.setGauge('disk_used_fraction', usedFractions[local_data_dir], {'root': local_data_dir})
+        pressuredRoots = []
+        if self.highWatermark > 0:
+            pressuredRoots = [local_data_dir for local_data_dir in usedFractions if usedFractions[local_data_dir] >= self.highWatermark]
+            pressuredRoots.sort(key = lambda local_data_dir: usedFractions[local_data_dir], reverse = True)
+        for local_data_dir in local_data_dirs:
+            self.metrics.setGauge('disk_pressure', int(local_data_dir in pressuredRoots), {'root': local_data_dir})
+        for local_data_dir in pressuredRoots:
+            gLogger.warn('Disk of %s is %.1f%% full (high watermark %.1f%%), draining it first'
+                         %(local_data_dir, 100 * usedFractions[local_data_dir], 100 * self.highWatermark))
+        return pressuredRoots
+
+
+    def __setPollingTime(self, underPressure):
+        """
+            Poll every PressurePollingTime seconds while a disk is under pressure, at the usual rate otherwise
+            """
+        pollingTime = self.normalPollingTime
+        if underPressure and self.pressurePollingTime > 0:
+            pollingTime = min(self.pressurePollingTime, self.normalPollingTime or self.pressurePollingTime)
+        if pollingTime and pollingTime != self.am_getPollingTime():
+            gLogger.info('Polling time set to %s s' %pollingTime)
+            self.am_setModuleParam('pollingTime', pollingTime)
+
+
+    def __prioritizeRoots(self, candidatesByRoot, pressuredRoots, maxFiles):
+        """
+            Merge the candidates of the local dirs into one list of (LFN, local-PFN): all the files of the dirs
+            under pressure first, fullest dir first and in PressureOrder within a dir, then at most maxFiles
+            files of the other dirs as usual.
+            """
+        merged = []
+        seen = set()
+        for local_data_dir in pressuredRoots:
+            candidates = []
+            for lfn, pfn in candidatesByRoot.get(local_data_dir, []):
+                ### Stat the file now: the scan index keeps the size and mtime a file had when it was found,
+                ### which are out of date for a file that was still being written
+                try:
+                    st = os.stat(pfn)
+                except OSError:
+                    continue
+                ### Largest first, or oldest first
+                key = -st.st_size if self.pressureOrder == 'size' else st.st_mtime
+                candidates.append( (key, lfn, pfn) )
+            candidates.sort()
+            count = 0
+            for _key, lfn, pfn in candidates:
+                if lfn in seen:
+                    continue
+                seen.add(lfn)
+                merged.append( (lfn, pfn) )
+                count += 1
+            self.metrics.setGauge('last_cycle_candidate_files_per_root', count, {'root': local_data_dir})
+        otherRoots = dict((local_data_dir, candidates) for local_data_dir, candidates in candidatesByRoot.items()
+                          if local_data_dir not in pressuredRoots)
+        if otherRoots:
+            for lfn, pfn in self.__interleaveRoots(otherRoots, maxFiles):
+                if lfn not in seen:
+                    seen.add(lfn)
+                    merged.append( (lfn, pfn) )
+        return merged
+
+
+    def __aggregateSmallFiles(self, filesToBeCopiedDict):
+        """
+            Pack the small side files (AggregateSuffixes, at most AggregateMaxFileSize bytes) of each dir into a tar archive,
+            when a dir has at least AggregateMinFiles of them.
+            Returns the dict of the files still to be copied one by one, and the list of archives to be copied
+            (queue items with the members and the meta data of the _meta.json members).
+            """
+        smallFilesByDir = {}
+        for lfn, pfn in filesToBeCopiedDict.items():
+            if not pfn.endswith(self.aggregateSuffixes):
+                continue
+            try:
+                if os.path.getsize(pfn) > self.aggregateMaxFileSize:
+                    continue
+            except OSError:
+                continue
+            smallFilesByDir.setdefault(os.path.dirname(pfn), []).append(lfn)
+
+        remainingDict = dict(filesToBeCopiedDict)
+        archives = []
+        if smallFilesByDir and not os.path.isdir(self.aggregationDir):
             try:
-                file = self.toBeCopied.get_nowait()
-            except Queue.Empty:
-                return S_OK()
-                    
-            gLogger.verbose( '%s - %s being processed' % ( file[ 'lfn' ], file[ 'pfn' ] ) )
-
-            ### Upload file to SE and register it in DIRAC
-            dirac = Dirac()
-            initialTime = time.time()
-            uploadStatus = dirac.addFile(file[ 'lfn' ], file[ 'pfn' ], self.CopyToSE)
+                os.makedirs(self.aggregationDir)
+            except OSError as e:
+                ### Unless it was created meanwhile, the small files are copied one by one in this cycle
+                if not os.path.isdir(self.aggregationDir):
+                    gLogger.error('Could not create the aggregation dir %s, no aggregation in this cycle: %s' %(self.aggregationDir, e))
+                    return remainingDict, archives
+        for currentdir, lfns in smallFilesByDir.items():
+            if len(lfns) < self.aggregateMinFiles:
+                continue
+            lfns.sort()
+            pfns = [filesToBeCopiedDict[lfn] for lfn in lfns]
+            memberMetaData = {}
+            for lfn, pfn in zip(lfns, pfns):
+                if lfn.endswith('_meta.json'):
+                    try:
+                        meta_python_dict = self.__getMetaData(pfn)
+                    except (IOError, ValueError) as e:
+                        gLogger.error('Could not read meta data from file (%s) : %s' %(pfn, e))
+                        continue
+                    meta_python_dict.update(self.extraMetadata)
+                    memberMetaData[pfn] = meta_python_dict
+            archiveName = '%s_sidecars_%s.tar' %(os.path.basename(currentdir), datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f'))
+            archivePath = os.path.join(self.aggregationDir, archiveName)
+            res = buildArchive(archivePath, pfns)
+            if not res['OK']:
+                gLogger.error(res['Message'])
+                continue
+            archives.append( {'lfn': os.path.join(os.path.dirname(lfns[0]), archiveName), 'pfn': archivePath,
+                              'size': os.path.getsize(archivePath), 'members': pfns, 'memberMetaData': memberMetaData} )
+            for lfn in lfns:
+                del remainingDict[lfn]
+        if archives:
+            gLogger.info('Packed %s small files into %s archives' %(len(filesToBeCopiedDict) - len(remainingDict), len(archives)))
+            self.metrics.incr('aggregated_files_total', len(filesToBeCopiedDict) - len(remainingDict))
+        return remainingDict, archives
+
+
+    def __isOldEnough(self, pfn):
+        """
+            True if the file was last modified at least MinFileAge seconds ago
+            """
+        try:
+            return time.time() - os.path.getmtime(pfn) >= self.minFileAge
+        except OSError:
+            return False
+
+
+    def __walkFiles(self, local_data_dir):
+        """
+            Generator over the local files with an acceptable suffix, found by a full OS walk over local_data_dir
+            """
+        for currentdir, subdirs, filenames in os.walk(local_data_dir):
+            gLogger.debug('In dir: %s . It has these many files (%s)' % (currentdir, len(filenames)))
+            ### Sort file names
+            filenames.sort()
+            for filename in filenames:
+                gLogger.debug('Found filename: %s' % filename)
+                ### Make sure file ends in acceptable suffix.
+                if not filename.endswith(tuple(self.acceptableFileSuffix)):
+                    ### Go to next file
+                    continue
+                yield os.path.join(currentdir, filename)
+
+
+    def __getIndexedFiles(self, local_data_dir):
+        """
+            Generator over the local files with an acceptable suffix, as found in the scan index.
+            Only the dirs that changed since the previous cycle are listed again.
+            """
+        initialTime = time.time()
+        self.scanIndex.update(local_data_dir)
+        gLogger.info('Scan index update of %s took %s s' % (local_data_dir, round(time.time() - initialTime, 2)))
+        for pfn, _size, _mtime in self.scanIndex.getFiles(local_data_dir):
+            ### Make sure file ends in acceptable suffix.
+            if pfn.endswith(tuple(self.acceptableFileSuffix)):
+                yield pfn
+
+
+    def _execute( self ):
+        """
+        Method run by the thread pool. It pulls files from the queue until it gets the end marker (None),
+        and copies and then removes each of them.
+        """
+        def copyFile( file ):
+            self.metrics.setGauge('copy_queue_depth', self.toBeCopied.qsize())
+            self.__copyFile( file )
+        return processQueue( self.toBeCopied, copyFile, lambda file: 'copy of file (%s)' %file[ 'lfn' ] )
+
+
+    def __copyFile( self, file ):
+        """
+        Upload a single file to the SE, register its meta data if any, and remove the local copy.
+        """
+        gLogger.verbose( '%s - %s being processed' % ( file[ 'lfn' ], file[ 'pfn' ] ) )
+
+        ### Precomputed checksum, if any (waited for before taking an upload slot, if its computation started)
+        checksum = None
+        if self.checksumCache:
+            with self.metrics.timer('checksum_wait_seconds'):
+                checksum = self.checksumCache.getChecksum( file[ 'pfn' ], self.checksumTimeout, startedOnly = True )
+
+        ### Wait for the upload rate limit, if any
+        if self.bandwidthLimiter:
+            waitTime = self.bandwidthLimiter.acquire( self.CopyToSE, file.get( 'size', 0 ) )
+            self.metrics.observe( 'throttle_wait_seconds', waitTime )
+
+        ### Upload file to SE and register it in DIRAC
+        if self.concurrencyController:
+            self.concurrencyController.acquire()
+        initialTime = time.time()
+        uploadStatus = S_ERROR( 'Upload interrupted' )
+        try:
+            uploadStatus = self.__uploadFile(file[ 'lfn' ], file[ 'pfn' ], checksum)
+        finally:
             elapsedTime = time.time() - initialTime
-            
-            if uploadStatus['OK']:
-                gLogger.info('File {} upload took {} s. Now deleting local file.'.format(file[ 'lfn' ], round(elapsedTime,2)))
-                
-                ### If file has metadata then register it in the respective dir.
-                ### It is safe to re-register the meta data
-                if 'metaData' in file :
-                    # register this metadata
-                    if file['metaData']:
-                        res = self.registerDirMetaData(file[ 'lfn' ], file['metaData'])
-                        if not res['OK']:
-                            ### If registering meta data failed, then finish the thread gracefully and go to next thread
-                            self.toBeCopied.task_done()
-                            continue
-
-                    else:
-                        gLogger.error('Meta Data for this dir (%s) was not found.' %(lpn))
-            
-                ### Now remove the file
-                self.removeLocalFile(file[ 'pfn' ])
-                    
+            ### Even a failed attempt may have registered the file (e.g. the addFile of a large file), look it up again
+            self.catalogLookupCache.invalidate( [ file[ 'lfn' ] ] )
+            if self.concurrencyController:
+                self.concurrencyController.release( file.get( 'size', 0 ), elapsedTime, uploadStatus[ 'OK' ] )
+            if self.bandwidthLimiter:
+                self.bandwidthLimiter.release( self.CopyToSE )
+            self.metrics.observe('upload_duration_seconds', elapsedTime)
+            self.metrics.incr('uploaded_files_total', labels={'status': 'OK' if uploadStatus[ 'OK' ] else 'Failed'})
+        
+        ### The local files of this upload (the members for an archive)
+        local_pfns = file.get( 'members', [ file[ 'pfn' ] ] )
+        if not uploadStatus['OK']:
+            gLogger.error('Failed to upload file (%s). Message is (%s)' %(file[ 'lfn' ], uploadStatus['Message']))
+            if self.retryJournal:
+                for local_pfn in local_pfns:
+                    self.retryJournal.recordFailure( local_pfn, uploadStatus['Message'] )
+            if 'members' in file:
+                ### The members stay on disk and are packed again in a later cycle
+                removeArchive(file[ 'pfn' ])
+            return
+
+        gLogger.info('File {} upload took {} s. Now deleting local file.'.format(file[ 'lfn' ], round(elapsedTime,2)))
+        if self.retryJournal:
+            for local_pfn in local_pfns:
+                self.retryJournal.forget( local_pfn )
+        self.metrics.incr('uploaded_bytes_total', file.get( 'size', 0 ))
+        if elapsedTime > 0:
+            self.metrics.observe('upload_rate_bytes_per_second', file.get( 'size', 0 ) / elapsedTime, buckets=RATE_BUCKETS)
+        ### Replicas on the secondary SEs of this data type, if any, are requested at the end of the cycle
+        if self.replicationRequests:
+            self.replicationRequests.add( file[ 'lfn' ], file.get( 'size', 0 ), checksum )
+        
+        ### Archive of small files: the archive and its members go, the _meta.json members once their meta data is registered
+        if 'members' in file:
+            removeArchive(file[ 'pfn' ])
+            for member_pfn in file[ 'members' ]:
+                if member_pfn in file[ 'memberMetaData' ]:
+                    self.queueDirMetaData(file[ 'lfn' ], file[ 'memberMetaData' ][ member_pfn ], member_pfn)
+                else:
+                    self.removeLocalFile(member_pfn)
+            return
+
+        ### If file has metadata then register it in the respective dir.
+        ### It is safe to re-register the meta data
+        if 'metaData' in file :
+            # register this metadata (in bulk at the end of the cycle), the local file is removed once it is registered
+            if file['metaData']:
+                self.queueDirMetaData(file[ 'lfn' ], file['metaData'], file[ 'pfn' ])
+                return
             else:
-                gLogger.error('Failed to upload file (%s). Message is (%s)' %(file[ 'lfn' ], uploadStatus['Message']))
+                gLogger.error('Meta Data for this file (%s) was not found.' %file[ 'lfn' ])
+    
+        ### Now remove the file
+        self.removeLocalFile(file[ 'pfn' ])
+
+
+    def __waitForVerification( self ):
+        """
+        Block until the verify threads have processed all the files of this cycle
+        """
+        if not self.toBeVerified:
+            return
+        gLogger.info( 'Blocking until all verify threads have finished.' )
+        while self.toBeVerified:
+            self.toBeVerified.pop( 0 ).join()
+
+
+    def _verify( self, toBeVerified ):
+        """
+        Method run by the verify thread pool. It pulls files from the given verify queue
+        until it gets the end marker (None).
+        """
+        def verifyFile( file ):
+            self.metrics.setGauge('verify_queue_depth', toBeVerified.qsize())
+            self.__verifyFile( file )
+        return processQueue( toBeVerified, verifyFile, lambda file: 'verification of file (%s)' %file[ 'lfn' ] )
+
+
+    def __verifyFile( self, file ):
+        """
+        Check that the replica of an already registered file is on CopyToSE and, if so, delete the local copy.
+        """
+        lfn = file[ 'lfn' ]
+        pfn = file[ 'replicas' ].get( self.CopyToSE )
+        if not pfn:
+            gLogger.warn('File (%s) is in the catalog but not on the SE (%s). Keeping the local copy.' %(lfn, self.CopyToSE))
+            return
+
+        try:
+            with self.metrics.timer('verify_duration_seconds'):
+                stat_values = self.__getWorkerGfal2Context().stat(pfn)
+            if self.verifyChecksum and not self.__isSameFile(lfn, file[ 'pfn' ], stat_values.st_size):
+                self.metrics.incr('verified_files_total', labels={'status': 'Mismatch'})
+                return
+            self.metrics.incr('verified_files_total', labels={'status': 'OK'})
+            gLogger.info('File (%s) was found on the SE (%s). Now deleting it locally.' %(lfn, self.CopyToSE))
+            if lfn.endswith('_meta.json'):
+                ### Make sure the parent dir has metaData set, the local file is removed once it is
+                meta_python_dict = self.__getMetaData(file[ 'pfn' ])
+                meta_python_dict.update(self.extraMetadata)
+                self.queueDirMetaData(lfn, meta_python_dict, file[ 'pfn' ])
+                return
+            ###
+            self.removeLocalFile(file[ 'pfn' ]) ### Need local PFN as well.
+            
+        except Exception, err:
+            self.metrics.incr('verified_files_total', labels={'status': 'Failed'})
+            msg = 'gfal API to query stat failed on PFN (%s) with output as %s' % (pfn, err)
+            gLogger.error(msg)
+
+
+    def __isSameFile( self, lfn, local_pfn, replicaSize ):
+        """
+        Compare the local file with the replica size and with the size and checksum in the catalog.
+        The local checksum comes from the checksum cache when it is there.
+        """
+        localSize = os.path.getsize(local_pfn)
+        if replicaSize != localSize:
+            gLogger.error('File (%s) has size %s on the SE and %s locally. Keeping the local copy.' %(lfn, replicaSize, localSize))
+            return False
+        with self.metrics.timer('catalog_rpc_seconds', {'method': 'getFileMetadata'}):
+            res = self.fc.getFileMetadata(lfn)
+        if not res['OK'] or lfn not in res['Value']['Successful']:
+            gLogger.error('Could not get the catalog meta data of file (%s). Keeping the local copy.' %lfn)
+            return False
+        catalogMetadata = res['Value']['Successful'][lfn]
+        if catalogMetadata.get('Size') is not None and int(catalogMetadata['Size']) != localSize:
+            gLogger.error('File (%s) has size %s in the catalog and %s locally. Keeping the local copy.' %(lfn, catalogMetadata['Size'], localSize))
+            return False
+        if not catalogMetadata.get('Checksum'):
+            return True
+        if self.checksumCache:
+            localChecksum = self.checksumCache.getChecksum(local_pfn, compute = True)
+        else:
+            localChecksum = adler32(local_pfn)
+        if not localChecksum or int(localChecksum, 16) != int(catalogMetadata['Checksum'], 16):
+            gLogger.error('File (%s) has checksum %s in the catalog and %s locally. Keeping the local copy.' %(lfn, catalogMetadata['Checksum'], localChecksum))
+            return False
+        return True
+
+
+    def __getWorkerGfal2Context( self ):
+        """
+        Return the gfal2 context of the current (verify or copy) thread, it is kept across files and cycles
+        """
+        context = getattr( self.workerClients, 'gfal2Context', None )
+        if context is None:
+            context = gfal2.creat_context()
+            self.workerClients.gfal2Context = context
+        return context
+
+
+    def __uploadFile( self, lfn, pfn, checksum = None ):
+        """
+        Upload (put and register) a file to CopyToSE with the DataManager of the current worker thread.
+        If the checksum is not given, the DataManager computes it.
+        Returns S_OK or S_ERROR, also when the file is reported in the 'Failed' dict.
+        """
+        if self.largeFileThreshold > 0:
+            size = os.path.getsize( pfn )
+            if size >= self.largeFileThreshold:
+                url = self.__getLargeFileURL( lfn )
+                if url:
+                    return self.__uploadLargeFile( lfn, pfn, url, size, checksum )
+        dataManager = self.__getWorkerDataManager()
+        res = dataManager.putAndRegister( lfn, pfn, self.CopyToSE, checksum = checksum )
+        if res[ 'OK' ] and lfn in res[ 'Value' ].get( 'Failed', {} ):
+            res = S_ERROR( str( res[ 'Value' ][ 'Failed' ][ lfn ] ) )
+        if not res[ 'OK' ]:
+            ### Do not trust this client any more, the next file gets a fresh one
+            self.workerClients.dataManager = None
+        return res
+
+
+    def __getLargeFileURL( self, lfn ):
+        """
+        URL of lfn on CopyToSE for the first of LargeFileProtocols it supports, None if there is none
+        (e.g. a DIPS SE): the file is then uploaded with putAndRegister.
+        """
+        se = getattr( self.workerClients, 'storageElement', None )
+        if se is None:
+            se = StorageElement( self.CopyToSE )
+            self.workerClients.storageElement = se
+        res = se.getURL( lfn, protocol = self.largeFileProtocols )
+        if res[ 'OK' ] and lfn in res[ 'Value' ][ 'Successful' ]:
+            return res[ 'Value' ][ 'Successful' ][ lfn ]
+        error = res[ 'Message' ] if not res[ 'OK' ] else res[ 'Value' ][ 'Failed' ].get( lfn )
+        gLogger.warn( 'No %s URL of (%s) on %s (%s), uploading it with putAndRegister'
+                      %( '/'.join( self.largeFileProtocols ), lfn, self.CopyToSE, error ) )
+        return None
+
+
+    def __uploadLargeFile( self, lfn, pfn, url, size, checksum = None ):
+        """
+        Copy a large file to url on CopyToSE with gfal2 (LargeFileStreams parallel streams, retried up to
+        LargeFileRetries times) and register it in the catalog. Returns S_OK or S_ERROR.
+        """
+        if not checksum:
+            checksum = self.checksumCache.getChecksum( pfn, compute = True ) if self.checksumCache else adler32( pfn )
+
+        context = self.__getWorkerGfal2Context()
+        params = context.transfer_parameters()
+        params.nbstreams = self.largeFileStreams
+        ### A failed attempt may leave a partial file behind
+        params.overwrite = True
+        params.create_parent = True
+        if self.largeFileTimeout:
+            params.timeout = self.largeFileTimeout
+        if checksum:
+            params.checksum_check = True
+            params.set_user_defined_checksum( 'ADLER32', checksum )
+
+        for attempt in xrange( 1, self.largeFileRetries + 2 ):
+            try:
+                context.filecopy( params, 'file://' + os.path.abspath( pfn ), url )
+                break
+            except Exception as e:
+                gLogger.warn( 'gfal2 copy of (%s) to (%s) failed (attempt %s): %s' %( pfn, url, attempt, e ) )
+                self.metrics.incr( 'large_file_copy_retries_total' )
+                if attempt > self.largeFileRetries:
+                    return S_ERROR( 'gfal2 copy of %s failed after %s attempts: %s' %( pfn, attempt, e ) )
+                time.sleep( self.largeFileRetryDelay )
 
-            # Used together with join !
-            self.toBeCopied.task_done()
+        fileDict = { lfn: { 'PFN': url, 'Size': size, 'SE': self.CopyToSE, 'GUID': makeGuid( pfn ), 'Checksum': checksum } }
+        with self.metrics.timer( 'catalog_rpc_seconds', { 'method': 'addFile' } ):
+            res = self.fc.addFile( fileDict )
+        if res[ 'OK' ] and lfn in res[ 'Value' ][ 'Failed' ]:
+            res = S_ERROR( str( res[ 'Value' ][ 'Failed' ][ lfn ] ) )
+        if not res[ 'OK' ]:
+            ### The copy is on the SE but not registered: it is copied again (overwritten) in a later cycle
+            return S_ERROR( 'Could not register %s after copying it to %s: %s' %( lfn, url, res[ 'Message' ] ) )
+        gLogger.info( 'Large file (%s) copied with %s streams and registered' %( lfn, self.largeFileStreams ) )
+        return S_OK( { 'Successful': { lfn: url }, 'Failed': {} } )
+
+
+    def __getWorkerDataManager( self ):
+        """
+        Return the DataManager of the current worker thread, creating a new one if there is none yet
+        or if the current one has been used too many times or for too long.
+        """
+        client = getattr( self.workerClients, 'dataManager', None )
+        if client and ( client[ 'Uses' ] >= self.clientMaxUses or time.time() - client[ 'Created' ] > self.clientMaxAge ):
+            gLogger.verbose( 'Recycling DataManager after %s uploads' %client[ 'Uses' ] )
+            client = None
+        if not client:
+            client = { 'DataManager': DataManager(), 'Created': time.time(), 'Uses': 0 }
+            self.workerClients.dataManager = client
+        client[ 'Uses' ] += 1
+        return client[ 'DataManager' ]
 
     #...............................................................................
     #EOF
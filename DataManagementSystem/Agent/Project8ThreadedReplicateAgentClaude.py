@@ -20,12 +20,15 @@ import os
 import urllib
 import time
 import json
+import Queue
+import threading
 import os.path as path
 from multiprocessing import Process
 from pprint import pprint
 
 from DIRAC import S_OK, S_ERROR
 from DIRAC.Core.Base.AgentModule import AgentModule
+from DIRAC.Core.Utilities.ThreadPool import ThreadPool
 
 # Copy from dirac script
 from DIRAC import gConfig, gLogger
@@ -36,6 +39,11 @@ from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
 from DIRAC.Interfaces.API.Dirac import Dirac
 from DIRAC.Interfaces.API.Job import Job
 
+from Project8DIRAC.DataManagementSystem.Client.AgentUtilities import dumpMetrics, makeDeletionQueue, processQueue
+from Project8DIRAC.DataManagementSystem.Client.CatalogUtilities import getReplicasInChunks
+from Project8DIRAC.DataManagementSystem.Client.MetadataTagQueue import MetadataTagQueue
+from Project8DIRAC.DataManagementSystem.Client.TransferMetrics import TransferMetrics
+
 
 __RCSID__ = ' '
 
@@ -61,6 +69,25 @@ class Project8ThreadedReplicateAgentClaude(AgentModule):
         self.DIRACCfgSEPath = 'Resources/StorageElements'
         self.dryRun = bool(self.am_getOption("DryRun",True))
         self.fc = FileCatalogClient()
+        ### Number of lfns per bulk catalog query
+        self.catalogChunkSize = int(self.am_getOption("CatalogChunkSize", 1000))
+        ### Uploads run in-process on a pool of maxNumberOfThreads threads, each with its own DataManager and catalog client
+        self.maxNumberOfThreads = int(self.am_getOption("maxNumberOfThreads", 5))
+        self.threadPool = ThreadPool(self.maxNumberOfThreads, self.maxNumberOfThreads)
+        self.workerClients = threading.local()
+        self.toBeUploaded = None
+        ### The DataFlavor tags of the uploaded files are set in bulk, once TagFlushSize of them are queued or the oldest
+        ### one waited TagFlushInterval seconds, and at the end of the cycle. The queue is persistent: the tags that
+        ### could not be set are retried in the next cycles, without uploading the files again.
+        self.tagQueue = MetadataTagQueue(self.am_getOption("TagQueueFile", os.path.join(self.am_getWorkDirectory(), 'MetadataTagQueue.db')),
+                                         int(self.am_getOption("TagFlushSize", 500)),
+                                         int(self.am_getOption("TagFlushInterval", 60)))
+        ### Metrics, written to MetricsDir at the end of every cycle (empty MetricsDir to disable)
+        self.metrics = TransferMetrics('project8_claude_replicate')
+        self.metricsDir = self.am_getOption("MetricsDir", self.am_getWorkDirectory())
+        self.metricsFormats = self.am_getOption("MetricsFormats", ['prometheus', 'json'])
+        ### The local files are removed in the background, see makeDeletionQueue for the options
+        self.deletionQueue = makeDeletionQueue(self, self.metrics)
         
         gLogger.info("DryRun: " + str(self.dryRun) )
         gLogger.info("CopyToSE: " + str(self.CopyToSE) )
@@ -75,56 +102,106 @@ class Project8ThreadedReplicateAgentClaude(AgentModule):
 
     
     def _uploadFile(self, dest_se, pfn, lfn, calib_dir):
-        """ Private method to upload and register file
+        """ Private method to upload and register file, with the DataManager of the current thread
             """
-        cmd = 'dirac-dms-add-file -o /Resources/Sites/Test=true '
-        cmd += lfn + ' '
-        cmd += pfn + ' '
-        cmd += dest_se
-        gLogger.info(cmd)
+        if self.dryRun:
+            gLogger.info('DryRun: would upload (%s) to (%s) as (%s) and tag it with DataFlavor %s' %(pfn, dest_se, lfn, calib_dir))
+            return S_OK()
         initialTime = time.time()
-        status, output = commands.getstatusoutput(cmd)
+        res = self.__getWorkerClient('DataManager', DataManager).putAndRegister(lfn, pfn, dest_se)
+        if res['OK'] and lfn in res['Value'].get('Failed', {}):
+            res = S_ERROR(str(res['Value']['Failed'][lfn]))
         elapsedTime = time.time() - initialTime
-        if status==0:
-            gLogger.info('Upload successful in {} s.'.format(elapsedTime))
+        self.metrics.observe('upload_duration_seconds', elapsedTime)
+        self.metrics.incr('uploaded_files_total', labels={'status': 'OK' if res['OK'] else 'Failed'})
+        if res['OK']:
+            gLogger.info('Upload of (%s) successful in %s s.' %(lfn, round(elapsedTime, 2)))
 
             ## 20190416 - new code added by Brent to tag metadata at the file level: DataFlavor : [esr,rf_bkgd]
-            # tag with metadata
+            # tag with metadata, set in bulk with the tags of the other files
             meta_dict = {'DataFlavor' : calib_dir}
-            res = self.fc.setMetadata(lfn, meta_dict)
-            if not res['OK']:
-                gLogger.error('Setting Metadata on (%s) failed with message (%s)' %(lfn, res['Message']))
-            else:
-                gLogger.info('Setting meta data on lfn (%s) succeeded' %lfn)
+            self.tagQueue.add(lfn, meta_dict)
+            if self.tagQueue.isDue():
+                self.__flushTags(wait = False)
                 
         else:
-            gLogger.error('Failed to upload file (%s). Status returned (%s) and error returned (%s)' %( lfn, status, output) )
+            gLogger.error('Failed to upload file (%s). Message is (%s)' %( lfn, res['Message']) )
+            ### Do not trust this client any more, the next file gets a fresh one
+            setattr(self.workerClients, 'DataManager', None)
+
+        return res
+
+
+    def _execute(self):
+        """ Method run by the thread pool. It uploads the files pulled from the queue
+            until it gets the end marker (None).
+            """
+        return processQueue(self.toBeUploaded, lambda task: self._uploadFile(*task), lambda task: 'upload of file (%s)' %task[2])
+
 
-        return status
+    def __flushTags(self, wait = True):
+        """ Set the queued file level tags with bulk catalog calls, with the catalog client of the current thread.
+            With wait False, nothing is done if another thread is already setting them.
+            """
+        res = self.tagQueue.flush(self.__getWorkerClient('FileCatalogClient', FileCatalogClient), self.catalogChunkSize, self.metrics, wait)
+        self.metrics.incr('tagged_files_total', len(res['Value']['Successful']), {'status': 'OK'})
+        self.metrics.incr('tagged_files_total', len(res['Value']['Failed']), {'status': 'Failed'})
+        self.metrics.setGauge('pending_tags', self.tagQueue.getNumberOfPending())
+        return res
+
+
+    def __getWorkerClient(self, name, clientClass):
+        """ The client of the current thread, created on first use
+            """
+        client = getattr(self.workerClients, name, None)
+        if client is None:
+            client = clientClass()
+            setattr(self.workerClients, name, client)
+        return client
 
 
-    def __checkAndRemoveFileOnSE(self, lfn, pfn, dest_se):
-        """ Check if a given lfn exist. And if it does remove it physically from the SE
-            Output: Return True if file exist and was failed to be removed
-            Return False if file was not found or was found but removed.
+    def __startUploadThreads(self):
+        """ Create the (bounded) upload queue and start the upload threads.
+            Returns the number of started threads.
+            """
+        self.toBeUploaded = Queue.Queue(2 * self.maxNumberOfThreads)
+        numberOfWorkers = 0
+        for _x in xrange(self.maxNumberOfThreads):
+            jobUp = self.threadPool.generateJobAndQueueIt(self._execute)
+            if not jobUp['OK']:
+                gLogger.error(jobUp['Message'])
+                continue
+            numberOfWorkers += 1
+        return numberOfWorkers
+
+
+    def __stopUploadThreads(self, numberOfWorkers):
+        """ Tell the upload threads there are no more files and block until they are done
+            """
+        for _x in xrange(numberOfWorkers):
+            self.toBeUploaded.put(None)
+        self.toBeUploaded.join()
+        gLogger.info('All upload threads are done (Num=%s).' %numberOfWorkers)
+
+
+    def __checkAndRemoveFileOnSE(self, lfn, pfn, dest_se, replicasDict):
+        """ Check if a given lfn exist (as found by the bulk catalog query in replicasDict).
+            And if it does remove it physically from the local disk
+            Output: Return True if file exist and can not be removed
+            Return False if file was not found or was found and queued for removal.
             """
         ### Check if file already exists ###
-        cmd = 'dirac-dms-lfn-accessURL ' + lfn + ' ' + dest_se
-        gLogger.debug(cmd)
-        status, output = commands.getstatusoutput(cmd)
-        if "No such file" not in output:
+        if lfn in replicasDict and dest_se in replicasDict[lfn]:
 
             gLogger.info('File (%s) already exists ... removing.' %lfn)
-            cmd = '/bin/rm ' + pfn + ' <<< y'
-            gLogger.debug(cmd)
-            status, output = commands.getstatusoutput(cmd)
-            if status==0:
-                gLogger.info('File (%s) successfully removed.' %pfn)
+            if self.dryRun:
+                gLogger.info('DryRun: would remove (%s)' %pfn)
                 return False
-            else:
-                gLogger.error('Problem removing file!  /bin/rm returned {}'.format(status))
-                gLogger.info('rm cmd was: "{}"'.format(cmd))
-                return True
+            self.deletionQueue.add(pfn)
+            return False
+        elif lfn in replicasDict:
+            gLogger.warn('File (%s) is in the catalog but not on %s ... skipping.' %(lfn, dest_se))
+            return True
         else:
             return False
 
@@ -147,7 +224,30 @@ class Project8ThreadedReplicateAgentClaude(AgentModule):
                     return S_ERROR('CopyToSE %s is not valid' %self.CopyToSE)
         dest_se = self.CopyToSE
         
+        numberOfWorkers = self.__startUploadThreads()
+        if not numberOfWorkers:
+            return S_ERROR('Could not start any upload thread')
+        try:
+            self.__processCalibDirs(dest_se)
+        finally:
+            ### Block until the queued uploads are done
+            self.__stopUploadThreads(numberOfWorkers)
+            ### Then set the tags of the last uploaded files, and retry the ones that failed before (not in DryRun:
+            ### nothing is queued then, but the tags left by an earlier run would be written to the catalog)
+            if self.dryRun:
+                gLogger.info('DryRun: would set the tags of %s files' %self.tagQueue.getNumberOfPending())
+            else:
+                self.__flushTags()
+            ### Wait for the removals that are due
+            self.deletionQueue.drain()
+
+        dumpMetrics(self.metrics, self.metricsDir, self.metricsFormats)
+        return S_OK()
+
 
+    def __processCalibDirs(self, dest_se):
+        """ Remove the local files already on dest_se, and queue the others for upload
+            """
         for calib_dir in self.calibDirs:
         
             se_data_dir = path.join(self.SEDataDirPath, path.join(calib_dir,self.rawDataDir))
@@ -155,6 +255,9 @@ class Project8ThreadedReplicateAgentClaude(AgentModule):
             gLogger.info("Using se dir:"+se_data_dir)
             gLogger.info("Using local dir:"+local_data_dir)
 
+            ### Collect the candidate files first ( dict with key - lfn and value = local-pfn )
+            scanStartTime = time.time()
+            filesDict = {}
             for currentdir, subdirs, filenames in os.walk(local_data_dir):
                 gLogger.debug('In current dir: %s' % currentdir)
                 for filename in filenames:
@@ -164,14 +267,24 @@ class Project8ThreadedReplicateAgentClaude(AgentModule):
                         sub_lfn = pfn.split(local_data_dir)[-1].strip("/")
                         lfn = path.join( se_data_dir, sub_lfn )
                         gLogger.debug('pfn/sub_lfn/lfn: %s -- %s -- %s' % (pfn,sub_lfn,lfn))
-                        
-                        if not self.dryRun:
-
-                            ### Check if file already exists ###
-                            if  self.__checkAndRemoveFileOnSE(lfn, pfn, dest_se):
-                                continue
-                            else:
-                                ### Upload file via processes ###
-                                status = self._uploadFile(dest_se,pfn,lfn,calib_dir)
-        
-        return S_OK()
+                        filesDict[lfn] = pfn
+            self.metrics.observe('scan_duration_seconds', time.time() - scanStartTime, {'root': local_data_dir})
+            self.metrics.setGauge('candidate_files', len(filesDict), {'root': local_data_dir})
+
+            if not filesDict:
+                continue
+
+            ### Check if files already exist, in bulk ###
+            res = getReplicasInChunks(self.fc, filesDict.keys(), self.catalogChunkSize, self.metrics)
+            if not res['OK']:
+                gLogger.error(res['Message'])
+                continue
+            replicasDict = res['Value']['Successful']
+
+            for lfn in sorted(filesDict):
+                pfn = filesDict[lfn]
+                if  self.__checkAndRemoveFileOnSE(lfn, pfn, dest_se, replicasDict):
+                    continue
+                elif lfn not in replicasDict:
+                    ### Upload file in the upload threads, this blocks while the queue is full ###
+                    self.toBeUploaded.put((dest_se, pfn, lfn, calib_dir))
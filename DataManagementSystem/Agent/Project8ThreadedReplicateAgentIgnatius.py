@@ -17,7 +17,7 @@ import os
 import urllib
 import time
 import json
-from multiprocessing import Process
+import multiprocessing
 from pprint import pprint
 from DIRAC.Core.Utilities.Grid import executeGridCommand
 from DIRAC import S_OK, S_ERROR
@@ -31,16 +31,28 @@ from DIRAC.ResourceStatusSystem.Client.ResourceStatus import ResourceStatus
 from DIRAC.Core.Utilities.List import sortList
 from DIRAC.Core.Utilities.PrettyPrint import printTable
 from DIRAC.DataManagementSystem.Client.DataManager import DataManager
-from DIRAC.RequestManagementSystem.Client.Request import Request
-from DIRAC.RequestManagementSystem.Client.Operation import Operation
-from DIRAC.RequestManagementSystem.Client.File import File
 from DIRAC.RequestManagementSystem.Client.ReqClient import ReqClient
 from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
 
+from Project8DIRAC.DataManagementSystem.Client.AgentUtilities import dumpMetrics, makeDeletionQueue
+from Project8DIRAC.DataManagementSystem.Client.CatalogUtilities import getReplicasInChunks
+from Project8DIRAC.DataManagementSystem.Client.ReplicationRequests import buildRequest
+from Project8DIRAC.DataManagementSystem.Client.TransferMetrics import TransferMetrics
+
 
 __RCSID__ = ' (Fri Oct  2 13:25:08 PDT 2015)  Malachi Schram <malachi.schram@pnnl.gov '
 
 def add_file(dest_se, pfn, lfn):
+  """ Upload and register a file (run in the worker processes), the agent removes the local copy.
+      Returns a tuple (lfn, uploaded, elapsedTime, message)
+      """
+  try:
+    return _add_file(dest_se, pfn, lfn)
+  except Exception as e:
+    ### Never let an exception escape to the pool, the agent expects a result for every task
+    return (lfn, False, 0., 'Unexpected error: %s' % e)
+
+def _add_file(dest_se, pfn, lfn):
   cmd = 'dirac-dms-add-file -o /Resources/Sites/Test=true '
   #gLogger.info("local file is {}".format(lfn))
   cmd += lfn + ' '
@@ -53,17 +65,11 @@ def add_file(dest_se, pfn, lfn):
   status, output = commands.getstatusoutput(cmd)
   elapsedTime = time.time() - initialTime
   if status==0:
-    gLogger.info('Upload successful in {} s. Removing local file...'.format(elapsedTime))
-    cmd = '/bin/rm ' + pfn + ' <<< y'
-    gLogger.debug(cmd)
-    status, output = commands.getstatusoutput(cmd)
-    if status==0:
-      gLogger.info('File successfully removed.')
-    else:
-      gLogger.error('Problem removing file!  rm returned {}'.format(status))
-      gLogger.info('rm cmd was: "{}"'.format(cmd))
+    gLogger.info('Upload successful in {} s.'.format(elapsedTime))
+    return (lfn, True, elapsedTime, '')
   else:
     gLogger.error('Failed to upload file ' + lfn)
+    return (lfn, False, elapsedTime, output)
 
 class Project8ThreadedReplicateAgentIgnatius(AgentModule):
 
@@ -84,7 +90,22 @@ class Project8ThreadedReplicateAgentIgnatius(AgentModule):
         self.LocalDataDirPath = (self.am_getOption("LocalDataDirPath",'/data_ignatius/'))
         self.DIRACCfgSEPath = 'Resources/StorageElements'
         self.fc = FileCatalogClient()
-        
+        ### Number of lfns per bulk catalog query
+        self.catalogChunkSize = int(self.am_getOption("CatalogChunkSize", 1000))
+        ### Metrics, written to MetricsDir at the end of every cycle (empty MetricsDir to disable)
+        ### The uploads run in separate processes, their results are collected by the agent
+        self.metrics = TransferMetrics('project8_ignatius_replicate')
+        self.metricsDir = self.am_getOption("MetricsDir", self.am_getWorkDirectory())
+        self.metricsFormats = self.am_getOption("MetricsFormats", ['prometheus', 'json'])
+        ### The uploads run in a pool of maxNumberOfProcesses processes. The scan waits when MaxPendingUploads
+        ### uploads are queued or running, and the results of the finished ones are collected meanwhile.
+        self.maxNumberOfProcesses = int(self.am_getOption("maxNumberOfProcesses", 10))
+        self.maxPendingUploads = int(self.am_getOption("MaxPendingUploads", 2 * self.maxNumberOfProcesses))
+        ### The pool is kept from one cycle to the next. It is created here, before the deletion threads,
+        ### so that its processes are not forked from a process running threads.
+        self.pool = multiprocessing.Pool(self.maxNumberOfProcesses)
+        ### The local files are removed in the background, see makeDeletionQueue for the options
+        self.deletionQueue = makeDeletionQueue(self, self.metrics)
 
         return S_OK()
 
@@ -95,28 +116,13 @@ class Project8ThreadedReplicateAgentIgnatius(AgentModule):
             """
     
         ## Setup request
-        request = Request()
-        request.RequestName = "DDM_"+ str(target_se) +  datetime.datetime.now().strftime("_%Y%m%d_%H%M%S")
-        myOp = Operation()
-        myOp.Type = whichRMSOp
-        myOp.TargetSE = target_se
-        ## Add LFNS to operations
-        for lfn in lfns_chunk_dict.keys():
-            opFile = File()
-            opFile.LFN = lfn
-            opFile.Size = lfns_chunk_dict[lfn]['Size']
-            if "Checksum" in lfns_chunk_dict[lfn]:
-                opFile.Checksum = lfns_chunk_dict[lfn]['Checksum']
-                opFile.ChecksumType = 'ADLER32'
-                ## Add file to operation
-                myOp.addFile( opFile )
-    
-        request.addOperation( myOp )
+        request = buildRequest( target_se, lfns_chunk_dict, whichRMSOp )
         reqClient = ReqClient()
         putRequest = reqClient.putRequest( request )
         if not putRequest["OK"]:
             gLogger.error( "Unable to put request '%s': %s" % ( request.RequestName, putRequest["Message"] ) )
             return S_ERROR("Problem submitting to RMS.")
+        return S_OK( putRequest["Value"] )
 
     def __getMetaData(self, filename):
         ### Give json filename as input
@@ -189,7 +195,9 @@ class Project8ThreadedReplicateAgentIgnatius(AgentModule):
         gLogger.info("Using se dir:"+se_data_dir)
         gLogger.info("Using local dir:"+local_data_dir)
 
-        np=0
+        ### Collect the candidate files first ( dict with key - lfn and value = local-pfn )
+        scanStartTime = time.time()
+        filesDict = {}
         for currentdir, subdirs, filenames in os.walk(local_data_dir):
           gLogger.debug('In current dir: %s' % currentdir)
           for filename in filenames:
@@ -200,62 +208,118 @@ class Project8ThreadedReplicateAgentIgnatius(AgentModule):
               sub_lfn = pfn.split(local_data_dir)[-1].strip("/")
               lfn = os.path.join( se_data_dir, pfn.split(local_data_dir)[-1].strip("/") ) 
               gLogger.debug('pfn/sub_lfn/lfn: %s -- %s -- %s' % (pfn,sub_lfn,lfn))
-              if np>=50:
-                pmesg = 'Too many active process (50). Sleeping for 1 sec'
-                gLogger.info(pmesg)
-                time.sleep(1)
-                np=0
-
-
-              ### Check if file already exists ###
-              cmd = 'dirac-dms-lfn-accessURL ' + lfn + ' ' + dest_se
-              gLogger.debug(cmd)
-              status, output = commands.getstatusoutput(cmd)
-              if "No such file" not in output:
-                gLogger.info('File already exists ... removing.')
-                cmd = '/bin/rm ' + pfn + ' <<< y'
-                gLogger.debug(cmd)
-                status, output = commands.getstatusoutput(cmd)
-                if status==0:
-                  gLogger.info('File successfully removed.')
-                else:
-                  gLogger.error('Problem removing file!  rm returned {}'.format(status))
-                  gLogger.info('rm cmd was: "{}"'.format(cmd))
+              filesDict[lfn] = pfn
+        self.metrics.observe('scan_duration_seconds', time.time() - scanStartTime)
+        self.metrics.setGauge('candidate_files', len(filesDict))
+
+        if not filesDict:
+          dumpMetrics(self.metrics, self.metricsDir, self.metricsFormats)
+          return S_OK()
+
+        ### Check if files already exist, in bulk ###
+        res = getReplicasInChunks(self.fc, filesDict.keys(), self.catalogChunkSize, self.metrics)
+        if not res['OK']:
+          gLogger.error(res['Message'])
+          dumpMetrics(self.metrics, self.metricsDir, self.metricsFormats)
+          return res
+        replicasDict = res['Value']['Successful']
+
+        pending = []
+        try:
+            self.__processFiles(filesDict, replicasDict, dest_se, se_data_dir, local_data_dir, self.pool, pending)
+        finally:
+            ### No more tasks, wait for the running ones (the worker processes wait for the next cycle)
+            while pending:
+                self.__collectResults(pending, 1)
+            ### Wait for the removals that are due
+            self.deletionQueue.drain()
+
+        dumpMetrics(self.metrics, self.metricsDir, self.metricsFormats)
+        return S_OK()
+
+
+    def __processFiles(self, filesDict, replicasDict, dest_se, se_data_dir, local_data_dir, pool, pending):
+        """ Remove the local files already on dest_se and submit the uploads of the others to the pool
+            """
+        for lfn in sorted(filesDict):
+              pfn = filesDict[lfn]
+              currentdir, filename = os.path.split(pfn)
+
+              ### Treat meta data file differently: the dir meta data is registered before the local file is removed
+              metaData = None
+              if filename.endswith('_meta.json'):
+                  sub_lpn = os.path.join( currentdir.split(local_data_dir)[-1].strip("/") )
+                  lpn = os.path.join( se_data_dir, sub_lpn)
+                  try:
+                      meta_python_dict = self.__getMetaData(pfn)
+                  except (IOError, ValueError) as e:
+                      gLogger.error('Could not read the meta data from file (%s): %s ... skipping.' %(pfn, e))
+                      continue
+                  gLogger.info('Meta Data from file (%s) is: %s' %(filename, meta_python_dict))
+                  metaData = (lpn, meta_python_dict)
+
+              if lfn in replicasDict:
+                if dest_se not in replicasDict[lfn]:
+                  gLogger.warn('File (%s) is in the catalog but not on %s ... skipping.' %(lfn, dest_se))
                   continue
-              ### Upload file via processes ###
+                gLogger.info('File already exists ... removing.')
+                if self.__registerMetaData(lfn, metaData):
+                    self.deletionQueue.add(pfn)
+              ### Upload file via the process pool ###
               else:
-                  
-                ### Get metadata for the dir
-                IsMetaDataDone = False
-                meta_python_dict = {}
-                ### Treat meta data file differently
-                if filename.endswith('_meta.json'):
-                    sub_lpn = os.path.join( currentdir.split(local_data_dir)[-1].strip("/") )
-                    lpn = os.path.join( se_data_dir, sub_lpn)
-                    meta_python_dict = self.__getMetaData(pfn)
-                    gLogger.info('Meta Data from file (%s) is: %s' %(filename, meta_python_dict))
-                    ## Upload metadata file
-                    add_file(dest_se,pfn,lfn)
-                    if not IsMetaDataDone :
-                        # register this metadata
-                        if meta_python_dict:
-                            res = self.fc.setMetadata(lpn, meta_python_dict)
-                            if not res['OK']:
-                                gLogger.error('Setting Meta Data from file (%s) failed with message (%s)' %(filename, res['Message']))
-                            else:
-                                IsMetaDataDone = True
-                        else:
-                            gLogger.error('Meta Data for this dir(%s) was not found.' %(currentdir))
-
-
-
-                else:
-                    ### All other files besides meta data file
-                    pmesg = 'Submitting process #%s.' % np
-                    gLogger.info(pmesg)
-                    p = Process(target=add_file,args=(dest_se,pfn,lfn,))
-                    p.start()
-                    np+=1
-                      
-        
+
+                ### Backpressure: wait for a free slot, collecting the finished uploads
+                while len(pending) >= self.maxPendingUploads:
+                    self.__collectResults(pending, 1)
+                gLogger.info('Submitting upload of %s (%s pending).' %(lfn, len(pending)))
+                pending.append((pool.apply_async(add_file, (dest_se, pfn, lfn)), pfn, metaData))
+                self.metrics.incr('submitted_uploads_total')
+              self.__collectResults(pending)
         return S_OK()
+
+
+    def __collectResults(self, pending, timeout=0):
+        """ Collect the results of the finished uploads in pending (list of (AsyncResult, local-pfn, metaData)),
+            waiting up to timeout seconds for the oldest one. The dir meta data of the uploaded meta data files
+            is registered here, and the uploaded files are queued for removal.
+            """
+        if timeout and pending:
+            pending[0][0].wait(timeout)
+        stillPending = []
+        for asyncResult, pfn, metaData in pending:
+            if not asyncResult.ready():
+                stillPending.append((asyncResult, pfn, metaData))
+                continue
+            try:
+                lfn, uploaded, elapsedTime, message = asyncResult.get()
+            except Exception as e:
+                gLogger.error('Upload task failed: %s' %e)
+                self.metrics.incr('uploaded_files_total', labels={'status': 'Failed'})
+                continue
+            self.metrics.incr('uploaded_files_total', labels={'status': 'OK' if uploaded else 'Failed'})
+            self.metrics.observe('upload_duration_seconds', elapsedTime)
+            if not uploaded:
+                gLogger.error('Failed to upload file (%s): %s' %(lfn, message))
+                continue
+            if self.__registerMetaData(lfn, metaData):
+                self.deletionQueue.add(pfn)
+        pending[:] = stillPending
+        self.metrics.setGauge('pending_uploads', len(pending))
+
+
+    def __registerMetaData(self, lfn, metaData):
+        """ Register the dir meta data (lpn, meta data dict) read from the meta data file lfn, if any.
+            Returns False if it could not be set, the local file is then kept for the next cycle.
+            """
+        if not metaData:
+            return True
+        lpn, meta_python_dict = metaData
+        if not meta_python_dict:
+            gLogger.error('Meta Data for this dir(%s) was not found.' %(lpn))
+            return True
+        with self.metrics.timer('catalog_rpc_seconds', {'method': 'setMetadata'}):
+            res = self.fc.setMetadata(lpn, meta_python_dict)
+        if not res['OK']:
+            gLogger.error('Setting Meta Data from file (%s) failed with message (%s), keeping the local file' %(lfn, res['Message']))
+            return False
+        return True
@@ -0,0 +1,75 @@
+########################################################################
+# $HeadURL$
+# File: AgentUtilities.py
+########################################################################
+""" :mod: AgentUtilities
+    ====================
+
+    Pieces shared by the replication agents and their helpers: the SQLite
+    connections of the persistent caches and queues, the loop of the queue
+    worker threads, the writing of the metrics and the background removal
+    of the local files.
+"""
+
+# # imports
+import os
+import sqlite3
+
+from DIRAC import S_OK, gLogger
+
+from Project8DIRAC.DataManagementSystem.Client.DeletionQueue import DeletionQueue
+
+__RCSID__ = ' '
+
+
+def openDatabase(dbPath):
+    """ SQLite connection to dbPath (its dir is created if needed), shared by the threads of the agent
+        (the callers serialise its use with their own lock). Text is returned as str.
+        """
+    dbDir = os.path.dirname(dbPath)
+    if dbDir and not os.path.isdir(dbDir):
+        os.makedirs(dbDir)
+    conn = sqlite3.connect(dbPath, check_same_thread=False)
+    conn.text_factory = str
+    return conn
+
+
+def processQueue(queue, processTask, describeTask=str):
+    """ Loop of a worker thread: process the tasks pulled from queue with processTask until the end marker (None).
+        An unexpected error on a task is logged (with describeTask(task)) and the loop goes on.
+        """
+    while True:
+        task = queue.get()
+        try:
+            if task is None:
+                return S_OK()
+            processTask(task)
+        except Exception as e:
+            gLogger.exception('Unexpected error while processing %s' % describeTask(task), lException=e)
+        finally:
+            # Used together with join !
+            queue.task_done()
+
+
+def dumpMetrics(metrics, metricsDir, metricsFormats):
+    """ Write the metrics (TransferMetrics) to metricsDir in metricsFormats, nothing is done for an empty metricsDir
+        """
+    if not metricsDir:
+        return
+    try:
+        metrics.dump(metricsDir, metricsFormats)
+    except (IOError, OSError) as e:
+        gLogger.error('Could not write metrics to %s: %s' % (metricsDir, e))
+
+
+def makeDeletionQueue(agent, metrics=None):
+    """ DeletionQueue configured by the options of agent: maxNumberOfDeleteThreads threads remove the local files
+        in batches of DeleteBatchSize, DeleteGracePeriod seconds after they are known to be safe on the SE.
+        """
+    return DeletionQueue(int(agent.am_getOption("maxNumberOfDeleteThreads", 2)),
+                         int(agent.am_getOption("DeleteBatchSize", 100)),
+                         int(agent.am_getOption("DeleteGracePeriod", 0)),
+                         metrics)
+
+#...............................................................................
+#EOF
@@ -0,0 +1,176 @@
+########################################################################
+# $HeadURL$
+# File: BandwidthLimiter.py
+########################################################################
+""" :mod: BandwidthLimiter
+    ====================
+
+    Token bucket limit on the upload rate to each destination SE, with
+    limits depending on the time of day.
+
+    The uploads can not be throttled while they run, so the limit is applied
+    per file: an upload waits until the bucket is not in debt, then takes
+    the whole size of its file from it (possibly going into debt). The
+    following uploads wait until the debt is paid back at the current rate,
+    so that the average rate stays at the limit.
+
+    This only shapes the average: a running upload goes as fast as it can.
+    To bound the peaks as well, at most maxStreams uploads to an SE run at
+    once while it is limited, the peak rate is then at most maxStreams times
+    the rate of a single upload.
+
+    A schedule is a list of windows 'HH:MM-HH:MM=rate' (bytes/s, local time,
+    a window may wrap around midnight). The first matching window gives the
+    limit, outside all windows (or with rate 0) there is no limit.
+"""
+
+# # imports
+import time
+import datetime
+import threading
+
+from DIRAC import S_OK, S_ERROR, gLogger
+
+__RCSID__ = ' '
+
+
+def parseSchedule(windows):
+    """ Parse a list of 'HH:MM-HH:MM=rate' windows into a list of (start minute, end minute, rate).
+        Returns S_OK or S_ERROR
+        """
+    schedule = []
+    for window in windows:
+        try:
+            period, rate = window.split('=')
+            start, end = period.split('-')
+            schedule.append((_toMinutes(start), _toMinutes(end), float(rate)))
+        except ValueError:
+            return S_ERROR('Invalid bandwidth window %s, expected HH:MM-HH:MM=bytes/s' % window)
+    return S_OK(schedule)
+
+
+def _toMinutes(hhmm):
+    hours, minutes = hhmm.strip().split(':')
+    hours, minutes = int(hours), int(minutes)
+    ### 24:00 is the end of the day, there is no later time
+    if not (0 <= minutes < 60 and (0 <= hours < 24 or (hours == 24 and minutes == 0))):
+        raise ValueError(hhmm)
+    return hours * 60 + minutes
+
+
+class BandwidthLimiter(object):
+
+    """
+    .. class:: BandwidthLimiter
+    """
+
+    # Longest sleep of a waiting upload before it checks the limit again (a new window may have started)
+    __maxSleep = 5
+
+    def __init__(self, burstTime=1., maxStreams=0):
+        """ c'tor
+
+        :param self: self reference
+        :param float burstTime: the bucket holds at most burstTime seconds worth of bytes at the current rate
+        :param int maxStreams: largest number of uploads running at once to a limited SE, 0 for no limit
+        """
+        self.burstTime = burstTime
+        self.maxStreams = max(0, int(maxStreams))
+        self.condition = threading.Condition()
+        self.schedules = {}
+        self.buckets = {}
+        self.active = {}  # se -> number of uploads between acquire and release
+
+
+    def setSchedule(self, se, schedule):
+        """ Set the schedule (as returned by parseSchedule) of an SE
+            """
+        with self.condition:
+            self.schedules[se] = list(schedule)
+            self.buckets.pop(se, None)
+
+
+    def getLimit(self, se, now=None):
+        """ Current limit (bytes/s) of an SE, 0 for none
+            """
+        localTime = datetime.datetime.fromtimestamp(now or time.time())
+        minute = localTime.hour * 60 + localTime.minute
+        for start, end, rate in self.schedules.get(se, []):
+            if start <= end:
+                inWindow = start <= minute < end
+            else:
+                inWindow = minute >= start or minute < end
+            if inWindow:
+                return rate
+        return 0
+
+
+    def acquire(self, se, nbytes):
+        """ Block until an upload of nbytes to se is allowed, returns the time waited (seconds).
+            Every acquire must be followed by a release once the upload is over.
+            """
+        initialTime = time.time()
+        with self.condition:
+            while True:
+                now = time.time()
+                bucket = self.__getBucket(se, now)
+                if bucket['Rate'] <= 0:
+                    break
+                streamFree = not self.maxStreams or self.active.get(se, 0) < self.maxStreams
+                if bucket['Tokens'] >= 0 and streamFree:
+                    bucket['Tokens'] -= nbytes
+                    break
+                ### Woken up by release() when a stream is free
+                wait = -bucket['Tokens'] / bucket['Rate'] if bucket['Tokens'] < 0 else self.__maxSleep
+                self.condition.wait(min(wait, self.__maxSleep))
+            bucket['Bytes'] += nbytes
+            self.active[se] = self.active.get(se, 0) + 1
+            return now - initialTime
+
+
+    def release(self, se):
+        """ The upload to se allowed by acquire is over
+            """
+        with self.condition:
+            self.active[se] = max(self.active.get(se, 0) - 1, 0)
+            self.condition.notify_all()
+
+
+    def getStatus(self):
+        """ Per SE: current limit and rate achieved (bytes/s) since the previous call
+            """
+        status = {}
+        with self.condition:
+            now = time.time()
+            for se in self.schedules:
+                bucket = self.__getBucket(se, now)
+                elapsed = max(now - bucket['ReportTime'], 1e-6)
+                status[se] = {'Limit': bucket['Rate'], 'Rate': bucket['Bytes'] / elapsed}
+                bucket['Bytes'] = 0
+                bucket['ReportTime'] = now
+        return status
+
+
+    # Private methods ............................................................
+
+    def __getBucket(self, se, now):
+        """ The bucket of se, refilled up to now at the current rate. Called with the condition held.
+            """
+        rate = self.getLimit(se, now)
+        bucket = self.buckets.get(se)
+        if bucket is None:
+            bucket = {'Rate': rate, 'Tokens': rate * self.burstTime, 'Time': now, 'Bytes': 0, 'ReportTime': now}
+            self.buckets[se] = bucket
+        if rate != bucket['Rate']:
+            gLogger.info('Upload rate limit to %s changed from %s to %s bytes/s' % (se, bucket['Rate'] or 'none', rate or 'none'))
+            bucket['Rate'] = rate
+            ### No limit any more: the debt is forgiven
+            if rate <= 0:
+                bucket['Tokens'] = 0
+        if rate > 0:
+            bucket['Tokens'] = min(bucket['Tokens'] + (now - bucket['Time']) * rate, rate * self.burstTime)
+        bucket['Time'] = now
+        return bucket
+
+    #...............................................................................
+    #EOF
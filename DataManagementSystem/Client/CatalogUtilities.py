@@ -0,0 +1,124 @@
+########################################################################
+# $HeadURL$
+# File: CatalogUtilities.py
+########################################################################
+""" :mod: CatalogUtilities
+    ====================
+
+    Helpers for bulk File Catalog queries shared by the Project8 agents,
+    and a cache of the replica lookups in front of them.
+"""
+
+# # imports
+import time
+import threading
+
+from DIRAC import S_OK, S_ERROR
+from DIRAC.Core.Utilities.List import breakListIntoChunks
+
+__RCSID__ = ' '
+
+
+def getReplicasInChunks(fc, lfns, chunkSize=1000, metrics=None):
+    """ Query fc.getReplicas for a (possibly long) list of lfns, chunkSize lfns per call.
+        Returns S_OK with the merged {'Successful': {lfn: {SE: pfn}}, 'Failed': {lfn: reason}} dicts
+        or S_ERROR if one of the calls failed
+        If a TransferMetrics is given, the latency of each call is recorded in it.
+        """
+    successful = {}
+    failed = {}
+    for lfnChunk in breakListIntoChunks(list(lfns), chunkSize):
+        initialTime = time.time()
+        res = fc.getReplicas(lfnChunk)
+        if metrics:
+            metrics.observe('catalog_rpc_seconds', time.time() - initialTime, {'method': 'getReplicas'})
+        if not res['OK']:
+            return S_ERROR('Could not query FC with getReplicas(). Message is : %s' % res['Message'])
+        successful.update(res['Value'].get('Successful', {}))
+        failed.update(res['Value'].get('Failed', {}))
+    return S_OK({'Successful': successful, 'Failed': failed})
+
+
+class CatalogLookupCache(object):
+
+    """
+    .. class:: CatalogLookupCache
+
+    Replica lookups answered locally for a while: the replicas of the files found in the catalog
+    (positive entries) for positiveTTL seconds, and the files not in the catalog (negative entries)
+    for negativeTTL seconds. Only the 'No such file' failures are cached. The entry of a file must be
+    invalidated when it is registered by the agent.
+    """
+
+    def __init__(self, positiveTTL=3600, negativeTTL=600):
+        """ c'tor
+
+        :param self: self reference
+        :param int positiveTTL: seconds the replicas of a file in the catalog are cached, 0 for never
+        :param int negativeTTL: seconds a file not in the catalog is cached as such, 0 for never
+        """
+        self.positiveTTL = positiveTTL
+        self.negativeTTL = negativeTTL
+        self.lock = threading.Lock()
+        self.entries = {}  # lfn -> ( expiry time, replicas dict or None if not in the catalog )
+
+
+    def getReplicas(self, fc, lfns, chunkSize=1000, metrics=None):
+        """ Same as getReplicasInChunks, with the cached lfns answered locally
+            """
+        now = time.time()
+        successful = {}
+        failed = {}
+        toQuery = []
+        with self.lock:
+            for lfn in lfns:
+                entry = self.entries.get(lfn)
+                if entry is None or entry[0] <= now:
+                    toQuery.append(lfn)
+                elif entry[1] is None:
+                    failed[lfn] = 'No such file or directory'
+                else:
+                    successful[lfn] = dict(entry[1])
+        if metrics:
+            metrics.incr('catalog_cache_lookups_total', len(successful) + len(failed), {'result': 'hit'})
+            metrics.incr('catalog_cache_lookups_total', len(toQuery), {'result': 'miss'})
+        if not toQuery:
+            return S_OK({'Successful': successful, 'Failed': failed})
+
+        res = getReplicasInChunks(fc, toQuery, chunkSize, metrics)
+        if not res['OK']:
+            return res
+        now = time.time()
+        with self.lock:
+            if self.positiveTTL > 0:
+                for lfn, replicas in res['Value']['Successful'].items():
+                    self.entries[lfn] = (now + self.positiveTTL, dict(replicas))
+            if self.negativeTTL > 0:
+                for lfn, reason in res['Value']['Failed'].items():
+                    if 'No such file' in str(reason):
+                        self.entries[lfn] = (now + self.negativeTTL, None)
+            if metrics:
+                metrics.setGauge('catalog_cache_entries', len(self.entries))
+        successful.update(res['Value']['Successful'])
+        failed.update(res['Value']['Failed'])
+        return S_OK({'Successful': successful, 'Failed': failed})
+
+
+    def invalidate(self, lfns):
+        """ Forget the cached lookups of lfns, e.g. once they are registered or removed
+            """
+        with self.lock:
+            for lfn in lfns:
+                self.entries.pop(lfn, None)
+
+
+    def purge(self):
+        """ Forget the expired entries
+            """
+        now = time.time()
+        with self.lock:
+            for lfn in [lfn for lfn, entry in self.entries.items() if entry[0] <= now]:
+                del self.entries[lfn]
+
+#...............................................................................
+#EOF
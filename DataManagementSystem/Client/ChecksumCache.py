@@ -0,0 +1,238 @@
+########################################################################
+# $HeadURL$
+# File: ChecksumCache.py
+########################################################################
+""" :mod: ChecksumCache
+    ====================
+
+    ADLER32 checksums of the local files, computed ahead of the uploads by a
+    pool of processes and kept in a persistent (SQLite) cache.
+
+    A checksum is cached with the size and mtime of the file it was computed
+    on, and only reused while both are unchanged. Checksums are formatted as
+    8 hex digits, as DIRAC stores them.
+
+    The pool is forked, so it should be started (start()) before the process
+    runs any thread.
+"""
+
+# # imports
+import os
+import zlib
+import threading
+import multiprocessing
+
+from DIRAC import gLogger
+
+from Project8DIRAC.DataManagementSystem.Client.AgentUtilities import openDatabase
+
+__RCSID__ = ' '
+
+# Size of the blocks read from disk
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Number of computations started by the pool processes, shared with them (set by _initWorker)
+_started = None
+
+
+def adler32(path, blockSize=BLOCK_SIZE):
+    """ ADLER32 checksum of a file, read in blocks of blockSize bytes
+        """
+    value = 1
+    with open(path, 'rb') as inputFile:
+        while True:
+            block = inputFile.read(blockSize)
+            if not block:
+                break
+            value = zlib.adler32(block, value)
+    return '%08x' % (value & 0xffffffff)
+
+
+def _initWorker(started):
+    global _started
+    _started = started
+
+
+def _computeChecksum(path):
+    """ adler32 run in a pool process, counting the started computations
+        """
+    with _started.get_lock():
+        _started.value += 1
+    return adler32(path)
+
+
+class ChecksumCache(object):
+
+    """
+    .. class:: ChecksumCache
+    """
+
+    def __init__(self, dbPath, numberOfProcesses=4, minSize=0):
+        """ c'tor
+
+        :param self: self reference
+        :param str dbPath: path of the SQLite file holding the cache
+        :param int numberOfProcesses: size of the process pool computing the checksums
+        :param int minSize: files smaller than this are not precomputed (their checksum is cheap to get at upload time)
+        """
+        self.dbPath = dbPath
+        self.numberOfProcesses = max(1, int(numberOfProcesses))
+        self.minSize = minSize
+        self.lock = threading.RLock()
+        self.pool = None
+        ### The pool takes the computations in submission order: the n-th submitted is started once n are
+        self.started = multiprocessing.Value('l', 0)
+        self.submitted = 0
+        self.pending = {}  # path -> ( ( size, mtime ), AsyncResult, submission number )
+        self.conn = openDatabase(dbPath)
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS Checksums ( Path TEXT PRIMARY KEY, Size INTEGER, MTime REAL, Checksum TEXT )')
+            self.conn.commit()
+
+
+    def start(self):
+        """ Start the process pool, if not done yet
+            """
+        self.__getPool()
+
+
+    def get(self, path, size, mtime):
+        """ Cached checksum of path if it was computed with this size and mtime, None otherwise
+            """
+        with self.lock:
+            row = self.conn.execute('SELECT Size, MTime, Checksum FROM Checksums WHERE Path = ?', (path,)).fetchone()
+        if row and row[0] == size and row[1] == mtime:
+            return row[2]
+        return None
+
+
+    def set(self, path, size, mtime, checksum):
+        """ Cache the checksum of path, computed with this size and mtime
+            """
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO Checksums ( Path, Size, MTime, Checksum ) VALUES ( ?, ?, ?, ? )',
+                              (path, size, mtime, checksum))
+            self.conn.commit()
+
+
+    def remove(self, path):
+        """ Forget the checksum of path, e.g. once the local file is removed
+            """
+        with self.lock:
+            self.pending.pop(path, None)
+            self.conn.execute('DELETE FROM Checksums WHERE Path = ?', (path,))
+            self.conn.commit()
+
+
+    def submit(self, paths):
+        """ Start computing in the background the checksums of the files (at least minSize bytes) that are not
+            cached yet, in the order given
+            """
+        submitted = 0
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_size < self.minSize:
+                continue
+            key = (st.st_size, st.st_mtime)
+            with self.lock:
+                if path in self.pending and self.pending[path][0] == key:
+                    continue
+            if self.get(path, *key) is not None:
+                continue
+            with self.lock:
+                result = self.__getPool().apply_async(_computeChecksum, (path,), callback=self.__makeCallback(path, key))
+                self.submitted += 1
+                self.pending[path] = (key, result, self.submitted)
+            submitted += 1
+        return submitted
+
+
+    def getChecksum(self, path, timeout=None, compute=False, startedOnly=False):
+        """ Checksum of path: from the cache, or waiting (at most timeout seconds) for the background computation.
+            With startedOnly True, a computation still queued in the pool is not waited for.
+            If it is neither cached nor being computed, it is computed here when compute is True.
+            Returns None if there is no checksum (yet).
+            """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = (st.st_size, st.st_mtime)
+        checksum = self.get(path, *key)
+        if checksum:
+            return checksum
+        with self.lock:
+            pending = self.pending.get(path)
+        if pending and pending[0] == key:
+            if startedOnly and self.started.value < pending[2]:
+                return None
+            try:
+                checksum = pending[1].get(timeout)
+            except multiprocessing.TimeoutError:
+                gLogger.warn('Checksum of %s not ready after %s s' % (path, timeout))
+                return None
+            except (IOError, OSError) as e:
+                gLogger.error('Could not compute checksum of %s: %s' % (path, e))
+                return None
+            finally:
+                with self.lock:
+                    if self.pending.get(path) is pending:
+                        del self.pending[path]
+            return checksum
+        if compute:
+            try:
+                checksum = adler32(path)
+            except (IOError, OSError) as e:
+                gLogger.error('Could not compute checksum of %s: %s' % (path, e))
+                return None
+            self.set(path, key[0], key[1], checksum)
+        return checksum
+
+
+    def clearPending(self):
+        """ Forget the checksums still being computed (the ones that complete are still cached)
+            """
+        with self.lock:
+            self.pending = {}
+
+
+    def close(self):
+        """ Stop the process pool
+            """
+        with self.lock:
+            pool, self.pool = self.pool, None
+            self.pending = {}
+            self.submitted = 0
+            self.started.value = 0
+        if pool:
+            pool.terminate()
+            pool.join()
+
+
+    # Private methods ............................................................
+
+    def __getPool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.numberOfProcesses, _initWorker, (self.started,))
+            return self.pool
+
+
+    def __makeCallback(self, path, key):
+        """ Callback of a completed checksum computation, run in the pool result thread
+            """
+        def callback(checksum):
+            ### Not cached if the file was removed (e.g. uploaded without waiting for it) or changed meanwhile
+            try:
+                st = os.stat(path)
+            except OSError:
+                return
+            if (st.st_size, st.st_mtime) == key:
+                self.set(path, key[0], key[1], checksum)
+        return callback
+
+    #...............................................................................
+    #EOF
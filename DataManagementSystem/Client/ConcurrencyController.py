@@ -0,0 +1,172 @@
+########################################################################
+# $HeadURL$
+# File: ConcurrencyController.py
+########################################################################
+""" :mod: ConcurrencyController
+    ====================
+
+    AIMD (additive increase, multiplicative decrease) limit on the number of
+    concurrent uploads.
+
+    Workers call acquire() before an upload and release() after it, with the
+    number of bytes sent, the time it took and whether it succeeded. After
+    every window of completed uploads the limit is updated:
+
+    - too many failures in the window, or a clearly lower estimated link
+      rate than before: the limit is multiplied by the decrease factor
+    - otherwise: the limit is increased by one
+
+    The link rate is estimated per upload as its own rate (bytes / time)
+    times the number of uploads running alongside it, and compared only
+    between uploads of the same size class (powers of sqrt(2) bytes): the fixed
+    cost of an upload weighs more on small files, and the files are not
+    queued in a random size order, so the raw bytes/s of two windows can
+    not be compared.
+
+    The limit always stays between the configured min and max.
+"""
+
+# # imports
+import math
+import time
+import threading
+
+from DIRAC import gLogger
+
+__RCSID__ = ' '
+
+
+def _median(values):
+    """ Median of a non empty list of numbers
+        """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.
+
+
+class ConcurrencyController(object):
+
+    """
+    .. class:: ConcurrencyController
+    """
+
+    def __init__(self, minLimit, maxLimit, initialLimit=None, window=10,
+                 maxErrorRate=0.2, decreaseFactor=0.5, throughputDropTolerance=0.8):
+        """ c'tor
+
+        :param self: self reference
+        :param int minLimit: lowest number of concurrent uploads
+        :param int maxLimit: highest number of concurrent uploads
+        :param int initialLimit: starting limit, defaults to minLimit
+        :param int window: number of completed uploads between two updates of the limit
+        :param float maxErrorRate: fraction of failed uploads in a window above which the limit is decreased
+        :param float decreaseFactor: the limit is multiplied by it on a decrease
+        :param float throughputDropTolerance: the limit is decreased if the estimated link rate of a window is below
+                                              this fraction of the last one measured on files of the same sizes
+        """
+        self.minLimit = max(1, int(minLimit))
+        self.maxLimit = max(self.minLimit, int(maxLimit))
+        if initialLimit is None:
+            initialLimit = self.minLimit
+        self.limit = min(self.maxLimit, max(self.minLimit, int(initialLimit)))
+        self.window = max(1, int(window))
+        self.maxErrorRate = maxErrorRate
+        self.decreaseFactor = decreaseFactor
+        self.throughputDropTolerance = throughputDropTolerance
+
+        self.condition = threading.Condition()
+        self.active = 0
+        self.lastThroughput = None
+        self.classRates = {}  # size class -> estimated link rate (bytes/s) of its last window
+        self.__resetWindow()
+
+
+    def acquire(self):
+        """ Block until the number of active uploads is below the current limit, then take a slot
+            """
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+
+    def release(self, nbytes, elapsedTime, ok):
+        """ Give back a slot, recording the result of the upload that used it
+            """
+        with self.condition:
+            concurrency = self.active
+            self.active -= 1
+            self.windowFiles += 1
+            if ok:
+                self.windowBytes += nbytes
+                if nbytes > 0 and elapsedTime > 0:
+                    sizeClass = int(2 * math.log(nbytes, 2))
+                    self.windowRates.setdefault(sizeClass, []).append(concurrency * nbytes / float(elapsedTime))
+            else:
+                self.windowErrors += 1
+            if self.windowFiles >= self.window:
+                self.__updateLimit()
+            self.condition.notify_all()
+
+
+    def resetWindow(self):
+        """ Drop the current measurement window, e.g. at the start of a cycle so that the idle
+            time between cycles is not counted. The current limit is kept.
+            """
+        with self.condition:
+            self.lastThroughput = None
+            self.__resetWindow()
+
+
+    def getStatus(self):
+        """ Current limit, number of active uploads and throughput (bytes/s) of the last full window
+            """
+        with self.condition:
+            return {'Limit': self.limit, 'Active': self.active, 'Throughput': self.lastThroughput}
+
+
+    # Private methods ............................................................
+
+    def __resetWindow(self):
+        """ Start a new measurement window
+            """
+        self.windowStart = time.time()
+        self.windowFiles = 0
+        self.windowBytes = 0
+        self.windowErrors = 0
+        self.windowRates = {}  # size class -> estimated link rates of the uploads of the window
+
+
+    def __updateLimit(self):
+        """ AIMD update of the limit at the end of a window, called with the condition held
+            """
+        elapsed = max(time.time() - self.windowStart, 1e-6)
+        errorRate = float(self.windowErrors) / self.windowFiles
+
+        ### Median estimated link rate of each size class, compared with the last one of the same class
+        classRates = dict((sizeClass, _median(rates)) for sizeClass, rates in self.windowRates.items())
+        ratios = [classRates[sizeClass] / self.classRates[sizeClass] for sizeClass in classRates
+                  if self.classRates.get(sizeClass)]
+        ratio = _median(ratios) if ratios else None
+
+        oldLimit = self.limit
+        if errorRate > self.maxErrorRate:
+            reason = 'error rate %.2f' % errorRate
+            self.limit = max(self.minLimit, int(self.limit * self.decreaseFactor))
+        elif ratio is not None and ratio < self.throughputDropTolerance:
+            reason = 'estimated link rate dropped to %.2f of the previous one' % ratio
+            self.limit = max(self.minLimit, int(self.limit * self.decreaseFactor))
+        else:
+            reason = 'error rate %.2f' % errorRate
+            self.limit = min(self.maxLimit, self.limit + 1)
+
+        if self.limit != oldLimit:
+            gLogger.info('Upload concurrency changed from %s to %s (%s)' % (oldLimit, self.limit, reason))
+        self.lastThroughput = self.windowBytes / elapsed
+        self.classRates.update(classRates)
+        self.__resetWindow()
+
+    #...............................................................................
+    #EOF
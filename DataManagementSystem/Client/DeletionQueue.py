@@ -0,0 +1,150 @@
+########################################################################
+# $HeadURL$
+# File: DeletionQueue.py
+########################################################################
+""" :mod: DeletionQueue
+    ====================
+
+    Background removal of the local files once they are safely on the SE.
+
+    The files are queued by the agents and removed by a few threads of their
+    own, in batches, so that a slow unlink on a busy file system does not hold
+    an upload slot. A file can be kept for a grace period after it is queued,
+    e.g. for whatever still reads it locally.
+"""
+
+# # imports
+import os
+import time
+import threading
+import collections
+
+from DIRAC import gLogger
+
+__RCSID__ = ' '
+
+
+class DeletionQueue(object):
+
+    """
+    .. class:: DeletionQueue
+    """
+
+    def __init__(self, numberOfThreads=2, batchSize=100, gracePeriod=0, metrics=None):
+        """ c'tor
+
+        :param self: self reference
+        :param int numberOfThreads: number of threads removing the files
+        :param int batchSize: largest number of files a thread takes from the queue at once
+        :param int gracePeriod: seconds a file is kept after it is queued
+        :param metrics: TransferMetrics recording the removals, if any
+        """
+        self.numberOfThreads = max(1, int(numberOfThreads))
+        self.batchSize = max(1, int(batchSize))
+        self.gracePeriod = gracePeriod
+        self.metrics = metrics
+        self.condition = threading.Condition()
+        self.queue = collections.deque()  # ( removal time, path ), in removal time order
+        self.pending = set()
+        self.inFlight = 0
+        self.threads = []
+
+
+    def add(self, path):
+        """ Queue the removal of a local file, returns False if it is already queued
+            """
+        with self.condition:
+            if path in self.pending:
+                return False
+            self.pending.add(path)
+            self.queue.append((time.time() + self.gracePeriod, path))
+            self.__startThreads()
+            self.condition.notify()
+        self.__setQueueDepth()
+        return True
+
+
+    def isPending(self, path):
+        """ True if the file is queued for removal (or being removed)
+            """
+        with self.condition:
+            return path in self.pending
+
+
+    def getNumberOfPending(self):
+        """ Number of files queued for removal (or being removed)
+            """
+        with self.condition:
+            return len(self.pending)
+
+
+    def drain(self, timeout=None):
+        """ Block until the files due for removal now (the grace period of the others is not waited for) are removed,
+            at most timeout seconds. Returns False on timeout.
+            """
+        now = time.time()
+        deadline = now + timeout if timeout else None
+        with self.condition:
+            while self.inFlight or (self.queue and self.queue[0][0] <= now):
+                if deadline and time.time() >= deadline:
+                    return False
+                self.condition.wait(min(deadline - time.time(), 1.) if deadline else 1.)
+        return True
+
+
+    # Private methods ............................................................
+
+    def __startThreads(self):
+        """ Start the missing removal threads. Called with the lock held.
+            """
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        while len(self.threads) < self.numberOfThreads:
+            thread = threading.Thread(target=self.__run, name='Deletion-%s' % len(self.threads))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+
+    def __run(self):
+        """ Removal thread: take the due files from the queue, batchSize at a time, and remove them
+            """
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > time.time():
+                    ### Woken up by add() when the queue is empty
+                    self.condition.wait(self.queue[0][0] - time.time() if self.queue else None)
+                batch = []
+                while self.queue and len(batch) < self.batchSize and self.queue[0][0] <= time.time():
+                    batch.append(self.queue.popleft()[1])
+                self.inFlight += len(batch)
+            try:
+                for path in batch:
+                    self.__remove(path)
+            finally:
+                with self.condition:
+                    self.inFlight -= len(batch)
+                    self.pending.difference_update(batch)
+                    self.condition.notify_all()
+                self.__setQueueDepth()
+
+
+    def __remove(self, path):
+        initialTime = time.time()
+        try:
+            os.remove(path)
+            gLogger.info('File %s successfully removed.' % path)
+            status = 'OK'
+        except OSError as e:
+            gLogger.error('Problem removing file {} !  remove returned {}'.format(path, e.strerror))
+            status = 'Failed'
+        if self.metrics:
+            self.metrics.incr('deleted_files_total', labels={'status': status})
+            self.metrics.observe('delete_duration_seconds', time.time() - initialTime)
+
+
+    def __setQueueDepth(self):
+        if self.metrics:
+            self.metrics.setGauge('deletion_queue_depth', self.getNumberOfPending())
+
+    #...............................................................................
+    #EOF
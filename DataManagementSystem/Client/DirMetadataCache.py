@@ -0,0 +1,67 @@
+########################################################################
+# $HeadURL$
+# File: DirMetadataCache.py
+########################################################################
+""" :mod: DirMetadataCache
+    ====================
+
+    Persistent (SQLite) record of the metadata registered on catalog directories.
+
+    For every directory the cache keeps a hash of the last metadata dict
+    successfully set on it, so that registering the same metadata again can
+    be skipped without a catalog call.
+"""
+
+# # imports
+import json
+import hashlib
+import threading
+
+from Project8DIRAC.DataManagementSystem.Client.AgentUtilities import openDatabase
+
+__RCSID__ = ' '
+
+
+class DirMetadataCache(object):
+
+    """
+    .. class:: DirMetadataCache
+    """
+
+    def __init__(self, dbPath):
+        """ c'tor
+
+        :param self: self reference
+        :param str dbPath: path of the SQLite file holding the cache
+        """
+        self.dbPath = dbPath
+        self.lock = threading.RLock()
+        self.conn = openDatabase(dbPath)
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS DirMetadata ( Path TEXT PRIMARY KEY, Hash TEXT )')
+            self.conn.commit()
+            self.hashes = dict(self.conn.execute('SELECT Path, Hash FROM DirMetadata'))
+
+
+    @staticmethod
+    def metadataHash(metaDict):
+        """ Hash of a metadata dict, independent of the key order
+            """
+        return hashlib.md5(json.dumps(metaDict, sort_keys=True)).hexdigest()
+
+
+    def isRegistered(self, lpn, metaDict):
+        """ True if exactly this metadata dict was already registered on lpn
+            """
+        with self.lock:
+            return self.hashes.get(lpn) == self.metadataHash(metaDict)
+
+
+    def setRegistered(self, lpn, metaDict):
+        """ Record that metaDict was successfully registered on lpn
+            """
+        metaHash = self.metadataHash(metaDict)
+        with self.lock:
+            self.hashes[lpn] = metaHash
+            self.conn.execute('INSERT OR REPLACE INTO DirMetadata ( Path, Hash ) VALUES ( ?, ? )', (lpn, metaHash))
+            self.conn.commit()
@@ -0,0 +1,147 @@
+########################################################################
+# $HeadURL$
+# File: DirectorySync.py
+########################################################################
+""" :mod: DirectorySync
+    ====================
+
+    Differential sync of a catalog directory tree to a local directory.
+
+    The listing of the catalog tree is cached between calls: a sub directory
+    is listed again only when its ModificationDate (as reported in the
+    listing of its parent) changed, and the whole tree is listed again every
+    ttl seconds. The files to be downloaded are found by comparing the sizes
+    and modification times of the catalog with the ones on the local disk.
+"""
+
+# # imports
+import os
+import time
+import calendar
+import datetime
+import threading
+
+from DIRAC import S_OK, S_ERROR, gLogger
+
+__RCSID__ = ' '
+
+
+def _toEpoch(modificationDate):
+    """ Seconds since the epoch of a catalog ModificationDate (UTC), None if it is unknown
+        """
+    if isinstance(modificationDate, datetime.datetime):
+        return calendar.timegm(modificationDate.utctimetuple())
+    try:
+        return calendar.timegm(time.strptime(str(modificationDate), '%Y-%m-%d %H:%M:%S'))
+    except ValueError:
+        return None
+
+
+def getFilesToDownload(remoteFiles, lfnDir, localDir):
+    """ Files of remoteFiles (as returned by RemoteListingCache.listTree) under lfnDir that are missing
+        in localDir, have another size, or are newer in the catalog.
+        Returns a list of (lfn, local path, size, catalog mtime)
+        """
+    toDownload = []
+    for lfn in sorted(remoteFiles):
+        remote = remoteFiles[lfn]
+        localPath = os.path.join(localDir, lfn[len(lfnDir):].strip('/'))
+        try:
+            st = os.stat(localPath)
+        except OSError:
+            toDownload.append((lfn, localPath, remote['Size'], remote['MTime']))
+            continue
+        if st.st_size != remote['Size'] or (remote['MTime'] and remote['MTime'] > st.st_mtime):
+            toDownload.append((lfn, localPath, remote['Size'], remote['MTime']))
+    return toDownload
+
+
+class RemoteListingCache(object):
+
+    """
+    .. class:: RemoteListingCache
+    """
+
+    def __init__(self, ttl=3600):
+        """ c'tor
+
+        :param self: self reference
+        :param int ttl: seconds after which a cached directory listing is not used any more
+        """
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.listings = {}  # dir -> { 'Time', 'MTime', 'Files' : { lfn : { 'Size', 'MTime' } }, 'SubDirs' : { dir : mtime } }
+
+
+    def listTree(self, fc, lfnDir):
+        """ All the files under lfnDir, listed with the catalog client fc or taken from the cache.
+            Returns S_OK with a dict with the lfns as key and a dict with 'Size' and 'MTime' as value,
+            and the number of catalog calls made as 'Listed'.
+            """
+        files = {}
+        listed = 0
+        ### ( dir, its mtime in the listing of its parent ), the top dir is always listed
+        toList = [(lfnDir.rstrip('/'), None)]
+        while toList:
+            directory, mtime = toList.pop()
+            listing = self.__getCached(directory, mtime)
+            if listing is None:
+                res = self.__listDirectory(fc, directory, mtime)
+                if not res['OK']:
+                    return res
+                listing = res['Value']
+                listed += 1
+            files.update(listing['Files'])
+            toList.extend(listing['SubDirs'].items())
+        return S_OK({'Files': files, 'Listed': listed})
+
+
+    def invalidate(self, lfnDir=None):
+        """ Forget the cached listings under lfnDir, or all of them
+            """
+        with self.lock:
+            if lfnDir is None:
+                self.listings = {}
+                return
+            lfnDir = lfnDir.rstrip('/')
+            for directory in self.listings.keys():
+                if directory == lfnDir or directory.startswith(lfnDir + '/'):
+                    del self.listings[directory]
+
+
+    # Private methods ............................................................
+
+    def __getCached(self, directory, mtime):
+        """ The cached listing of directory if it is recent enough and the directory did not change since
+            """
+        with self.lock:
+            listing = self.listings.get(directory)
+        if listing is None or mtime is None or listing['MTime'] != mtime:
+            return None
+        if time.time() - listing['Time'] > self.ttl:
+            return None
+        return listing
+
+
+    def __listDirectory(self, fc, directory, mtime):
+        listTime = time.time()
+        res = fc.listDirectory(directory, True)
+        if not res['OK']:
+            return res
+        if directory in res['Value']['Failed']:
+            return S_ERROR('Could not list %s: %s' % (directory, res['Value']['Failed'][directory]))
+        content = res['Value']['Successful'][directory]
+        listing = {'Time': listTime, 'MTime': mtime, 'Files': {}, 'SubDirs': {}}
+        for lfn, fileDict in content.get('Files', {}).items():
+            metaData = fileDict.get('MetaData', {})
+            listing['Files'][lfn] = {'Size': metaData.get('Size', 0), 'MTime': _toEpoch(metaData.get('ModificationDate'))}
+        for subDir, metaData in content.get('SubDirs', {}).items():
+            subDirMTime = _toEpoch(metaData.get('ModificationDate')) if isinstance(metaData, dict) else None
+            listing['SubDirs'][subDir.rstrip('/')] = subDirMTime
+        with self.lock:
+            self.listings[directory] = listing
+        gLogger.debug('Listed %s: %s files, %s sub dirs' % (directory, len(listing['Files']), len(listing['SubDirs'])))
+        return S_OK(listing)
+
+    #...............................................................................
+    #EOF
@@ -0,0 +1,219 @@
+########################################################################
+# $HeadURL$
+# File: InotifyWatcher.py
+########################################################################
+""" :mod: InotifyWatcher
+    ====================
+
+    Linux inotify watcher over a set of local data dirs (recursively).
+
+    A background thread collects the files that are closed after writing
+    (IN_CLOSE_WRITE) or moved into a watched dir (IN_MOVED_TO); new
+    sub-directories are watched as soon as they are created or moved in,
+    and the files already in them are reported too, as not known to be
+    closed. The other files that are still open for writing are never
+    reported.
+
+    Events can be lost (kernel queue overflow, watch limit reached): in that
+    case the overflowed flag is set and the caller is expected to fall back
+    to a full scan.
+"""
+
+# # imports
+import os
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+import threading
+import Queue
+
+from DIRAC import S_OK, S_ERROR, gLogger
+
+__RCSID__ = ' '
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher(object):
+
+    """
+    .. class:: InotifyWatcher
+    """
+
+    __watchMask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+    def __init__(self, roots):
+        """ c'tor
+
+        :param self: self reference
+        :param list roots: local dirs to watch recursively
+        """
+        self.roots = list(roots)
+        self.files = Queue.Queue()
+        self.watches = {}  # wd -> (root, dir path)
+        self.overflowed = False
+        self.fd = None
+        self.libc = None
+        self.thread = None
+        self.stopEvent = threading.Event()
+
+
+    def start(self):
+        """ Set up the watches and start the reader thread
+            """
+        libcName = ctypes.util.find_library('c')
+        if not libcName:
+            return S_ERROR('Could not find libc for inotify')
+        self.libc = ctypes.CDLL(libcName, use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return S_ERROR('inotify_init1 failed: %s' % os.strerror(ctypes.get_errno()))
+        self.fd = fd
+
+        for root in self.roots:
+            self.__watchTree(root, root)
+
+        self.thread = threading.Thread(target=self.__run, name='InotifyWatcher')
+        self.thread.daemon = True
+        self.thread.start()
+        gLogger.info('InotifyWatcher: watching %s dirs under %s' % (len(self.watches), ','.join(self.roots)))
+        return S_OK()
+
+
+    def stop(self):
+        """ Stop the reader thread and close the inotify fd
+            """
+        self.stopEvent.set()
+        if self.thread:
+            self.thread.join()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+    def getFiles(self, timeout, maxFiles):
+        """ Wait up to timeout seconds for a closed file, then return all the closed files
+            available right now (at most maxFiles), as a list of (root, path, closed).
+            closed is False for the files found in a new dir, which may still be open for writing.
+            """
+        files = []
+        try:
+            files.append(self.files.get(timeout=timeout))
+        except Queue.Empty:
+            return files
+        while len(files) < maxFiles:
+            try:
+                files.append(self.files.get_nowait())
+            except Queue.Empty:
+                break
+        return files
+
+
+    def resetOverflow(self):
+        """ Clear the overflowed flag, to be called before the fall back full scan
+            """
+        self.overflowed = False
+
+
+    # Private methods ............................................................
+
+    def __watchTree(self, root, path, listFiles=False):
+        """ Add a watch on path and on all the dirs below it.
+            With listFiles, the files already in these dirs are reported too.
+            """
+        for currentdir, subdirs, _filenames in os.walk(path):
+            wd = self.libc.inotify_add_watch(self.fd, currentdir, self.__watchMask)
+            if wd < 0:
+                err = ctypes.get_errno()
+                gLogger.error('InotifyWatcher: could not watch %s : %s' % (currentdir, os.strerror(err)))
+                ### Most likely the watch limit (ENOSPC), rely on the full scan from now on
+                self.overflowed = True
+                continue
+            self.watches[wd] = (root, currentdir)
+            if listFiles:
+                ### Listed once the dir is watched, so that a file closed meanwhile is not missed
+                self.__listFiles(root, currentdir)
+
+
+    def __listFiles(self, root, currentdir):
+        """ Report the files already in a dir that was just watched
+            """
+        try:
+            names = os.listdir(currentdir)
+        except OSError as e:
+            gLogger.error('InotifyWatcher: could not list %s : %s' % (currentdir, e.strerror))
+            self.overflowed = True
+            return
+        for name in names:
+            path = os.path.join(currentdir, name)
+            if os.path.isfile(path):
+                self.files.put((root, path, False))
+
+
+    def __run(self):
+        """ Reader thread: turn inotify events into closed files
+            """
+        while not self.stopEvent.is_set():
+            try:
+                readable, _w, _x = select.select([self.fd], [], [], 1)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                continue
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                gLogger.error('InotifyWatcher: read failed: %s' % e.strerror)
+                self.overflowed = True
+                continue
+            self.__handleEvents(buf)
+
+
+    def __handleEvents(self, buf):
+        """ Parse a buffer of inotify events
+            """
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                gLogger.warn('InotifyWatcher: event queue overflow, some files were missed')
+                self.overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or not name:
+                continue
+
+            root, currentdir = self.watches[wd]
+            path = os.path.join(currentdir, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    ### New dir, watch it too, and report the files it already holds (e.g. a whole run dir moved in)
+                    self.__watchTree(root, path, listFiles=True)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.files.put((root, path, True))
+
+    #...............................................................................
+    #EOF
@@ -0,0 +1,158 @@
+########################################################################
+# $HeadURL$
+# File: MetadataTagQueue.py
+########################################################################
+""" :mod: MetadataTagQueue
+    ====================
+
+    Persistent (SQLite) queue of the file level metadata to be set in the
+    catalog.
+
+    The tags are collected as the files are uploaded and set with bulk
+    catalog calls (setMetadataBulk) once maxTags of them are queued or the
+    oldest one waited maxAge seconds. A tag that could not be set stays in
+    the queue, with its number of attempts and last error, and is retried
+    at the next flush, also after a restart.
+"""
+
+# # imports
+import json
+import time
+import threading
+
+from DIRAC import S_OK, gLogger
+from DIRAC.Core.Utilities.List import breakListIntoChunks
+
+from Project8DIRAC.DataManagementSystem.Client.AgentUtilities import openDatabase
+
+__RCSID__ = ' '
+
+
+def _loadTags(metaData):
+    """ Tags stored as JSON, with the unicode keys and values (as json gives them) encoded to utf-8 str,
+        as the catalog expects them
+        """
+    tags = {}
+    for key, value in json.loads(metaData).items():
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        tags[key.encode('utf-8')] = value
+    return tags
+
+
+class MetadataTagQueue(object):
+
+    """
+    .. class:: MetadataTagQueue
+    """
+
+    def __init__(self, dbPath, maxTags=500, maxAge=60):
+        """ c'tor
+
+        :param self: self reference
+        :param str dbPath: path of the SQLite file holding the queue
+        :param int maxTags: number of queued tags from which a flush is due
+        :param int maxAge: seconds after which the oldest queued tag makes a flush due
+        """
+        self.dbPath = dbPath
+        self.maxTags = maxTags
+        self.maxAge = maxAge
+        self.lock = threading.RLock()
+        self.flushLock = threading.Lock()
+        self.conn = openDatabase(dbPath)
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS Tags ( Path TEXT PRIMARY KEY, MetaData TEXT, Queued REAL, '
+                              'Attempts INTEGER, LastError TEXT )')
+            self.conn.commit()
+            self.numberOfTags, self.oldest = self.conn.execute('SELECT COUNT(*), MIN(Queued) FROM Tags').fetchone()
+        self.retryTime = 0
+
+
+    def add(self, lfn, metaDict):
+        """ Queue metaDict to be set on lfn (merged with the tags already queued for it)
+            """
+        with self.lock:
+            row = self.conn.execute('SELECT MetaData FROM Tags WHERE Path = ?', (lfn,)).fetchone()
+            if row:
+                queued = _loadTags(row[0])
+                queued.update(metaDict)
+                self.conn.execute('UPDATE Tags SET MetaData = ? WHERE Path = ?', (json.dumps(queued), lfn))
+            else:
+                now = time.time()
+                self.conn.execute('INSERT INTO Tags ( Path, MetaData, Queued, Attempts, LastError ) VALUES ( ?, ?, ?, 0, NULL )',
+                                  (lfn, json.dumps(metaDict), now))
+                self.numberOfTags += 1
+                self.oldest = min(self.oldest or now, now)
+            self.conn.commit()
+
+
+    def isDue(self, now=None):
+        """ True if enough tags are queued, or the oldest one waited long enough
+            """
+        now = now or time.time()
+        with self.lock:
+            if not self.numberOfTags or now < self.retryTime:
+                return False
+            return self.numberOfTags >= self.maxTags or now - self.oldest >= self.maxAge
+
+
+    def getNumberOfPending(self):
+        """ Number of files with tags waiting to be set
+            """
+        with self.lock:
+            return self.numberOfTags
+
+
+    def flush(self, fc, chunkSize=1000, metrics=None, wait=True):
+        """ Set all the queued tags with bulk catalog calls of at most chunkSize files, using the catalog client fc.
+            With wait False, nothing is done if another thread is already flushing.
+            If a TransferMetrics is given, the latency of each call is recorded in it.
+            Returns S_OK with the lists of 'Successful' lfns and the dict of 'Failed' lfns and errors
+            """
+        if not self.flushLock.acquire(wait):
+            return S_OK({'Successful': [], 'Failed': {}})
+        try:
+            with self.lock:
+                tags = dict((row[0], _loadTags(row[1])) for row in self.conn.execute('SELECT Path, MetaData FROM Tags'))
+            successful = []
+            failed = {}
+            for lfns in breakListIntoChunks(sorted(tags), chunkSize):
+                initialTime = time.time()
+                res = fc.setMetadataBulk(dict((lfn, tags[lfn]) for lfn in lfns))
+                if metrics:
+                    metrics.observe('catalog_rpc_seconds', time.time() - initialTime, {'method': 'setMetadataBulk'})
+                if not res['OK']:
+                    failed.update(dict((lfn, res['Message']) for lfn in lfns))
+                    continue
+                failed.update(res['Value']['Failed'])
+                successful.extend([lfn for lfn in lfns if lfn in res['Value']['Successful']])
+            self.__done(tags, successful, failed)
+            for lfn, error in failed.items():
+                gLogger.error('Setting meta data on (%s) failed with message (%s), it will be retried' % (lfn, error))
+            if tags:
+                gLogger.info('Setting meta data succeeded on %s out of %s files' % (len(successful), len(tags)))
+            return S_OK({'Successful': successful, 'Failed': failed})
+        finally:
+            self.flushLock.release()
+
+
+    # Private methods ............................................................
+
+    def __done(self, tags, successful, failed):
+        """ Remove the tags that were set (unless more were queued for the file meanwhile), and record the failures
+            """
+        with self.lock:
+            for lfn in successful:
+                ### The tags of lfn queued during the flush are set at the next one
+                row = self.conn.execute('SELECT MetaData FROM Tags WHERE Path = ?', (lfn,)).fetchone()
+                if row and _loadTags(row[0]) == tags[lfn]:
+                    self.conn.execute('DELETE FROM Tags WHERE Path = ?', (lfn,))
+            for lfn, error in failed.items():
+                self.conn.execute('UPDATE Tags SET Attempts = Attempts + 1, LastError = ? WHERE Path = ?', (str(error), lfn))
+            self.conn.commit()
+            self.numberOfTags, self.oldest = self.conn.execute('SELECT COUNT(*), MIN(Queued) FROM Tags').fetchone()
+            ### After a failure the next flush is due in maxAge seconds at the earliest, whatever the number of tags
+            self.retryTime = time.time() + self.maxAge if failed else 0
+
+    #...............................................................................
+    #EOF
@@ -0,0 +1,184 @@
+########################################################################
+# $HeadURL$
+# File: ReplicationRequests.py
+########################################################################
+""" :mod: ReplicationRequests
+    ====================
+
+    Replication of the uploaded files to secondary SEs through the Request
+    Management System.
+
+    The files are collected as they are uploaded, then grouped by target SE
+    into ReplicateAndRegister requests of at most chunkSize files, so that the
+    replicas are made by third party transfers from the first SE. The target
+    SEs depend on the data type of the file, i.e. its suffix.
+
+    The files waiting to be submitted are kept in an SQLite file, so that
+    none is lost when the agent stops before its end of cycle submission or
+    the RMS is not reachable.
+"""
+
+# # imports
+import datetime
+import threading
+
+from DIRAC import S_OK, S_ERROR, gLogger
+from DIRAC.Core.Utilities.File import makeGuid
+from DIRAC.Core.Utilities.List import breakListIntoChunks
+from DIRAC.RequestManagementSystem.Client.Request import Request
+from DIRAC.RequestManagementSystem.Client.Operation import Operation
+from DIRAC.RequestManagementSystem.Client.File import File
+from DIRAC.RequestManagementSystem.Client.ReqClient import ReqClient
+
+from Project8DIRAC.DataManagementSystem.Client.AgentUtilities import openDatabase
+
+__RCSID__ = ' '
+
+
+def parseSecondarySEs(entries):
+    """ Parse a list of 'suffix=SE1+SE2' entries into a dict with the suffix as key and the list of SEs as value.
+        Returns S_OK or S_ERROR
+        """
+    secondarySEs = {}
+    for entry in entries:
+        try:
+            suffix, ses = entry.split('=')
+        except ValueError:
+            return S_ERROR('Invalid secondary SE entry %s, expected suffix=SE1+SE2' % entry)
+        ses = [se.strip() for se in ses.split('+') if se.strip()]
+        if not suffix.strip() or not ses:
+            return S_ERROR('Invalid secondary SE entry %s, expected suffix=SE1+SE2' % entry)
+        secondarySEs[suffix.strip()] = ses
+    return S_OK(secondarySEs)
+
+
+def buildRequest(targetSE, files, operationType='ReplicateAndRegister', sourceSE=None):
+    """ Request with one operation of type operationType to targetSE for files, a dict with the lfns as key
+        and a dict with 'Size' and optionally 'Checksum' (ADLER32) as value
+        """
+    request = Request()
+    request.RequestName = 'DDM_%s_%s_%s' % (targetSE, datetime.datetime.now().strftime('%Y%m%d_%H%M%S'), makeGuid()[:8])
+    operation = Operation()
+    operation.Type = operationType
+    operation.TargetSE = targetSE
+    if sourceSE:
+        operation.SourceSE = sourceSE
+    for lfn, fileDict in files.items():
+        opFile = File()
+        opFile.LFN = lfn
+        opFile.Size = fileDict['Size']
+        if fileDict.get('Checksum'):
+            opFile.Checksum = fileDict['Checksum']
+            opFile.ChecksumType = 'ADLER32'
+        operation.addFile(opFile)
+    request.addOperation(operation)
+    return request
+
+
+class ReplicationRequests(object):
+
+    """
+    .. class:: ReplicationRequests
+    """
+
+    def __init__(self, dbPath, secondarySEs, chunkSize=500, sourceSE=None, operationType='ReplicateAndRegister'):
+        """ c'tor
+
+        :param self: self reference
+        :param str dbPath: path of the SQLite file holding the files waiting to be submitted
+        :param dict secondarySEs: target SEs by file suffix, as returned by parseSecondarySEs
+        :param int chunkSize: largest number of files in one request
+        :param str sourceSE: SE the replicas are made from, None to let the RMS choose
+        :param str operationType: RMS operation of the requests
+        """
+        self.secondarySEs = secondarySEs
+        ### The longest suffix that matches wins, e.g. _meta.json over .json
+        self.suffixes = sorted(secondarySEs, key=len, reverse=True)
+        self.chunkSize = max(1, int(chunkSize))
+        self.sourceSE = sourceSE
+        self.operationType = operationType
+        self.lock = threading.RLock()
+        self.flushLock = threading.Lock()
+        self.reqClient = None
+        self.conn = openDatabase(dbPath)
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS Pending ( TargetSE TEXT, LFN TEXT, Size INTEGER, Checksum TEXT, '
+                              'PRIMARY KEY ( TargetSE, LFN ) )')
+            self.conn.commit()
+
+
+    def getTargetSEs(self, lfn):
+        """ Secondary SEs of lfn (by its suffix), empty list for none
+            """
+        for suffix in self.suffixes:
+            if lfn.endswith(suffix):
+                return self.secondarySEs[suffix]
+        return []
+
+
+    def add(self, lfn, size, checksum=None):
+        """ Queue the replication of lfn to its secondary SEs, returns the number of SEs it is queued for
+            """
+        targetSEs = [se for se in self.getTargetSEs(lfn) if se != self.sourceSE]
+        if not targetSEs:
+            return 0
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO Pending ( TargetSE, LFN, Size, Checksum ) VALUES ( ?, ?, ?, ? )',
+                                  [(targetSE, lfn, size, checksum) for targetSE in targetSEs])
+            self.conn.commit()
+        return len(targetSEs)
+
+
+    def getNumberOfPending(self):
+        """ Number of ( file, target SE ) pairs waiting to be submitted
+            """
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM Pending').fetchone()[0]
+
+
+    def flush(self):
+        """ Submit the queued files as requests of at most chunkSize files per target SE.
+            The files of the requests that could not be submitted stay queued for the next flush (also after a restart).
+            Returns S_OK with the number of 'Requests', 'Files' submitted and 'Failed' files
+            """
+        submitted = {'Requests': 0, 'Files': 0, 'Failed': 0}
+        with self.flushLock:
+            pending = {}
+            with self.lock:
+                for targetSE, lfn, size, checksum in self.conn.execute('SELECT TargetSE, LFN, Size, Checksum FROM Pending'):
+                    pending.setdefault(targetSE, {})[lfn] = {'Size': size, 'Checksum': checksum}
+            for targetSE, files in pending.items():
+                for lfns in breakListIntoChunks(sorted(files), self.chunkSize):
+                    chunk = dict((lfn, files[lfn]) for lfn in lfns)
+                    request = buildRequest(targetSE, chunk, self.operationType, self.sourceSE)
+                    res = self.__putRequest(request)
+                    if not res['OK']:
+                        gLogger.error("Unable to put request '%s': %s" % (request.RequestName, res['Message']))
+                        submitted['Failed'] += len(chunk)
+                        continue
+                    gLogger.info("Request '%s' submitted: %s files to %s" % (request.RequestName, len(chunk), targetSE))
+                    self.__done(targetSE, chunk)
+                    submitted['Requests'] += 1
+                    submitted['Files'] += len(chunk)
+        return S_OK(submitted)
+
+
+    # Private methods ............................................................
+
+    def __done(self, targetSE, files):
+        """ Drop the submitted files, unless they were queued again (uploaded again) meanwhile
+            """
+        with self.lock:
+            for lfn, fileDict in files.items():
+                self.conn.execute('DELETE FROM Pending WHERE TargetSE = ? AND LFN = ? AND Size IS ? AND Checksum IS ?',
+                                  (targetSE, lfn, fileDict['Size'], fileDict['Checksum']))
+            self.conn.commit()
+
+
+    def __putRequest(self, request):
+        if self.reqClient is None:
+            self.reqClient = ReqClient()
+        return self.reqClient.putRequest(request)
+
+    #...............................................................................
+    #EOF
@@ -0,0 +1,161 @@
+########################################################################
+# $HeadURL$
+# File: RetryJournal.py
+########################################################################
+""" :mod: RetryJournal
+    ====================
+
+    Persistent (SQLite) journal of the failed uploads.
+
+    For every local file whose upload failed the journal keeps the number of
+    failed attempts, the last error and the time of the next attempt, which
+    backs off exponentially (baseDelay * 2 ** (attempts - 1), at most maxDelay).
+    After quarantineAfter failed attempts the file is quarantined and not
+    retried any more until it is released or changes on disk (size or mtime).
+"""
+
+# # imports
+import os
+import time
+import threading
+
+from DIRAC import gLogger
+
+from Project8DIRAC.DataManagementSystem.Client.AgentUtilities import openDatabase
+
+__RCSID__ = ' '
+
+
+class RetryJournal(object):
+
+    """
+    .. class:: RetryJournal
+    """
+
+    def __init__(self, dbPath, baseDelay=600, maxDelay=86400, quarantineAfter=10):
+        """ c'tor
+
+        :param self: self reference
+        :param str dbPath: path of the SQLite file holding the journal
+        :param int baseDelay: delay (seconds) before retrying a file after its first failure
+        :param int maxDelay: longest delay (seconds) between two attempts
+        :param int quarantineAfter: number of failed attempts after which a file is quarantined, 0 for never
+        """
+        self.dbPath = dbPath
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.quarantineAfter = quarantineAfter
+        self.lock = threading.RLock()
+        self.conn = openDatabase(dbPath)
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS Failures ( Path TEXT PRIMARY KEY, Size INTEGER, MTime REAL, Attempts INTEGER, '
+                              'LastError TEXT, LastAttempt REAL, NextAttempt REAL, Quarantined INTEGER )')
+            self.conn.commit()
+            self.failures = {}
+            for row in self.conn.execute('SELECT Path, Size, MTime, Attempts, NextAttempt, Quarantined FROM Failures'):
+                self.failures[row[0]] = {'Size': row[1], 'MTime': row[2], 'Attempts': row[3],
+                                         'NextAttempt': row[4], 'Quarantined': bool(row[5])}
+
+
+    def isDue(self, path, now=None):
+        """ True if the file can be tried now: it never failed, its backoff delay is over, or it changed since
+            its last failure. False if it is quarantined or still backing off.
+            The entry of a file that is gone (removed or renamed) is dropped.
+            """
+        with self.lock:
+            failure = self.failures.get(path)
+        if not failure:
+            return True
+        if not os.path.exists(path):
+            self.forget(path)
+            return True
+        if self.__hasChanged(path, failure):
+            return True
+        if failure['Quarantined']:
+            return False
+        return failure['NextAttempt'] <= (now or time.time())
+
+
+    def hasDue(self, now=None):
+        """ True if one of the files that failed is due for another attempt (quarantined files are not).
+            The entries of the due files that are gone (removed or renamed) are dropped.
+            """
+        now = now or time.time()
+        with self.lock:
+            duePaths = [path for path, failure in self.failures.items() if not failure['Quarantined'] and failure['NextAttempt'] <= now]
+        for path in duePaths:
+            if os.path.exists(path):
+                return True
+            self.forget(path)
+        return False
+
+
+    def recordFailure(self, path, message):
+        """ Record a failed attempt on path, returns the failure entry
+            """
+        now = time.time()
+        try:
+            st = os.stat(path)
+            size, mtime = st.st_size, st.st_mtime
+        except OSError:
+            size, mtime = None, None
+        with self.lock:
+            failure = self.failures.get(path)
+            attempts = 1
+            if failure and failure['Size'] == size and failure['MTime'] == mtime:
+                attempts = failure['Attempts'] + 1
+            delay = min(self.baseDelay * 2 ** (attempts - 1), self.maxDelay)
+            quarantined = bool(self.quarantineAfter) and attempts >= self.quarantineAfter
+            failure = {'Size': size, 'MTime': mtime, 'Attempts': attempts, 'NextAttempt': now + delay, 'Quarantined': quarantined}
+            self.failures[path] = failure
+            self.conn.execute('INSERT OR REPLACE INTO Failures ( Path, Size, MTime, Attempts, LastError, LastAttempt, NextAttempt, Quarantined ) '
+                              'VALUES ( ?, ?, ?, ?, ?, ?, ?, ? )',
+                              (path, size, mtime, attempts, str(message), now, now + delay, int(quarantined)))
+            self.conn.commit()
+        if quarantined:
+            gLogger.error('RetryJournal: %s failed %s times, it is quarantined. Last error: %s' % (path, attempts, message))
+        else:
+            gLogger.info('RetryJournal: %s failed %s times, next attempt in %s s' % (path, attempts, delay))
+        return dict(failure)
+
+
+    def forget(self, path):
+        """ Drop path from the journal, e.g. once it is uploaded or removed. Also releases a quarantined file.
+            """
+        with self.lock:
+            if self.failures.pop(path, None) is None:
+                return
+            self.conn.execute('DELETE FROM Failures WHERE Path = ?', (path,))
+            self.conn.commit()
+
+
+    def getQuarantined(self):
+        """ Dict of the quarantined files, with path as key and (attempts, last error) as value
+            """
+        with self.lock:
+            return dict((row[0], (row[1], row[2])) for row in
+                        self.conn.execute('SELECT Path, Attempts, LastError FROM Failures WHERE Quarantined = 1'))
+
+
+    def getStatus(self):
+        """ Number of files backing off and quarantined
+            """
+        with self.lock:
+            quarantined = len([1 for failure in self.failures.values() if failure['Quarantined']])
+            return {'BackingOff': len(self.failures) - quarantined, 'Quarantined': quarantined}
+
+
+    # Private methods ............................................................
+
+    @staticmethod
+    def __hasChanged(path, failure):
+        """ True if the file is not the one that failed any more (new size or mtime)
+            """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return (st.st_size, st.st_mtime) != (failure['Size'], failure['MTime'])
+
+    #...............................................................................
+    #EOF
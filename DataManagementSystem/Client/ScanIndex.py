@@ -0,0 +1,180 @@
+########################################################################
+# $HeadURL$
+# File: ScanIndex.py
+########################################################################
+""" :mod: ScanIndex
+    ====================
+
+    Persistent (SQLite) index of the local data directories.
+
+    For every directory the index keeps its mtime and the names of its
+    sub-directories. A directory whose mtime did not change since the last
+    scan is not listed again, so a scan only reads the entries of the
+    directories that changed. Files found in the tree are kept in the index
+    until they disappear from disk (i.e. until they are copied and removed).
+"""
+
+# # imports
+import os
+import json
+import time
+import threading
+
+from DIRAC import gLogger
+
+from Project8DIRAC.DataManagementSystem.Client.AgentUtilities import openDatabase
+
+__RCSID__ = ' '
+
+
+class ScanIndex(object):
+
+    """
+    .. class:: ScanIndex
+    """
+
+    # Directories modified less than this many seconds before they are listed
+    # are listed again on the next scan (mtime granularity safety)
+    __mtimeSafetyMargin = 2
+
+    def __init__(self, dbPath):
+        """ c'tor
+
+        :param self: self reference
+        :param str dbPath: path of the SQLite file holding the index
+        """
+        self.dbPath = dbPath
+        self.lock = threading.RLock()
+        self.conn = openDatabase(dbPath)
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS Directories ( Path TEXT PRIMARY KEY, Root TEXT, MTime REAL, SubDirs TEXT )')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS Files ( Path TEXT PRIMARY KEY, Root TEXT, Dir TEXT, Size INTEGER, MTime REAL )')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS FilesDir ON Files ( Dir )')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS FilesRoot ON Files ( Root, Path )')
+            self.conn.commit()
+
+
+    def update(self, root):
+        """ Bring the index of the tree below root up to date.
+            Only directories whose mtime changed are listed.
+            The lock is only held for the index queries, so that several roots can be updated
+            at the same time from different threads.
+            Returns a tuple (number of listed dirs, number of new files)
+            """
+        cachedDirs = {}
+        with self.lock:
+            for path, mtime, subDirs in self.conn.execute('SELECT Path, MTime, SubDirs FROM Directories WHERE Root = ?', (root,)):
+                cachedDirs[path] = (mtime, json.loads(subDirs))
+
+        listedDirs = 0
+        newFiles = 0
+        stack = [root]
+        while stack:
+            currentdir = stack.pop()
+            try:
+                dirMTime = os.stat(currentdir).st_mtime
+            except OSError:
+                ### Directory is gone, drop it and everything below it
+                with self.lock:
+                    self.__forgetTree(currentdir)
+                continue
+
+            cached = cachedDirs.get(currentdir)
+            if cached and cached[0] == dirMTime:
+                ### Nothing was added or removed in this dir, reuse its sub-dirs
+                subdirs = cached[1]
+            else:
+                res = self.__listDir(root, currentdir, dirMTime, cached[1] if cached else [])
+                if res is None:
+                    continue
+                subdirs, added = res
+                listedDirs += 1
+                newFiles += added
+
+            stack.extend(os.path.join(currentdir, subdir) for subdir in reversed(subdirs))
+
+        with self.lock:
+            self.conn.commit()
+
+        gLogger.info('ScanIndex: %s dirs listed and %s new files found under %s' % (listedDirs, newFiles, root))
+        return listedDirs, newFiles
+
+
+    def getFiles(self, root):
+        """ Generator over the indexed files below root, sorted by path.
+            Yields tuples (path, size, mtime)
+            """
+        with self.lock:
+            rows = self.conn.execute('SELECT Path, Size, MTime FROM Files WHERE Root = ? ORDER BY Path', (root,)).fetchall()
+        for row in rows:
+            yield row
+
+
+    def removeFile(self, path):
+        """ Drop a single file from the index
+            """
+        with self.lock:
+            self.conn.execute('DELETE FROM Files WHERE Path = ?', (path,))
+            self.conn.commit()
+
+
+    # Private methods ............................................................
+
+    def __listDir(self, root, currentdir, dirMTime, oldSubDirs):
+        """ List one directory and update its entries in the index.
+            Returns (list of sub-dir names, number of new files) or None if the dir can not be listed
+            """
+        try:
+            names = os.listdir(currentdir)
+        except OSError as e:
+            gLogger.error('ScanIndex: could not list dir %s : %s' % (currentdir, e.strerror))
+            return None
+
+        subdirs = []
+        filenames = []
+        for name in names:
+            path = os.path.join(currentdir, name)
+            ### Same rules as os.walk: do not follow links to directories
+            if os.path.isdir(path):
+                if not os.path.islink(path):
+                    subdirs.append(name)
+            else:
+                filenames.append(name)
+        subdirs.sort()
+
+        with self.lock:
+            known = set(row[0] for row in self.conn.execute('SELECT Path FROM Files WHERE Dir = ?', (currentdir,)))
+        present = set(os.path.join(currentdir, filename) for filename in filenames)
+
+        newFiles = []
+        for path in present - known:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            newFiles.append((path, root, currentdir, st.st_size, st.st_mtime))
+
+        ### A dir modified right now may still get entries within the same mtime tick: list it again next time
+        if time.time() - dirMTime < self.__mtimeSafetyMargin:
+            dirMTime = -1
+
+        with self.lock:
+            for path in known - present:
+                self.conn.execute('DELETE FROM Files WHERE Path = ?', (path,))
+            self.conn.executemany('INSERT OR REPLACE INTO Files ( Path, Root, Dir, Size, MTime ) VALUES ( ?, ?, ?, ?, ? )', newFiles)
+            for subdir in set(oldSubDirs) - set(subdirs):
+                self.__forgetTree(os.path.join(currentdir, subdir))
+            self.conn.execute('INSERT OR REPLACE INTO Directories ( Path, Root, MTime, SubDirs ) VALUES ( ?, ?, ?, ? )',
+                              (currentdir, root, dirMTime, json.dumps(subdirs)))
+        return subdirs, len(newFiles)
+
+
+    def __forgetTree(self, path):
+        """ Drop a dir and everything below it from the index, called with the lock held
+            """
+        prefix = path.rstrip('/') + '/'
+        self.conn.execute('DELETE FROM Directories WHERE Path = ? OR substr( Path, 1, ? ) = ?', (path, len(prefix), prefix))
+        self.conn.execute('DELETE FROM Files WHERE Dir = ? OR substr( Dir, 1, ? ) = ?', (path, len(prefix), prefix))
+
+    #...............................................................................
+    #EOF
@@ -0,0 +1,83 @@
+########################################################################
+# $HeadURL$
+# File: SmallFileArchive.py
+########################################################################
+""" :mod: SmallFileArchive
+    ====================
+
+    Packing of the small side files of a run directory (_meta.json,
+    _snapshot.json, .yaml, .Setup, .msk, ...) into one uncompressed tar
+    archive, so that they cost a single upload and catalog registration.
+
+    Every archive holds a MANIFEST.json listing its members with their
+    size, mtime and ADLER32 checksum.
+"""
+
+# # imports
+import os
+import json
+import time
+import tarfile
+import StringIO
+
+from DIRAC import S_OK, S_ERROR
+
+from Project8DIRAC.DataManagementSystem.Client.ChecksumCache import adler32
+
+__RCSID__ = ' '
+
+MANIFEST_NAME = 'MANIFEST.json'
+
+
+def buildArchive(archivePath, pfns):
+    """ Pack the local files pfns (all in the same dir) into the tar archive archivePath, with a manifest.
+        Returns S_OK with the manifest dict, or S_ERROR (and no archive left behind)
+        """
+    if MANIFEST_NAME in [os.path.basename(pfn) for pfn in pfns]:
+        return S_ERROR('A file to be archived is called %s' % MANIFEST_NAME)
+    manifest = {'Created': time.time(), 'Files': []}
+    try:
+        archive = tarfile.open(archivePath, 'w')
+        try:
+            for pfn in pfns:
+                st = os.stat(pfn)
+                name = os.path.basename(pfn)
+                archive.add(pfn, arcname=name, recursive=False)
+                manifest['Files'].append({'Name': name, 'Size': st.st_size, 'MTime': st.st_mtime,
+                                          'Checksum': adler32(pfn), 'ChecksumType': 'ADLER32'})
+            manifestString = json.dumps(manifest, indent=1, sort_keys=True)
+            manifestInfo = tarfile.TarInfo(MANIFEST_NAME)
+            manifestInfo.size = len(manifestString)
+            manifestInfo.mtime = manifest['Created']
+            archive.addfile(manifestInfo, StringIO.StringIO(manifestString))
+        finally:
+            archive.close()
+    except (IOError, OSError, tarfile.TarError) as e:
+        removeArchive(archivePath)
+        return S_ERROR('Could not create archive %s: %s' % (archivePath, e))
+    return S_OK(manifest)
+
+
+def readManifest(archivePath):
+    """ The manifest of an archive made by buildArchive
+        """
+    try:
+        archive = tarfile.open(archivePath, 'r')
+        try:
+            return S_OK(json.load(archive.extractfile(MANIFEST_NAME)))
+        finally:
+            archive.close()
+    except (IOError, OSError, KeyError, ValueError, tarfile.TarError) as e:
+        return S_ERROR('Could not read the manifest of %s: %s' % (archivePath, e))
+
+
+def removeArchive(archivePath):
+    """ Remove a local archive, if it is there
+        """
+    try:
+        os.remove(archivePath)
+    except OSError:
+        pass
+
+#...............................................................................
+#EOF
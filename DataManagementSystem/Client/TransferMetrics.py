@@ -0,0 +1,193 @@
+########################################################################
+# $HeadURL$
+# File: TransferMetrics.py
+########################################################################
+""" :mod: TransferMetrics
+    ====================
+
+    Thread safe counters, gauges and histograms for the replicate agents,
+    exported as a Prometheus text file and/or a JSON snapshot.
+
+    Counters and histograms are cumulative over the life of the agent (as
+    Prometheus expects), gauges hold the last value set.
+"""
+
+# # imports
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+__RCSID__ = ' '
+
+# Default histogram buckets, for durations in seconds
+TIME_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800, 3600)
+# Histogram buckets for rates in bytes/s
+RATE_BUCKETS = (1e5, 1e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8, 1e9)
+
+
+class TransferMetrics(object):
+
+    """
+    .. class:: TransferMetrics
+    """
+
+    def __init__(self, prefix):
+        """ c'tor
+
+        :param self: self reference
+        :param str prefix: prefix of all the metric names, e.g. project8_data_replicate
+        """
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+
+
+    def describe(self, name, text):
+        """ Set the help text of a metric
+            """
+        self.help[name] = text
+
+
+    def incr(self, name, value=1, labels=None):
+        """ Increase a counter
+            """
+        key = (name, self.__labelKey(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def setGauge(self, name, value, labels=None):
+        """ Set a gauge
+            """
+        key = (name, self.__labelKey(labels))
+        with self.lock:
+            self.gauges[key] = value
+
+
+    def observe(self, name, value, labels=None, buckets=TIME_BUCKETS):
+        """ Add an observation to a histogram
+            """
+        key = (name, self.__labelKey(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {'Buckets': tuple(buckets), 'Counts': [0] * len(buckets), 'Count': 0, 'Sum': 0.0}
+                self.histograms[key] = histogram
+            for i, bound in enumerate(histogram['Buckets']):
+                if value <= bound:
+                    histogram['Counts'][i] += 1
+            histogram['Count'] += 1
+            histogram['Sum'] += value
+
+
+    def getCounter(self, name, labels=None):
+        """ Current value of a counter
+            """
+        with self.lock:
+            return self.counters.get((name, self.__labelKey(labels)), 0)
+
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        """ Context manager observing the duration (seconds) of its block in a histogram
+            """
+        initialTime = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - initialTime, labels)
+
+
+    def snapshot(self):
+        """ All the metrics as a JSON serialisable dict
+            """
+        with self.lock:
+            return {'Time': time.time(),
+                    'Counters': [self.__entry(key, value) for key, value in sorted(self.counters.items())],
+                    'Gauges': [self.__entry(key, value) for key, value in sorted(self.gauges.items())],
+                    'Histograms': [self.__entry(key, {'Buckets': list(h['Buckets']), 'Counts': list(h['Counts']),
+                                                      'Count': h['Count'], 'Sum': h['Sum']})
+                                   for key, h in sorted(self.histograms.items())]}
+
+
+    def toPrometheus(self):
+        """ All the metrics in the Prometheus text exposition format
+            """
+        lines = []
+        with self.lock:
+            for metricType, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted(set(key[0] for key in metrics)):
+                    self.__header(lines, name, metricType)
+                    for key in sorted(k for k in metrics if k[0] == name):
+                        lines.append('%s%s %s' % (self.__fullName(name), self.__labelString(key[1]), metrics[key]))
+            for name in sorted(set(key[0] for key in self.histograms)):
+                self.__header(lines, name, 'histogram')
+                for key in sorted(k for k in self.histograms if k[0] == name):
+                    h = self.histograms[key]
+                    for bound, count in zip(h['Buckets'], h['Counts']):
+                        lines.append('%s_bucket%s %s' % (self.__fullName(name), self.__labelString(key[1], ('le', repr(float(bound)))), count))
+                    lines.append('%s_bucket%s %s' % (self.__fullName(name), self.__labelString(key[1], ('le', '+Inf')), h['Count']))
+                    lines.append('%s_sum%s %s' % (self.__fullName(name), self.__labelString(key[1]), h['Sum']))
+                    lines.append('%s_count%s %s' % (self.__fullName(name), self.__labelString(key[1]), h['Count']))
+        return '\n'.join(lines) + '\n'
+
+
+    def dump(self, directory, formats=('prometheus', 'json')):
+        """ Write the metrics to <directory>/<prefix>.prom and/or <directory>/<prefix>.json.
+            Files are replaced atomically so that a reader never sees a partial file.
+            """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        written = []
+        for fmt in formats:
+            if fmt == 'prometheus':
+                path, content = os.path.join(directory, self.prefix + '.prom'), self.toPrometheus()
+            elif fmt == 'json':
+                path, content = os.path.join(directory, self.prefix + '.json'), json.dumps(self.snapshot(), indent=1)
+            else:
+                continue
+            tmpPath = path + '.tmp'
+            with open(tmpPath, 'w') as tmpFile:
+                tmpFile.write(content)
+            os.rename(tmpPath, path)
+            written.append(path)
+        return written
+
+
+    # Private methods ............................................................
+
+    @staticmethod
+    def __labelKey(labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+
+    def __fullName(self, name):
+        return '%s_%s' % (self.prefix, name)
+
+
+    def __header(self, lines, name, metricType):
+        if name in self.help:
+            lines.append('# HELP %s %s' % (self.__fullName(name), self.help[name]))
+        lines.append('# TYPE %s %s' % (self.__fullName(name), metricType))
+
+
+    @staticmethod
+    def __labelString(labelKey, extra=None):
+        labels = list(labelKey)
+        if extra:
+            labels.append(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels)
+
+
+    def __entry(self, key, value):
+        return {'Name': self.__fullName(key[0]), 'Labels': dict(key[1]), 'Value': value}
+
+    #...............................................................................
+    #EOF
@@ -0,0 +1,3 @@
+"""
+   Project8DIRAC.DataManagementSystem.Client package
+"""
@@ -0,0 +1,575 @@
+#!/usr/bin/env python
+########################################################################
+# $HeadURL$
+# File: dirac-dms-p8-replicate-benchmark.py
+########################################################################
+""" :mod: dirac-dms-p8-replicate-benchmark
+    ====================
+
+    Offline benchmark of Project8ThreadedDataReplicateAgent.
+
+    The agent runs its normal cycles (scan, getFilesToBeCopied, makeFileCopyQueue,
+    copy and verify threads) over a synthetic tree of sparse files, with
+    in-process stand-ins for the File Catalog, the upload (DataManager.putAndRegister)
+    and gfal2. The stand-ins sleep according to simple latency and bandwidth models,
+    so no DIRAC service, proxy or SE (nor its configuration) is needed.
+
+    For every cycle it reports the files and bytes uploaded, the files verified,
+    the cycle time, files/s and bytes/s.
+
+    Usage:
+      dirac-dms-p8-replicate-benchmark.py --files 100000 --files-per-dir 1000 --cycles 3
+      dirac-dms-p8-replicate-benchmark.py --option maxNumberOfThreads=30 --option UseScanIndex=true
+
+    The models can be sped up with --time-scale (all the modelled delays are multiplied by it),
+    the agent options are set with --option Name=Value (the value is parsed as JSON if possible).
+"""
+
+# # imports
+import os
+import sys
+import imp
+import json
+import time
+import types
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+
+from DIRAC import S_OK, S_ERROR, gLogger
+
+__RCSID__ = ' '
+
+AGENT_NAME = 'Project8ThreadedDataReplicateAgent'
+BENCHMARK_SE = 'P8-BENCHMARK-SE'
+BENCHMARK_SE_DIR = '/project8/benchmark/data/'
+
+
+class LatencyModel(object):
+
+    """
+    .. class:: LatencyModel
+
+    Delay of a call: base + perItem * number of items, +/- a uniform jitter
+    """
+
+    def __init__(self, base, perItem=0., jitter=0., timeScale=1., seed=None):
+        self.base = base
+        self.perItem = perItem
+        self.jitter = jitter
+        self.timeScale = timeScale
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+
+    def wait(self, nItems=1):
+        """ Sleep for the modelled delay, returns it
+            """
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0.
+        delay = max(0., self.base + self.perItem * nItems + jitter) * self.timeScale
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class BandwidthModel(object):
+
+    """
+    .. class:: BandwidthModel
+
+    A link of linkBandwidth bytes/s shared by all the running transfers,
+    each of them also limited to streamBandwidth bytes/s per stream.
+    The rate of a transfer is fixed when it starts.
+    """
+
+    def __init__(self, linkBandwidth, streamBandwidth, timeScale=1.):
+        self.linkBandwidth = float(linkBandwidth)
+        self.streamBandwidth = float(streamBandwidth)
+        self.timeScale = timeScale
+        self.lock = threading.Lock()
+        self.active = 0
+
+
+    def transfer(self, nbytes, streams=1):
+        """ Sleep for the modelled duration of a transfer of nbytes, returns it
+            """
+        with self.lock:
+            self.active += 1
+            rate = min(self.streamBandwidth * streams, self.linkBandwidth / self.active)
+        try:
+            duration = nbytes / rate * self.timeScale
+            if duration:
+                time.sleep(duration)
+            return duration
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+class StandInStorage(object):
+
+    """
+    .. class:: StandInStorage
+
+    Shared state of the stand-ins: the catalog (lfn -> {SE: surl}, lfn -> file meta data),
+    the dir meta data, the replicas on the SEs (surl -> size) and some counters
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.replicas = {}
+        self.fileMetadata = {}
+        self.dirMetadata = {}
+        self.seFiles = {}
+        self.counters = {}
+
+
+    @staticmethod
+    def getSURL(se, lfn):
+        return 'srm://%s%s' % (se.lower(), lfn)
+
+
+    def addReplica(self, lfn, se, size, checksum=None):
+        surl = self.getSURL(se, lfn)
+        with self.lock:
+            self.replicas.setdefault(lfn, {})[se] = surl
+            self.fileMetadata[lfn] = {'Size': size, 'Checksum': checksum, 'ChecksumType': 'ADLER32' if checksum else None}
+            self.seFiles[surl] = size
+        return surl
+
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def getCounters(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class StandInFileCatalogClient(object):
+
+    """
+    .. class:: StandInFileCatalogClient
+
+    In-process replacement for the FileCatalogClient calls used by the agent
+    """
+
+    def __init__(self, storage, rpcLatency):
+        self.storage = storage
+        self.rpcLatency = rpcLatency
+
+
+    def getReplicas(self, lfns, allStatus=False):
+        lfns = [lfns] if isinstance(lfns, basestring) else list(lfns)
+        self.rpcLatency.wait(len(lfns))
+        self.storage.count('getReplicas')
+        successful = {}
+        failed = {}
+        with self.storage.lock:
+            for lfn in lfns:
+                if lfn in self.storage.replicas:
+                    successful[lfn] = dict(self.storage.replicas[lfn])
+                else:
+                    failed[lfn] = 'No such file or directory'
+        return S_OK({'Successful': successful, 'Failed': failed})
+
+
+    def getFileMetadata(self, lfns):
+        lfns = [lfns] if isinstance(lfns, basestring) else list(lfns)
+        self.rpcLatency.wait(len(lfns))
+        self.storage.count('getFileMetadata')
+        successful = {}
+        failed = {}
+        with self.storage.lock:
+            for lfn in lfns:
+                if lfn in self.storage.fileMetadata:
+                    successful[lfn] = dict(self.storage.fileMetadata[lfn])
+                else:
+                    failed[lfn] = 'No such file or directory'
+        return S_OK({'Successful': successful, 'Failed': failed})
+
+
+    def addFile(self, lfns):
+        self.rpcLatency.wait(len(lfns))
+        self.storage.count('addFile')
+        for lfn, fileDict in lfns.items():
+            self.storage.addReplica(lfn, fileDict['SE'], fileDict['Size'], fileDict.get('Checksum'))
+        return S_OK({'Successful': dict((lfn, True) for lfn in lfns), 'Failed': {}})
+
+
+    def setMetadata(self, path, metadict):
+        self.rpcLatency.wait()
+        self.storage.count('setMetadata')
+        with self.storage.lock:
+            self.storage.dirMetadata.setdefault(path, {}).update(metadict)
+        return S_OK()
+
+
+    def setMetadataBulk(self, pathMetadataDict):
+        self.rpcLatency.wait(len(pathMetadataDict))
+        self.storage.count('setMetadataBulk')
+        with self.storage.lock:
+            for path, metadict in pathMetadataDict.items():
+                self.storage.dirMetadata.setdefault(path, {}).update(metadict)
+        return S_OK({'Successful': dict((path, True) for path in pathMetadataDict), 'Failed': {}})
+
+
+class StandInDataManager(object):
+
+    """
+    .. class:: StandInDataManager
+
+    In-process replacement for DataManager.putAndRegister: the transfer takes the time given by
+    the bandwidth model, the registration the catalog latency. A fraction of the uploads fail.
+    """
+
+    def __init__(self, storage, bandwidth, rpcLatency, failureRate=0., seed=None):
+        self.storage = storage
+        self.bandwidth = bandwidth
+        self.rpcLatency = rpcLatency
+        self.failureRate = failureRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+
+    def putAndRegister(self, lfn, fileName, diracSE, guid=None, path=None, checksum=None, overwrite=False):
+        try:
+            size = os.path.getsize(fileName)
+        except OSError as e:
+            return S_ERROR('Could not get size of %s: %s' % (fileName, e.strerror))
+        with self.lock:
+            failed = self.random.random() < self.failureRate
+        putTime = self.bandwidth.transfer(size)
+        if failed:
+            self.storage.count('failedUploads')
+            return S_OK({'Successful': {}, 'Failed': {lfn: 'Simulated upload failure'}})
+        registerTime = self.rpcLatency.wait()
+        self.storage.addReplica(lfn, diracSE, size, checksum)
+        self.storage.count('uploads')
+        self.storage.count('uploadedBytes', size)
+        return S_OK({'Successful': {lfn: {'put': putTime, 'register': registerTime}}, 'Failed': {}})
+
+
+class StandInStorageElement(object):
+
+    """
+    .. class:: StandInStorageElement
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+
+    def getURL(self, lfn, protocol=None):
+        return S_OK({'Successful': {lfn: StandInStorage.getSURL(self.name, lfn)}, 'Failed': {}})
+
+
+class StandInConfig(object):
+
+    """
+    .. class:: StandInConfig
+
+    The DIRAC configuration of the agent, with the benchmark SE added to the sections of seCfgPath
+    (the agent checks CopyToSE against them). Everything else goes to the real configuration.
+    """
+
+    def __init__(self, config, seCfgPath, seName):
+        self.config = config
+        self.seCfgPath = seCfgPath.strip('/')
+        self.seName = seName
+
+
+    def getSections(self, sectionPath, *args, **kwargs):
+        res = self.config.getSections(sectionPath, *args, **kwargs)
+        if sectionPath.strip('/') != self.seCfgPath:
+            return res
+        sections = list(res['Value']) if res['OK'] and res['Value'] else []
+        if self.seName not in sections:
+            sections.append(self.seName)
+        return S_OK(sections)
+
+
+    def __getattr__(self, name):
+        return getattr(self.config, name)
+
+
+class StandInTransferParameters(object):
+
+    """
+    .. class:: StandInTransferParameters
+    """
+
+    def __init__(self):
+        self.nbstreams = 1
+        self.overwrite = False
+        self.create_parent = False
+        self.timeout = 0
+        self.checksum_check = False
+        self.checksum = None
+
+
+    def set_user_defined_checksum(self, checksumType, checksum):
+        self.checksum = checksum
+
+
+class StandInGfal2Context(object):
+
+    """
+    .. class:: StandInGfal2Context
+
+    stat of the replicas, and copies (filecopy) going through the bandwidth model.
+    The copied files are not registered, the caller does it.
+    """
+
+    def __init__(self, storage, statLatency, bandwidth):
+        self.storage = storage
+        self.statLatency = statLatency
+        self.bandwidth = bandwidth
+
+
+    def transfer_parameters(self):
+        return StandInTransferParameters()
+
+
+    def filecopy(self, params, source, destination):
+        size = os.path.getsize(source[len('file://'):] if source.startswith('file://') else source)
+        self.bandwidth.transfer(size, params.nbstreams)
+        self.storage.count('filecopies')
+        self.storage.count('uploadedBytes', size)
+        with self.storage.lock:
+            self.storage.seFiles[destination] = size
+
+
+    def stat(self, surl):
+        self.statLatency.wait()
+        self.storage.count('stats')
+        with self.storage.lock:
+            if surl not in self.storage.seFiles:
+                raise Exception('[gfal2_stat] No such file or directory: %s' % surl)
+            size = self.storage.seFiles[surl]
+        return StandInStat(size)
+
+
+class StandInStat(object):
+
+    """
+    .. class:: StandInStat
+    """
+
+    def __init__(self, size):
+        self.st_size = size
+
+
+def makeGfal2Module(storage, statLatency, bandwidth):
+    """ A module that can stand in for gfal2 in the agent
+        """
+    module = types.ModuleType('gfal2', 'Stand-in gfal2 module')
+    module.creat_context = lambda: StandInGfal2Context(storage, statLatency, bandwidth)
+    return module
+
+
+def makeSyntheticTree(root, nFiles, filesPerDir, meanSize, sizeSpread, seed=None, suffix='.egg', age=3600):
+    """ Create nFiles sparse files (truncated to a lognormal size around meanSize) in run dirs
+        of filesPerDir files under root, each dir with a small _meta.json. The files are dated age
+        seconds ago, i.e. closed for long enough for any MinFileAge. Returns the total size.
+        """
+    rng = random.Random(seed)
+    totalSize = 0
+    fileTime = time.time() - age
+    for index in xrange(nFiles):
+        runNumber, fileNumber = divmod(index, filesPerDir)
+        runDir = os.path.join(root, 'run%06d' % runNumber)
+        if fileNumber == 0:
+            os.makedirs(runDir)
+            with open(os.path.join(runDir, 'run%06d_meta.json' % runNumber), 'w') as metaFile:
+                json.dump({'run_id': runNumber, 'run_tag': 'benchmark'}, metaFile)
+            os.utime(os.path.join(runDir, 'run%06d_meta.json' % runNumber), (fileTime, fileTime))
+        if sizeSpread:
+            size = int(rng.lognormvariate(0, sizeSpread) * meanSize)
+        else:
+            size = int(meanSize)
+        with open(os.path.join(runDir, 'run%06d_%06d%s' % (runNumber, fileNumber, suffix)), 'w') as dataFile:
+            dataFile.truncate(size)
+        os.utime(os.path.join(runDir, 'run%06d_%06d%s' % (runNumber, fileNumber, suffix)), (fileTime, fileTime))
+        totalSize += size
+    return totalSize
+
+
+def loadAgentClass(repoRoot):
+    """ Import the agent from this source tree (imported as Project8DIRAC, whatever the dir is called)
+        """
+    for packageName, packagePath in (('Project8DIRAC', repoRoot),
+                                     ('Project8DIRAC.DataManagementSystem.Agent',
+                                      os.path.join(repoRoot, 'DataManagementSystem', 'Agent'))):
+        if packageName not in sys.modules:
+            package = types.ModuleType(packageName)
+            package.__path__ = [packagePath]
+            sys.modules[packageName] = package
+    if 'gfal2' not in sys.modules:
+        try:
+            import gfal2  # pylint: disable=unused-variable
+        except ImportError:
+            ### It is replaced by the stand-in anyway
+            sys.modules['gfal2'] = types.ModuleType('gfal2')
+    agentPath = os.path.join(repoRoot, 'DataManagementSystem', 'Agent', AGENT_NAME + '.py')
+    agentModule = imp.load_source('Project8DIRAC.DataManagementSystem.Agent.' + AGENT_NAME, agentPath)
+    return agentModule, getattr(agentModule, AGENT_NAME)
+
+
+def makeBenchmarkAgent(agentClass, options, workDir):
+    """ An instance of the agent that takes its options from a dict, without the AgentModule set up
+        """
+
+    class BenchmarkAgent(agentClass):
+
+        def __init__(self):
+            pass
+
+        def am_getOption(self, optionName, defaultValue=None):
+            return options.get(optionName, defaultValue)
+
+        def am_setOption(self, optionName, value):
+            options[optionName] = value
+
+        def am_setModuleParam(self, optionName, value):
+            options[optionName] = value
+
+        def am_getPollingTime(self):
+            return options.get('pollingTime', options.get('PollingTime', 120))
+
+        def am_getWorkDirectory(self):
+            return workDir
+
+    return BenchmarkAgent()
+
+
+def parseOptionValue(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of %s with stand-ins for the catalog, SE and upload' % AGENT_NAME)
+    parser.add_argument('--files', type=int, default=10000, help='number of data files in the synthetic tree')
+    parser.add_argument('--files-per-dir', type=int, default=1000, help='number of data files per run dir')
+    parser.add_argument('--mean-size', type=float, default=100e6, help='mean file size (bytes)')
+    parser.add_argument('--size-spread', type=float, default=1., help='sigma of the lognormal file size, 0 for fixed size')
+    parser.add_argument('--catalogued-fraction', type=float, default=0.1,
+                        help='fraction of the files already in the catalog and on the SE (verified and deleted)')
+    parser.add_argument('--cycles', type=int, default=3, help='number of agent cycles')
+    parser.add_argument('--rpc-latency', type=float, default=0.05, help='catalog call latency (s)')
+    parser.add_argument('--rpc-latency-per-item', type=float, default=1e-4, help='catalog latency per lfn (s)')
+    parser.add_argument('--stat-latency', type=float, default=0.02, help='gfal2 stat latency (s)')
+    parser.add_argument('--link-bandwidth', type=float, default=1e9, help='total bandwidth to the SE (bytes/s)')
+    parser.add_argument('--stream-bandwidth', type=float, default=1e8, help='bandwidth of one upload (bytes/s)')
+    parser.add_argument('--upload-failure-rate', type=float, default=0., help='fraction of uploads failing')
+    parser.add_argument('--time-scale', type=float, default=1., help='factor applied to all the modelled delays')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the tree and the models')
+    parser.add_argument('--work-dir', help='where to create the tree and the agent work dir (kept), default a temporary dir')
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE', help='agent option')
+    parser.add_argument('--json', help='write the report to this file as JSON')
+    parser.add_argument('--log-level', default='ERROR', help='gLogger level of the agent')
+    args = parser.parse_args()
+
+    gLogger.setLevel(args.log_level)
+    repoRoot = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    agentModule, agentClass = loadAgentClass(repoRoot)
+
+    workDir = args.work_dir or tempfile.mkdtemp(prefix='p8-replicate-benchmark-')
+    dataDir = os.path.join(workDir, 'data')
+    agentWorkDir = os.path.join(workDir, 'agent')
+    for directory in (dataDir, agentWorkDir):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    try:
+        initialTime = time.time()
+        totalSize = makeSyntheticTree(dataDir, args.files, args.files_per_dir, args.mean_size, args.size_spread, args.seed)
+        print 'Created %s files (%.3g bytes, sparse) in %.1f s under %s' % (args.files, totalSize, time.time() - initialTime, dataDir)
+
+        ### The stand-ins
+        storage = StandInStorage()
+        rpcLatency = LatencyModel(args.rpc_latency, args.rpc_latency_per_item, args.rpc_latency / 5, args.time_scale, args.seed)
+        statLatency = LatencyModel(args.stat_latency, 0., args.stat_latency / 5, args.time_scale, args.seed + 1)
+        bandwidth = BandwidthModel(args.link_bandwidth, args.stream_bandwidth, args.time_scale)
+        fileCatalog = StandInFileCatalogClient(storage, rpcLatency)
+        dataManager = StandInDataManager(storage, bandwidth, rpcLatency, args.upload_failure_rate, args.seed + 2)
+        agentModule.FileCatalogClient = lambda *args, **kwargs: fileCatalog
+        agentModule.DataManager = lambda *args, **kwargs: dataManager
+        agentModule.gfal2 = makeGfal2Module(storage, statLatency, bandwidth)
+        agentModule.StorageElement = StandInStorageElement
+        agentModule.gConfig = StandInConfig(agentModule.gConfig, 'Resources/StorageElements', BENCHMARK_SE)
+
+        ### Some files are already on the SE
+        rng = random.Random(args.seed + 3)
+        for currentdir, _subdirs, filenames in os.walk(dataDir):
+            for filename in filenames:
+                if filename.endswith('_meta.json') or rng.random() >= args.catalogued_fraction:
+                    continue
+                pfn = os.path.join(currentdir, filename)
+                storage.addReplica(os.path.join(BENCHMARK_SE_DIR, pfn.split(dataDir)[-1].strip('/')), BENCHMARK_SE, os.path.getsize(pfn))
+
+        options = {'CopyToSE': BENCHMARK_SE,
+                   'SEDataDirPath': BENCHMARK_SE_DIR,
+                   'LocalDataDirPaths': [dataDir],
+                   'MaxFilesToTransferPerCycle': args.files,
+                   'MetricsDir': agentWorkDir}
+        for option in args.option:
+            name, _sep, value = option.partition('=')
+            options[name.strip()] = parseOptionValue(value.strip())
+        agent = makeBenchmarkAgent(agentClass, options, agentWorkDir)
+        res = agent.initialize()
+        if not res['OK']:
+            print 'Agent initialization failed: %s' % res['Message']
+            return 1
+
+        report = {'Options': dict((key, value) for key, value in vars(args).items()),
+                  'AgentOptions': options,
+                  'Cycles': []}
+        if args.time_scale != 1.:
+            print 'Modelled delays are scaled by %s, the rates below are wall clock rates' % args.time_scale
+        print '%5s %9s %12s %9s %10s %10s %12s' % ('cycle', 'uploaded', 'bytes', 'verified', 'time (s)', 'files/s', 'bytes/s')
+        for cycle in xrange(args.cycles):
+            before = storage.getCounters()
+            initialTime = time.time()
+            res = agent.execute()
+            cycleTime = time.time() - initialTime
+            after = storage.getCounters()
+            delta = dict((key, after.get(key, 0) - before.get(key, 0)) for key in after)
+            result = {'Cycle': cycle,
+                      'OK': res['OK'],
+                      'CycleTime': cycleTime,
+                      'Uploads': delta.get('uploads', 0) + delta.get('filecopies', 0),
+                      'FailedUploads': delta.get('failedUploads', 0),
+                      'UploadedBytes': delta.get('uploadedBytes', 0),
+                      'Verified': delta.get('stats', 0),
+                      'CatalogCalls': sum(delta.get(call, 0) for call in ('getReplicas', 'getFileMetadata', 'addFile', 'setMetadata', 'setMetadataBulk')),
+                      'FilesPerSecond': (delta.get('uploads', 0) + delta.get('filecopies', 0)) / max(cycleTime, 1e-6),
+                      'BytesPerSecond': delta.get('uploadedBytes', 0) / max(cycleTime, 1e-6)}
+            report['Cycles'].append(result)
+            print '%5s %9s %12.4g %9s %10.2f %10.1f %12.4g' % (cycle, result['Uploads'], result['UploadedBytes'], result['Verified'],
+                                                              cycleTime, result['FilesPerSecond'], result['BytesPerSecond'])
+            if not res['OK']:
+                print 'Cycle failed: %s' % res['Message']
+
+        if args.json:
+            with open(args.json, 'w') as reportFile:
+                json.dump(report, reportFile, indent=1)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(workDir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+#...............................................................................
+#EOF